@@ -0,0 +1,157 @@
+"""
+Benchmark each stage of extractIFCBdata.py on synthetic bins
+
+Matlab is replaced by a stub feature engine so the benchmark runs anywhere and measures only the python code.
+Results are saved in json to compare commits:
+    python -m dev.benchmark -n 20 -o before.json
+    git checkout <branch>
+    python -m dev.benchmark -n 20 -o after.json -c before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import PIL
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from extractIFCBdata import BinExtractor, CorruptedBin, parse_adc, __version__, \
+    FTR_V2_COLUMN_NAMES, BLOB_FTR_V4_COLUMN_NAMES, SLIM_FTR_V4_COLUMN_NAMES, ALL_FTR_V4_COLUMN_NAMES
+from dev.benchmark.synthetic import make_dataset
+
+SEABASS_METADATA = {'investigators': 'Jane_Doe', 'affiliations': 'University_of_Maine', 'contact': 'jane@doe.edu',
+                    'documents': 'protocol.pdf', 'calibration_files': 'no_cal_files', 'associated_files': 'raw.zip',
+                    'associated_file_types': 'raw', 'instrument_model': 'Imaging_FlowCytobot_IFCB107',
+                    'instrument_manufacturer': 'McLane_Research_Laboratories_Inc', 'pixel_per_um': 3.4,
+                    'data_status': 'preliminary', 'experiment': 'BENCHMARK', 'cruise': 'BENCHMARK',
+                    'filename_descriptor': 'IFCB_plankton&particles', 'revision': 'R0',
+                    'dashboard_url': 'http://localhost/', 'ifcb_analysis_version': 'v4'}
+
+
+class StubBinExtractor(BinExtractor):
+    """ BinExtractor returning placeholder features computed with numpy instead of Matlab """
+
+    def _stub_features(self, bin_name, column_names):
+        with self.raw.open(bin_name, '.adc') as f:
+            adc = parse_adc(f)
+        adc = adc[adc['StartByte'] != adc['EndByte']]
+        rng = np.random.default_rng(len(adc))
+        features = pd.DataFrame(rng.random((len(adc), len(column_names))) * 100, columns=column_names)
+        features['ImageId'] = adc.index
+        features['Area'] = adc['ImageWidth'].to_numpy() * adc['ImageHeight'].to_numpy() // 2
+        features['NumberBlobsInImage'] = 1
+        features = features.astype({'ImageId': 'uint32', 'Area': 'uint64', 'NumberBlobsInImage': 'uint16'})
+        features.set_index('ImageId', inplace=True)
+        return features
+
+    def extract_features_v2(self, bin_name, minimal_feature_flag=False):
+        return self._stub_features(bin_name, FTR_V2_COLUMN_NAMES)
+
+    def extract_features_v4(self, bin_name, level=1):
+        return self._stub_features(bin_name, {0: BLOB_FTR_V4_COLUMN_NAMES, 1: SLIM_FTR_V4_COLUMN_NAMES,
+                                              2: ALL_FTR_V4_COLUMN_NAMES}[level])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(path, n_bins=10, n_triggers=1000, corrupted_fraction=0.1, repeat=1, seed=0):
+    """ Generate dataset in path and time each stage, return dictionary of results """
+    bins = make_dataset(path, n_bins, n_triggers, corrupted_fraction=corrupted_fraction, seed=seed)
+    path_to_raw, path_to_out = os.path.join(path, 'raw'), os.path.join(path, 'out')
+    n_images = int(pd.read_csv(os.path.join(path, 'ecotaxa', 'ecotaxa_export.tsv'), sep='\t').shape[0])
+    raw_bytes = sum(os.path.getsize(os.path.join(path_to_raw, f)) for f in os.listdir(path_to_raw))
+    ifcb = StubBinExtractor(path_to_raw, os.path.join(path, 'metadata.csv'))
+    acquisition = {'instrument': 'IFCB', 'serial_number': 107, 'resolution_pixel_per_micron': 3.4}
+    process = {'id': 'benchmark', 'software': 'ifcb-tools', 'software_version': __version__}
+
+    def each_bin(method, **kwargs):
+        for b in bins:
+            try:
+                method(b, **kwargs)
+            except CorruptedBin:
+                pass
+
+    stages = [
+        ('extract_images_and_cytometry', lambda: each_bin(ifcb.extract_images_and_cytometry)),
+        ('extract_header', lambda: each_bin(ifcb.extract_header)),
+        ('write_png', lambda: each_bin(ifcb.extract_images_and_cytometry,
+                                       write_images_to=os.path.join(path_to_out, 'png'))),
+        ('init_ecotaxa_classification', lambda: ifcb.init_ecotaxa_classification(
+            os.path.join(path, 'ecotaxa'), os.path.join(path, 'taxonomic_grouping.csv'))),
+        ('classification_join', lambda: each_bin(ifcb.query_classification, verbose=False)),
+        ('run_ecotaxa', lambda: ifcb.run_ecotaxa(os.path.join(path_to_out, 'ecotaxa'), bins, acquisition, process,
+                                                 force=True)),
+        ('run_science', lambda: ifcb.run_science(os.path.join(path_to_out, 'sci'), update_all=True)),
+        ('run_seabass', lambda: BinExtractor.run_seabass(os.path.join(path_to_out, 'sci'),
+                                                         os.path.join(path_to_out, 'seabass'),
+                                                         dict(SEABASS_METADATA))),
+    ]
+    for d in ['ecotaxa', 'sci', 'seabass']:
+        os.makedirs(os.path.join(path_to_out, d), exist_ok=True)
+    results = {}
+    for name, fn in stages:
+        timings = []
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                t0 = perf_counter()
+                fn()
+                timings.append(perf_counter() - t0)
+        t = min(timings)
+        results[name] = {'seconds': t, 'seconds_per_bin': t / n_bins, 'images_per_second': n_images / t}
+        print(f'{name:<30} {t:8.3f} s  {n_images / t:10.0f} images/s', file=sys.stderr)
+    return {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'pillow': PIL.__version__,
+            'config': {'n_bins': n_bins, 'n_triggers': n_triggers, 'corrupted_fraction': corrupted_fraction,
+                       'repeat': repeat, 'seed': seed, 'n_images': n_images, 'raw_bytes': raw_bytes},
+            'stages': results}
+
+
+def compare(results, baseline):
+    print(f"{'stage':<30} {'baseline (s)':>12} {'current (s)':>12} {'speedup':>8}")
+    for name, r in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        b = baseline['stages'][name]['seconds']
+        print(f"{name:<30} {b:12.3f} {r['seconds']:12.3f} {b / r['seconds']:7.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark extractIFCBdata.py on synthetic bins.')
+    parser.add_argument('-n', '--bins', type=int, default=10, help='Set number of bins to generate.')
+    parser.add_argument('-t', '--triggers', type=int, default=1000, help='Set number of triggers per bin.')
+    parser.add_argument('--corrupted', type=float, default=0.1, help='Set fraction of bins with corrupted tail.')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Set number of repetitions (keep fastest).')
+    parser.add_argument('-o', '--output', type=str, help='Set path to json results (default benchmark_<commit>.json).')
+    parser.add_argument('-c', '--compare', type=str, help='Set path to json results to compare with.')
+    parser.add_argument('-d', '--data', type=str, help='Set directory for synthetic data (kept after run).')
+    args = parser.parse_args()
+
+    path = args.data if args.data else tempfile.mkdtemp(prefix='ifcb_benchmark_')
+    try:
+        results = run_benchmark(path, args.bins, args.triggers, args.corrupted, args.repeat)
+    finally:
+        if not args.data:
+            shutil.rmtree(path, ignore_errors=True)
+    output = args.output if args.output else f"benchmark_{results['commit'] or 'unknown'}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
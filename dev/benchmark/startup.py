@@ -0,0 +1,66 @@
+"""
+Benchmark startup time of extractIFCBdata.py (each run is a new process, like mode ml-classify-rt)
+
+    python -m dev.benchmark.startup -n 20 -o startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAZY_MODULES = ['matlab', 'PIL', 'tqdm', 'makeIFCBTable']
+COMMANDS = {
+    'python': [sys.executable, '-c', 'pass'],
+    'import': [sys.executable, '-c', 'import extractIFCBdata'],
+    'cli_help': [sys.executable, os.path.join(ROOT, 'extractIFCBdata.py'), '--help'],
+}
+
+
+def time_command(cmd, n=10):
+    """ Return wall time (s) of each run of cmd """
+    timings = []
+    for _ in range(n):
+        t0 = perf_counter()
+        subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(perf_counter() - t0)
+    return timings
+
+
+def import_profile(top=10):
+    """ Return modules with the largest cumulative import time (s) and the lazy modules loaded by the import """
+    code = f'import sys, extractIFCBdata; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True,
+                       check=True)
+    modules = []
+    for line in p.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit() and len(name) - len(name.lstrip()) <= 3:  # Imported by extractIFCBdata
+                modules.append((name.strip(), int(cumulative) / 1e6))
+    modules.sort(key=lambda m: -m[1])
+    return dict(modules[:top]), [m for m in p.stdout.strip().split(',') if m]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark startup time of extractIFCBdata.py.')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='Set number of runs of each command.')
+    parser.add_argument('-o', '--output', type=str, help='Set path to json results.')
+    args = parser.parse_args()
+
+    results = {}
+    for name, cmd in COMMANDS.items():
+        t = time_command(cmd, args.repeat)
+        results[name] = {'median': statistics.median(t), 'min': min(t), 'max': max(t)}
+        print(f"{name:<10} {results[name]['median'] * 1000:8.1f} ms (median of {args.repeat})", file=sys.stderr)
+    modules, loaded = import_profile()
+    print('Slowest imports:\n' + '\n'.join(f'\t{m:<30} {t * 1000:8.1f} ms' for m, t in modules.items()),
+          file=sys.stderr)
+    if loaded:
+        print(f"Imported eagerly (expected on first use): {', '.join(loaded)}", file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'startup': results, 'imports': modules, 'eager': loaded}, f, indent=2)
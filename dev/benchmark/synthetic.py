@@ -0,0 +1,122 @@
+"""
+Generate synthetic IFCB data (adc, hdr, and roi files) with the metadata, taxonomic grouping and EcoTaxa files
+required to run every mode of extractIFCBdata.py
+"""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+HDR_TEMPLATE = """softwareVersion: Imaging FlowCytobot Acquisition Software version 2.2.3.0
+runTime: {run_time:.6f}
+inhibitTime: {inhibit_time:.6f}
+SyringeSampleVolume: 5
+PMTAhighVoltage: 0.550000
+PMTBhighVoltage: 0.650000
+PMTtriggerSelection_DAQ_MCConly: 2
+PMTAtriggerThreshold_DAQ_MCConly: 0.150000
+PMTBtriggerThreshold_DAQ_MCConly: 0.140000
+"""
+HIERARCHY = ['living>Eukaryota>Harosa>Stramenopiles>Ochrophyta>Bacillariophyta',
+             'living>Eukaryota>Harosa>Alveolata>Myzozoa>Dinophyceae',
+             'living>Eukaryota>Harosa>Alveolata>Ciliophora',
+             'not-living>detritus', 'not-living>artefact>bubble']
+TAXON = ['Bacillariophyta', 'Dinophyceae', 'Ciliophora', 'detritus', 'bubble']
+GROUP = ['Diatom', 'Dinoflagellate', 'Ciliate', 'Detritus', 'Artefact']
+
+
+def make_image(rng, height, width):
+    """ Grey background with a darker elliptic particle and noise (compresses like a real ROI) """
+    y, x = np.ogrid[:height, :width]
+    cy, cx = height / 2, width / 2
+    ry, rx = max(1., height * rng.uniform(0.2, 0.45)), max(1., width * rng.uniform(0.2, 0.45))
+    particle = ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 <= 1
+    img = rng.normal(200, 3, (height, width))
+    img[particle] -= rng.uniform(40, 120)
+    return img.clip(0, 255).astype('uint8')
+
+
+def make_bin(path, bin_name, n_triggers=1000, multi_roi_fraction=0.05, empty_fraction=0.01,
+             size_mean=(60, 40), size_sigma=0.6, max_size=(1360, 1024), corrupted_tail=False, seed=None):
+    """
+    Write adc, hdr, and roi files of a synthetic bin
+
+    :param n_triggers: number of triggers in bin
+    :param multi_roi_fraction: fraction of triggers with two ROIs
+    :param empty_fraction: fraction of triggers without ROI (width and height of 0)
+    :param size_mean: geometric mean of ROI width and height (pixels), sizes follow a log-normal distribution
+    :param size_sigma: standard deviation of log of ROI sizes
+    :param corrupted_tail: truncate roi file to simulate an interrupted acquisition
+    :return: number of ROIs in bin
+    """
+    rng = np.random.default_rng(seed)
+    rows, start_byte, run_time, n_images = [], 0, 0., 0
+    with open(os.path.join(path, bin_name + '.roi'), 'wb') as roi:
+        for trigger in range(1, n_triggers + 1):
+            run_time += rng.exponential(1.2)
+            n_roi = 2 if rng.random() < multi_roi_fraction else 1
+            for _ in range(n_roi):
+                if rng.random() < empty_fraction:
+                    width, height = 0, 0
+                else:
+                    width = int(np.clip(rng.lognormal(np.log(size_mean[0]), size_sigma), 8, max_size[0]))
+                    height = int(np.clip(rng.lognormal(np.log(size_mean[1]), size_sigma), 8, max_size[1]))
+                    roi.write(make_image(rng, height, width).tobytes())
+                    n_images += 1
+                ssc, fl = rng.lognormal(-2, 1, 2)
+                rows.append(f'{trigger},{run_time:.5f},{ssc:.5f},{fl:.5f},0.00000,0.00000,{ssc * 1.5:.5f},'
+                            f'{fl * 1.5:.5f},0.00000,0.00000,{rng.uniform(5, 60):.0f},{run_time - 0.001:.5f},'
+                            f'{run_time:.5f},{rng.integers(0, 1000)},{rng.integers(0, 800)},{width},{height},'
+                            f'{start_byte},0,0,0,0,{run_time:.5f},{run_time * 0.02:.5f}')
+                start_byte += width * height
+    with open(os.path.join(path, bin_name + '.adc'), 'w') as adc:
+        adc.write('\n'.join(rows) + '\n')
+    with open(os.path.join(path, bin_name + '.hdr'), 'w') as hdr:
+        hdr.write(HDR_TEMPLATE.format(run_time=run_time, inhibit_time=run_time * 0.02))
+    if corrupted_tail:
+        with open(os.path.join(path, bin_name + '.roi'), 'r+b') as roi:
+            roi.truncate(max(0, start_byte - 1000))
+    return n_images
+
+
+def make_dataset(path, n_bins=10, n_triggers=1000, corrupted_fraction=0., serial_number=107,
+                 start=datetime(2023, 5, 1), interval=timedelta(minutes=20), seed=0, **kwargs):
+    """
+    Write a synthetic dataset in path:
+        raw/            adc, hdr, and roi files
+        metadata.csv    environmental data of each bin
+        taxonomic_grouping.csv
+        ecotaxa/ecotaxa_export.tsv  classification of each image
+
+    :return: list of bin names
+    """
+    rng = np.random.default_rng(seed)
+    path_to_raw = os.path.join(path, 'raw')
+    os.makedirs(path_to_raw, exist_ok=True)
+    os.makedirs(os.path.join(path, 'ecotaxa'), exist_ok=True)
+    bins, object_ids = [], []
+    for i in range(n_bins):
+        dt = start + i * interval
+        bin_name = f'D{dt:%Y%m%dT%H%M%S}_IFCB{serial_number}'
+        make_bin(path_to_raw, bin_name, n_triggers, corrupted_tail=rng.random() < corrupted_fraction,
+                 seed=rng.integers(2**32), **kwargs)
+        bins.append(bin_name)
+        adc = pd.read_csv(os.path.join(path_to_raw, bin_name + '.adc'), header=None, usecols=[15, 16])
+        image_ids = np.flatnonzero(adc[15] * adc[16] > 0) + 1
+        object_ids += [f'{bin_name}_{j:05d}' for j in image_ids]
+    # Environmental data
+    n = len(bins)
+    pd.DataFrame({'bin': bins, 'DateTime': [f'{start + i * interval:%Y/%m/%d %H:%M:%S}' for i in range(n)],
+                  'Latitude': np.linspace(43.5, 44.5, n), 'Longitude': np.linspace(-69, -68, n),
+                  'Depth': 5, 'Salinity': rng.normal(33, 0.5, n), 'Temperature': rng.normal(12, 2, n),
+                  'Type': 'inline', 'Station': np.nan, 'Campaign': 1, 'Concentration': 1, 'Flag': ''}) \
+        .to_csv(os.path.join(path, 'metadata.csv'), index=False)
+    # Taxonomy and classification
+    pd.DataFrame({'hierarchy': HIERARCHY, 'taxon': TAXON, 'group': GROUP}) \
+        .to_csv(os.path.join(path, 'taxonomic_grouping.csv'), index=False)
+    pd.DataFrame({'object_id': object_ids,
+                  'object_annotation_status': rng.choice(['validated', 'predicted', 'dubious'], len(object_ids)),
+                  'object_annotation_hierarchy': rng.choice(HIERARCHY, len(object_ids))}) \
+        .to_csv(os.path.join(path, 'ecotaxa', 'ecotaxa_export.tsv'), sep='\t', index=False)
+    return bins
@@ -12,18 +12,30 @@ Copyright (c) 2021 Nils Haentjens
 """
 
 import glob
+import io
+import json
 import sys
 import os
 import re
 import argparse
+import csv
+import tarfile
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from datetime import datetime, timezone
+from time import time, sleep, perf_counter
 from warnings import warn
 
 import numpy as np
 import pandas as pd
 from pandas.api.types import union_categoricals
-from PIL import Image, ImageDraw, ImageFont
-import matlab.engine
-from tqdm import tqdm
+from ifcb_csv import write_csv
+from ifcb_flags import flag_str_to_int, parse_flags  # flag_str_to_int imported by scripts
+# matlab.engine, PIL, tqdm, and makeIFCBTable are imported on first use to keep startup fast (see get_matlab)
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
 
 
 __version__ = '0.3.4'
@@ -38,6 +50,9 @@ ADC_COLUMN_SEL = ['SSCIntegrated', 'FLIntegrated', 'SSCPeak', 'FLPeak', 'TimeOfF
                   'ImageX', 'ImageY', 'ImageWidth', 'ImageHeight', 'NumberImagesInTrigger']
 HDR_COLUMN_NAMES = ['VolumeSampled', 'VolumeSampleRequested',
                     'TriggerSelection', 'SSCGain', 'FLGain', 'SSCThreshold', 'FLThreshold']
+HDR_REQUIRED_KEYS = ['runTime', 'inhibitTime', 'SyringeSampleVolume', 'PMTtriggerSelection_DAQ_MCConly',
+                     'PMTAhighVoltage', 'PMTBhighVoltage',
+                     'PMTAtriggerThreshold_DAQ_MCConly', 'PMTBtriggerThreshold_DAQ_MCConly']  # see extract_header
 FTR_V2_COLUMN_NAMES = ['ImageId', 'Area', 'NumberBlobsInImage',
                        'EquivalentDiameter', 'FeretDiameter', 'MinorAxisLength', 'MajorAxisLength', 'Perimeter',
                        'Biovolume',
@@ -95,6 +110,8 @@ PATH_TO_DIPUM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DIPUM'
 PATH_TO_MATLAB_FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'matlab_helpers')
 
 IFCB_FLOW_RATE = 0.25
+RAW_EXTENSIONS = ('.adc', '.hdr', '.roi')
+TAXON_INDEX_FILENAME = 'taxon_index.npz'  # Inverted index of classification in output of run_science
 
 
 class IFCBTools(Exception):
@@ -105,6 +122,65 @@ class CorruptedBin(IFCBTools):
     pass
 
 
+@lru_cache(maxsize=None)
+def get_matlab():
+    """ Import matlab.engine on first use, takes seconds and is only available on hosts with MATLAB """
+    try:
+        import matlab.engine
+    except ImportError:
+        raise IFCBTools('MATLAB Engine API for Python is required to extract features (matlab.engine not found).')
+    return matlab
+
+
+def start_matlab_engine():
+    return get_matlab().engine.start_matlab()
+
+
+def progress(iterable=None, **kwargs):
+    """ Progress bar, tqdm is imported on first use """
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
+
+
+def reset_peak_rss():
+    """ Reset peak resident set size of process (Linux only), return True if successful """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """ Peak resident set size of process in bytes (since last reset_peak_rss on Linux) """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # Peak since process started (kB on Linux, bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def write_csv_with_constants(data, constants, filename, chunk_size=10000, **kwargs):
+    """
+    Write data with constant columns appended (e.g. environmental data of a bin) to csv.
+    The constant columns are broadcast one chunk of rows at a time instead of being materialized for all rows.
+    """
+    index = kwargs.pop('index', True)
+    with open(filename, 'wb') as f:
+        for i in range(0, max(len(data.index), 1), chunk_size):
+            chunk = data.iloc[i:i + chunk_size]
+            # Object dtype to write constants as is (float_format is not applied)
+            chunk = chunk.assign(**{k: np.full(len(chunk.index), v, dtype=object) for k, v in constants.items()})
+            write_csv(chunk, f, header=i == 0, index=index, **kwargs)
+
+
 def upper_to_under(var):
     """
     Insert underscore before upper case letter followed by lower case letter and lower case all sentence.
@@ -112,75 +188,464 @@ def upper_to_under(var):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', re.sub('(.)([A-Z][a-z]+)', r'\1_\2', var)).lower()
 
 
-def flag_str_to_int(flag_str):
-    if pd.isna(flag_str):
-        return 1
-    flag_str = flag_str.strip()
-    if flag_str == '':  # Good
-        return 1
-    flag_int = 0
-    for f in flag_str.split(';'):
-        f = f.strip()
-        if f in ('questionable alignment', 'questionable_alignment', 'questionablealignment', 'questionable allignement'):
-            if not (flag_int & 2 ** 11):
-                flag_int += 2 ** 11
-        elif f == 'corrupted':
-            if not (flag_int & 2**10):
-                flag_int += 2 ** 10
-        elif f in ('timeoffset', 'time_offset'):
-            if not (flag_int & 2**9):
-                flag_int = 2 ** 9
-        elif f in ('bad focus', 'bad_focus', 'badfocus', 'bfocus'):
-            if not (flag_int & 2**8):
-                flag_int = 2 ** 8
-        elif f in ('bad alignment', 'bad_alignment', 'badalignment', 'balignment'):
-            if not (flag_int & 2**7):
-                flag_int = 2 ** 7
-        elif f in ('cvolume', 'customvolume', 'custom_volume', 'custom volume'):
-            if not (flag_int & 2**6):
-                flag_int = 2 ** 6
-        elif f == 'flush':
-            if not (flag_int & 2**5):
-                flag_int = 2 ** 5
-        elif f in ('ctrigger', 'customtrigger', 'custom_trigger', 'custom trigger', 'scatter trigger'):
-            if not (flag_int & 2**4):
-                flag_int = 2 ** 4
-        elif f in ('questionnable', 'questionable'):
-            if not (flag_int & 2**3):
-                flag_int = 2 ** 3
-        elif f in ('bad', 'ignore', 'delete', 'failed', 'bubble', 'bubbles', 'empty'):
-            if not (flag_int & 2**2):
-                flag_int = 2 ** 2
-        elif f in ('incomplete', 'aborted', 'contaminated', 'soap contamination'):
-            if not (flag_int & 2**1):
-                flag_int = 2 ** 1
+def is_bin_complete(path_to_bin, bin_name):
+    """
+    Check that the adc, hdr, and roi files of a bin are present
+    and that the roi file is as long as the last end byte listed in the adc file
+    """
+    for ext in RAW_EXTENSIONS:
+        if not os.path.isfile(os.path.join(path_to_bin, bin_name + ext)):
+            return False
+    with open(os.path.join(path_to_bin, bin_name + '.adc'), 'rb') as f:
+        lines = f.read().splitlines()
+    if lines and lines[-1].count(b',') < len(ADC_COLUMN_NAMES) - 1:
+        return False  # Last line of adc file is still being written
+    end_byte = 0
+    for line in reversed(lines):
+        try:
+            fields = line.split(b',')
+            end_byte = int(fields[17]) + int(fields[15]) * int(fields[16])  # StartByte + ImageWidth * ImageHeight
+        except (IndexError, ValueError):
+            return False
+        if end_byte != 0:
+            break
+    return os.path.getsize(os.path.join(path_to_bin, bin_name + '.roi')) == end_byte
+
+
+def read_ecotaxa_classification(filepath_or_buffer, chunksize=None):
+    """
+    Read an EcoTaxa tsv export (or a classification table previously saved in feather format)
+    into a compact classification table with columns AnnotationStatus, Hierarchy, bin (categorical) and ImageId
+    If chunksize is set, return an iterator of tables of chunksize rows (feather tables are read at once)
+    """
+    if isinstance(filepath_or_buffer, str) and filepath_or_buffer.endswith('.feather'):
+        data = pd.read_feather(filepath_or_buffer)
+        return data if chunksize is None else iter([data])
+    reader = pd.read_csv(filepath_or_buffer, header=0, sep='\t', engine='c', chunksize=chunksize,
+                         usecols=['object_id', 'object_annotation_status', 'object_annotation_hierarchy'],
+                         dtype={'object_id': str, 'object_annotation_status': 'category',
+                                'object_annotation_hierarchy': 'category'})
+    return _format_ecotaxa_classification(reader) if chunksize is None else \
+        (_format_ecotaxa_classification(data) for data in reader)
+
+
+def _format_ecotaxa_classification(data):
+    data.rename(columns={'object_id': 'id', 'object_annotation_status': 'AnnotationStatus',
+                         'object_annotation_hierarchy': 'Hierarchy'}, inplace=True)
+    # Remove Incorrect ids
+    sel = data['id'].str.len() != 30
+    if np.any(sel):
+        print(f"Invalid id(s) in EcoTaxa file, dropping: {data['id'][sel].to_list()}")
+        data = data[~sel].reset_index(drop=True)
+    # Split EcoTaxa Id
+    data['bin'] = data['id'].str[0:24].astype('category')
+    data['ImageId'] = data['id'].str[25:].astype('uint32')
+    return data.drop(columns='id')
+
+
+def list_ecotaxa_files(path_to_ecotaxa_tsv):
+    """ EcoTaxa tsv files and classification tables (feather) of directory and its subdirectories """
+    return glob.glob(os.path.join(path_to_ecotaxa_tsv, '**', '*.tsv'), recursive=True) + \
+        glob.glob(os.path.join(path_to_ecotaxa_tsv, '**', '*.feather'), recursive=True)
+
+
+def read_taxonomic_grouping(path_to_taxonomic_grouping_csv):
+    """ Mappings of EcoTaxa hierarchy to taxon and to group """
+    taxonomic_grouping = pd.read_csv(path_to_taxonomic_grouping_csv, header=0, engine='c')
+    taxon = pd.Series(taxonomic_grouping.taxon.values, index=taxonomic_grouping.hierarchy).to_dict()
+    group = pd.Series(taxonomic_grouping.group.values, index=taxonomic_grouping.hierarchy).to_dict()
+    return taxon, group
+
+
+def remap_categories(categorical, mapping):
+    """ Rename categories with mapping (categories missing from mapping are kept), new categories can be non-unique """
+    codes, categories = pd.factorize(categorical.cat.categories.map(lambda x: mapping.get(x, x)))
+    codes = np.where(categorical.cat.codes >= 0, codes[categorical.cat.codes], -1)
+    return pd.Categorical.from_codes(codes, categories)
+
+
+def parse_adc(filepath_or_buffer, first_image_id=1):
+    """ Read adc file (or part of it) and compute the end byte of each ROI """
+    adc = pd.read_csv(filepath_or_buffer, names=ADC_COLUMN_NAMES, engine='c', na_values='-999.00000')
+    adc.index = adc.index + first_image_id  # increment index to match feature id
+    adc['EndByte'] = adc['StartByte'] + adc['ImageWidth'] * adc['ImageHeight']
+    return adc
+
+
+def parse_hdr(file):
+    """ Read hdr file (text file object) into a dictionary of raw values by key """
+    hdr = dict()
+    for line in file:
+        name, var = line.partition(":")[::2]
+        hdr[name.strip()] = var
+    return hdr
+
+
+def resize_and_pad(images, shape=(128, 128), interpolation='bilinear', pad_value=0, upscale=True):
+    """
+    Resize a stack of images of the same size (n, h, w) to fit in shape preserving their aspect ratio, then pad them
+    (centered) with pad_value. Nearest and bilinear interpolations are vectorized over the stack, other
+    interpolations (bicubic, lanczos, box, hamming) use PIL on each image.
+
+    :return: array of images (n, H, W) uint8 and scale factor applied
+    """
+    n, h, w = images.shape
+    scale = min(shape[0] / h, shape[1] / w)
+    if not upscale:
+        scale = min(scale, 1)
+    oh, ow = max(1, min(shape[0], round(h * scale))), max(1, min(shape[1], round(w * scale)))
+    if (oh, ow) == (h, w):
+        resized = images
+    elif interpolation == 'nearest':
+        y = np.minimum(((np.arange(oh) + 0.5) * h / oh).astype(int), h - 1)
+        x = np.minimum(((np.arange(ow) + 0.5) * w / ow).astype(int), w - 1)
+        resized = images[:, y[:, None], x[None, :]]
+    elif interpolation == 'bilinear':
+        y = np.clip((np.arange(oh) + 0.5) * h / oh - 0.5, 0, h - 1)
+        x = np.clip((np.arange(ow) + 0.5) * w / ow - 0.5, 0, w - 1)
+        y0, x0 = y.astype(int), x.astype(int)
+        y1, x1 = np.minimum(y0 + 1, h - 1), np.minimum(x0 + 1, w - 1)
+        wy, wx = (y - y0)[:, None].astype('float32'), (x - x0)[None, :].astype('float32')
+        top, bottom = images[:, y0].astype('float32'), images[:, y1].astype('float32')
+        top = top[:, :, x0] * (1 - wx) + top[:, :, x1] * wx
+        bottom = bottom[:, :, x0] * (1 - wx) + bottom[:, :, x1] * wx
+        resized = np.rint(top * (1 - wy) + bottom * wy).astype('uint8')
+    else:
+        from PIL import Image
+        resample = getattr(Image.Resampling, interpolation.upper())
+        resized = np.stack([np.asarray(Image.fromarray(img).resize((ow, oh), resample)) for img in images])
+    padded = np.full((n, shape[0], shape[1]), pad_value, dtype='uint8')
+    top, left = (shape[0] - oh) // 2, (shape[1] - ow) // 2
+    padded[:, top:top + oh, left:left + ow] = resized
+    return padded, oh / h
+
+
+class BinWatcher:
+    """
+    Watch a directory of raw IFCB data and yield each bin (name and time closed) once it is complete.
+    A bin is complete when is_bin_complete is true and none of its files was modified for settle_time seconds.
+    Uses inotify (requires inotify_simple) when available and fall back to polling the directory otherwise.
+    """
+
+    def __init__(self, path_to_bin, settle_time=5, poll_interval=2, skip_existing=True):
+        self.path_to_bin = path_to_bin
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self._seen, self._pending = set(), set()
+        self._inotify = None
+        try:
+            from inotify_simple import INotify, flags
+            self._inotify = INotify()
+            self._inotify.add_watch(path_to_bin, flags.CLOSE_WRITE | flags.MODIFY | flags.MOVED_TO)
+        except (ImportError, OSError):
+            self._inotify = None
+        # Bins already complete when starting are skipped, bins in progress are watched
+        self._pending = self._list_bins()
+        if skip_existing:
+            for bin_name in list(self._pending):
+                if is_bin_complete(self.path_to_bin, bin_name):
+                    self._pending.discard(bin_name)
+                    self._seen.add(bin_name)
+
+    def _list_bins(self):
+        return {os.path.splitext(f)[0] for f in os.listdir(self.path_to_bin)
+                if os.path.splitext(f)[1] in RAW_EXTENSIONS} - self._seen
+
+    def _wait_for_changes(self):
+        if self._inotify is not None:
+            for event in self._inotify.read(timeout=self.poll_interval * 1000):
+                name, ext = os.path.splitext(event.name)
+                if ext in RAW_EXTENSIONS and name not in self._seen:
+                    self._pending.add(name)
         else:
-            raise ValueError(f'Unknown flag: {flag_str}')
-    return flag_int
+            sleep(self.poll_interval)
+            self._pending |= self._list_bins()
+
+    def __iter__(self):
+        while True:
+            for bin_name in sorted(self._pending):
+                try:
+                    closed_at = max(os.path.getmtime(os.path.join(self.path_to_bin, bin_name + ext))
+                                    for ext in RAW_EXTENSIONS)
+                except FileNotFoundError:
+                    continue  # Bin is still being created (or was moved away)
+                if time() - closed_at < self.settle_time or not is_bin_complete(self.path_to_bin, bin_name):
+                    continue
+                self._pending.discard(bin_name)
+                self._seen.add(bin_name)
+                yield bin_name, closed_at
+            self._wait_for_changes()
+
+
+class BinTailReader:
+    """
+    Incrementally read a bin while the IFCB is still writing it.
+    Each call to read returns the cytometry and images of the ROIs appended since the previous call
+    and whose bytes are already on disk. Rows of the last trigger are held back until the trigger is complete.
+    The position in the bin is saved to path_to_checkpoint (optional) to resume reading after a restart.
+    """
+
+    def __init__(self, path_to_bin, bin_name, path_to_checkpoint=None):
+        self.path_to_bin = path_to_bin
+        self.bin_name = bin_name
+        self.path_to_checkpoint = path_to_checkpoint
+        self.adc_offset, self.next_image_id = 0, 1
+        if path_to_checkpoint is not None and os.path.isfile(path_to_checkpoint):
+            with open(path_to_checkpoint) as f:
+                checkpoint = json.load(f)
+            if checkpoint['bin'] != bin_name:
+                raise ValueError(f'Checkpoint {path_to_checkpoint} is for bin {checkpoint["bin"]}.')
+            self.adc_offset, self.next_image_id = checkpoint['adc_offset'], checkpoint['next_image_id']
+
+    def save_checkpoint(self):
+        if self.path_to_checkpoint is None:
+            return
+        with open(self.path_to_checkpoint + '.tmp', 'w') as f:
+            json.dump({'bin': self.bin_name, 'adc_offset': self.adc_offset, 'next_image_id': self.next_image_id}, f)
+        os.replace(self.path_to_checkpoint + '.tmp', self.path_to_checkpoint)
+
+    def read(self, write_images_to=None, finalize=False):
+        """
+        Read ROIs appended to the bin since last call
+
+        :param write_images_to: write png of images read in <write_images_to>/<bin_name>
+        :param finalize: set to True once the bin is closed to emit the rows of the last trigger
+        :return: cytometry (same format as extract_images_and_cytometry) and a dictionary of images by ImageId
+        """
+        with open(os.path.join(self.path_to_bin, self.bin_name + '.adc'), 'rb') as f:
+            f.seek(self.adc_offset)
+            chunk = f.read()
+        chunk = chunk[:chunk.rfind(b'\n') + 1]  # Ignore line being written
+        images = dict()
+        if not chunk:
+            return pd.DataFrame(columns=ADC_COLUMN_SEL), images
+        line_ends = np.cumsum([len(line) + 1 for line in chunk[:-1].split(b'\n')])
+        adc = parse_adc(io.BytesIO(chunk), first_image_id=self.next_image_id)
+        # Keep rows with ROI on disk and hold back last trigger (might be incomplete)
+        roi_size = os.path.getsize(os.path.join(self.path_to_bin, self.bin_name + '.roi'))
+        n = np.argmin(adc['EndByte'].to_numpy() <= roi_size) if np.any(adc['EndByte'] > roi_size) else len(adc)
+        if not finalize:
+            trigger_id = adc['TriggerId'].to_numpy()
+            if n < len(adc):
+                # Roi file ends within trigger of row n, hold back the entire trigger
+                n = np.argmax(trigger_id == trigger_id[n])
+            n = min(n, np.argmax(trigger_id == trigger_id[-1]))
+        if n == 0:
+            return pd.DataFrame(columns=ADC_COLUMN_SEL), images
+        adc = adc.iloc[:n].copy()
+        adc['NumberImagesInTrigger'] = adc.groupby('TriggerId')['TriggerId'].transform('size')
+        adc = adc[adc['StartByte'] != adc['EndByte']]
+        if not adc.empty:
+            # Read only the bytes of the new ROIs
+            start = adc['StartByte'].min()
+            with open(os.path.join(self.path_to_bin, self.bin_name + '.roi'), 'rb') as f:
+                f.seek(start)
+                roi = np.frombuffer(f.read(adc['EndByte'].max() - start), 'uint8')
+            if write_images_to is not None:
+                from PIL import Image
+                path_to_png = os.path.join(write_images_to, self.bin_name)
+                if not os.path.isdir(path_to_png):
+                    os.makedirs(path_to_png)
+            for d in adc.itertuples():
+                images[d.Index] = roi[d.StartByte - start:d.EndByte - start].reshape(d.ImageHeight, d.ImageWidth)
+                if write_images_to is not None:
+                    Image.fromarray(images[d.Index]).save(
+                        os.path.join(path_to_png, f'{self.bin_name}_{d.Index:05d}.png'), 'PNG')
+        # Move checkpoint after rows emitted
+        self.adc_offset += int(line_ends[n - 1])
+        self.next_image_id += int(n)
+        self.save_checkpoint()
+        adc = adc[ADC_COLUMN_SEL].astype({'NumberImagesInTrigger': 'uint8'})
+        adc.index = adc.index.astype('uint32')
+        return adc, images
+
+    def micro_batches(self, write_images_to=None, poll_interval=1, settle_time=5):
+        """
+        Yield cytometry and images of new ROIs as they are written by the IFCB
+        until the bin is complete (see BinWatcher) at which point the remaining rows are emitted
+        """
+        while True:
+            closed = False
+            if is_bin_complete(self.path_to_bin, self.bin_name):
+                last_modified = max(os.path.getmtime(os.path.join(self.path_to_bin, self.bin_name + ext))
+                                    for ext in RAW_EXTENSIONS)
+                closed = time() - last_modified >= settle_time
+            cytometry, images = self.read(write_images_to, finalize=closed)
+            if not cytometry.empty:
+                yield cytometry, images
+            if closed:
+                return
+            sleep(poll_interval)
+
+
+class ShardWriter:
+    """
+    Write samples to tar shards of about max_size bytes readable by WebDataset (<key>.<ext> members)
+    Samples are assigned at random to one of n_open shards to shuffle them across shards.
+    An index (index.csv) records the shard and byte offset of each sample along with its labels.
+    """
+
+    def __init__(self, path, max_size=2**28, n_open=8, seed=None, prefix='shard'):
+        self.path, self.max_size, self.prefix = path, max_size, prefix
+        self.rng = np.random.default_rng(seed)
+        self.n_shards = 0
+        self.shards = [None] * n_open  # Opened on first sample
+        self.index_file = open(os.path.join(path, 'index.csv'), 'w', newline='')
+        self.index = csv.writer(self.index_file)
+        self.index_columns = None
+
+    def _open(self):
+        name = f'{self.prefix}-{self.n_shards:06d}.tar'
+        self.n_shards += 1
+        return name, tarfile.open(os.path.join(self.path, name), 'w', format=tarfile.USTAR_FORMAT)
+
+    def write(self, key, members, labels=None):
+        """
+        Write sample to a random shard
+        :param key: unique name of sample (no dot)
+        :param members: dictionary of extension (e.g. png, json) and bytes
+        :param labels: dictionary of fields to record in index, same fields for all samples (set by first sample)
+        """
+        labels = {} if labels is None else labels
+        if self.index_columns is None:
+            self.index_columns = list(labels.keys())
+            self.index.writerow(['key', 'shard', 'offset', 'size'] + self.index_columns)
+        elif set(labels.keys()) != set(self.index_columns):
+            # Checked before writing sample to keep shards and index consistent
+            raise ValueError(f'Labels of {key} {sorted(labels.keys())} differ from columns of index '
+                             f'{sorted(self.index_columns)}.')
+        i = self.rng.integers(len(self.shards))
+        if self.shards[i] is None:
+            self.shards[i] = self._open()
+        name, tar = self.shards[i]
+        offset = tar.offset
+        for ext, data in members.items():
+            info = tarfile.TarInfo(f'{key}.{ext}')
+            info.size, info.mtime, info.mode = len(data), 0, 0o444
+            tar.addfile(info, io.BytesIO(data))
+        self.index.writerow([key, name, offset, tar.offset - offset] + [labels[k] for k in self.index_columns])
+        if tar.offset >= self.max_size:
+            tar.close()
+            self.shards[i] = None
+
+    def close(self):
+        for shard in self.shards:
+            if shard is not None:
+                shard[1].close()
+        self.shards = [None] * len(self.shards)
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Profiler:
+    """
+    Time each stage of the processing of a bin and count images and bytes read.
+    One event per bin is appended to a JSONL log and a summary table is printed at the end of a run.
+    Timers are always running (negligible overhead) but nothing is written if path_to_log is None.
+    The peak resident set size (RSS) of each bin is tracked on Linux, other systems report the peak of the process.
+    """
+    STAGES = ('adc_parse', 'roi_read', 'png_encode', 'resize', 'hash', 'feature_extraction', 'classification_join',
+              'output_write')
+
+    def __init__(self, path_to_log=None):
+        self.path_to_log = path_to_log
+        self.events = []
+        self.timers, self.counters, self.status = dict(), dict(), 'ok'
+
+    @contextmanager
+    def timer(self, stage):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] = self.timers.get(stage, 0) + perf_counter() - t0
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    @contextmanager
+    def bin(self, bin_name):
+        """ Record timers and counters of stages run in context as one event """
+        self.timers, self.counters, self.status = dict(), dict(), 'ok'
+        reset_peak_rss()
+        start, t0 = datetime.now(timezone.utc), perf_counter()
+        try:
+            yield self
+        except Exception as e:
+            self.status = type(e).__name__
+            raise
+        finally:
+            elapsed = perf_counter() - t0
+            event = dict(bin=bin_name, start=f'{start:%Y/%m/%d %H:%M:%S}', status=self.status, elapsed=elapsed,
+                         **{s: self.timers.get(s, 0) for s in self.STAGES},
+                         images=self.counters.get('images', 0), bytes=self.counters.get('bytes', 0),
+                         peak_rss=get_peak_rss())
+            event['other'] = elapsed - sum(self.timers.values())
+            event['images_per_second'] = event['images'] / elapsed if elapsed else 0
+            event['bytes_per_second'] = event['bytes'] / elapsed if elapsed else 0
+            self.events.append(event)
+            if self.path_to_log is not None:
+                with open(self.path_to_log, 'a') as f:
+                    f.write(json.dumps(event) + '\n')
+
+    def summary(self, events=None):
+        """ Time spent in each stage for bins processed (skipped bins are ignored) """
+        events = pd.DataFrame(self.events) if events is None else events
+        events = events[events['status'] != 'skipped'] if not events.empty else events
+        if events.empty:
+            return pd.DataFrame(columns=['seconds', 'seconds_per_bin', 'percent'])
+        stages = events.reindex(columns=list(self.STAGES) + ['other'], fill_value=0).sum()  # Logs of older versions
+        summary = pd.DataFrame({'seconds': stages, 'seconds_per_bin': stages / len(events),
+                                'percent': 100 * stages / events['elapsed'].sum()})
+        summary.loc['total'] = [events['elapsed'].sum(), events['elapsed'].mean(), 100]
+        return summary
+
+    def report(self):
+        """ Print summary table, throughput, and save summary next to log, then start a new run """
+        events, self.events = pd.DataFrame(self.events), []
+        if self.path_to_log is None or events.empty:
+            return
+        summary = self.summary(events)
+        if summary.empty:
+            return
+        elapsed = summary.loc['total', 'seconds']
+        print(summary.to_string(float_format='%.3f'))
+        peak_rss = pd.to_numeric(events['peak_rss']).max()
+        print(f"{len(events)} bins ({(events['status'] != 'ok').sum()} not processed), "
+              f"{events['images'].sum() / elapsed:.1f} images/s, {events['bytes'].sum() / elapsed / 2**20:.1f} MB/s, "
+              f"peak RSS {peak_rss / 2**20:.0f} MB")
+        summary.to_csv(os.path.splitext(self.path_to_log)[0] + '_summary.csv', index_label='stage',
+                       float_format='%.4f')
 
 
 class BinExtractor:
 
     def __init__(self, path_to_bin, path_to_environmental_csv=None,
                  path_to_ecotaxa_tsv=None, path_to_taxonomic_grouping_csv=None,
-                 matlab_engine=None, matlab_parallel_flag=False):
-        self.path_to_bin = path_to_bin
+                 matlab_engine=None, matlab_parallel_flag=False, path_to_profile_log=None, memory_budget=None,
+                 feature_daemon=None, path_to_hashes=None):
+        self.path_to_bin = path_to_bin  # directory or zip/tar archive of raw files (see ifcb_raw.py)
+        self._raw = None
+        self.profiler = Profiler(path_to_profile_log)
+        self.memory_budget = memory_budget  # bytes of roi file loaded at once (None: entire file)
+        self.path_to_hashes = path_to_hashes  # directory of dHash of ROIs of each bin (see ifcb_duplicates.py)
         self.matlab_engine = matlab_engine
         self.matlab_parallel_flag = matlab_parallel_flag
+        if isinstance(feature_daemon, str):
+            from ifcb_daemon import FeatureClient
+            feature_daemon = FeatureClient(feature_daemon)
+        self.feature_daemon = feature_daemon  # extract features with warm engines of ifcb_daemon.py
+        self.path_to_environmental_csv = path_to_environmental_csv
+        self.environmental_data = None
         if path_to_environmental_csv:
-            #   the environmental file must be in csv format and the first line must be the column names
-            #   one of the column must be named "bin" and contain the bin id: D<yyyymmdd>T<HHMMSS>_IFCB<SN#>
-            self.environmental_data = pd.read_csv(path_to_environmental_csv, header=0, engine='c',
-                                                  parse_dates=['DateTime'])
-            if 'bin' not in self.environmental_data:
-                raise ValueError('Missing column bin in environmental data file.')
-            if self.environmental_data.Flag.dtypes != int:
-                # Convert flags to string
-                self.environmental_data.Flag = self.environmental_data.Flag.apply(lambda r: flag_str_to_int(r))\
-                    .astype(int)
-        else:
-            self.environmental_data = None
+            self.init_environmental_data(path_to_environmental_csv)
         self.classification_data = None
+        self._taxon_index = None
         if path_to_ecotaxa_tsv and path_to_taxonomic_grouping_csv:
             self.init_ecotaxa_classification(path_to_ecotaxa_tsv, path_to_taxonomic_grouping_csv)
 
@@ -188,8 +653,37 @@ class BinExtractor:
         if self.matlab_engine is not None:
             self.matlab_engine.quit()
 
+    @property
+    def raw(self):
+        """ Raw source of path_to_bin (reopened if path_to_bin changed) """
+        if self._raw is None or self._raw.path != self.path_to_bin:
+            from ifcb_raw import open_raw
+            if self._raw is not None:
+                self._raw.close()
+            self._raw = open_raw(self.path_to_bin)
+        return self._raw
+
+    def init_environmental_data(self, path_to_environmental_csv):
+        """ Load environmental data of each bin """
+        #   the environmental file must be in csv format and the first line must be the column names
+        #   one of the column must be named "bin" and contain the bin id: D<yyyymmdd>T<HHMMSS>_IFCB<SN#>
+        self.environmental_data = pd.read_csv(path_to_environmental_csv, header=0, engine='c',
+                                              parse_dates=['DateTime'])
+        if 'bin' not in self.environmental_data:
+            raise ValueError('Missing column bin in environmental data file.')
+        # Convert flags to bitmask
+        self.environmental_data['Flag'] = parse_flags(self.environmental_data['Flag'])
+        self.path_to_environmental_csv = path_to_environmental_csv
+
     def extract_images_and_cytometry(self, bin_name, write_images_to=None,
-                                     with_scale_bar=False, scale_bar_resolution=3.4, scale_bar_outside=False):
+                                     with_scale_bar=False, scale_bar_resolution=3.4, scale_bar_outside=False,
+                                     hashes=None):
+        """ Read cytometry of bin and write its images if write_images_to is set
+        the dHash of each image written is set in hashes (dictionary) and saved in path_to_hashes if set """
+        from PIL import Image, ImageDraw, ImageFont
+        from ifcb_duplicates import dhash
+        hash_images = write_images_to is not None and (hashes is not None or self.path_to_hashes is not None)
+        decoded, image_hashes = dict(), dict()  # Images of chunk to hash, hash of each image
         if with_scale_bar:
             # Prepare Scale Bar
             sb_height = round(1.2 * scale_bar_resolution)  # pixel (3-4 pixels depending on resolution)
@@ -199,73 +693,153 @@ class BinExtractor:
                 sb_font = ImageFont.truetype("Times New Roman", 10)  # font is required to anchor text
             except OSError:
                 # In case font is not available with OS, import font manually (ttf file must be placed in package)
-                sb_font = ImageFont.truetype("Times New Roman.ttf", 10)  # font is required to anchor text
-                # sb_font = ImageFont.load_default()  # Ultimate work-arround but doesn't support \mu
+                try:
+                    sb_font = ImageFont.truetype("Times New Roman.ttf", 10)  # font is required to anchor text
+                except OSError:
+                    sb_font = ImageFont.load_default(10)  # Ultimate work-arround (Pillow >= 10.1)
             outside_height = 10 + 4 + 2*2  # pixels font size + scale bar height + 2px padding (no padding above txt)
 
         # Parse ADC File
-        adc = pd.read_csv(os.path.join(self.path_to_bin, bin_name + '.adc'), names=ADC_COLUMN_NAMES, engine='c',
-                          na_values='-999.00000')
-        adc.index = adc.index + 1  # increment index to match feature id
-        adc['EndByte'] = adc['StartByte'] + adc['ImageWidth'] * adc['ImageHeight']
-        # Get Number of ROI within one trigger
-        adc['NumberImagesInTrigger'] = [sum(adc['TriggerId'] == x) for x in adc['TriggerId']]
+        with self.profiler.timer('adc_parse'):
+            with self.raw.open(bin_name, '.adc') as f:
+                adc = parse_adc(f)
+            # Get Number of ROI within one trigger
+            adc['NumberImagesInTrigger'] = [sum(adc['TriggerId'] == x) for x in adc['TriggerId']]
+        self.profiler.count('bytes', self.raw.size(bin_name, '.adc'))
         rows_to_remove = list()
         if write_images_to is not None and not adc.empty:
             # Set path
             if not os.path.exists(write_images_to):
                 os.makedirs(write_images_to)
             path_to_png = os.path.join(write_images_to, bin_name)
-            # Open ROI File
-            roi = np.fromfile(os.path.join(self.path_to_bin, bin_name + '.roi'), 'uint8')
+            # Check ROI File
+            roi_size = self.raw.size(bin_name, '.roi')
             try:
                 last_non_empty_index = -1
                 while adc['EndByte'].iloc[last_non_empty_index] == 0:
                     last_non_empty_index -= 1
             except IndexError:
                 raise CorruptedBin(f'CorruptedBin:{bin_name}: adc end byte is all zeros.')
-            if len(roi) != adc['EndByte'].iloc[last_non_empty_index]:
+            if roi_size != adc['EndByte'].iloc[last_non_empty_index]:
                 raise CorruptedBin(f'CorruptedBin:{bin_name}: adc end byte is greater than roi size.')
             if not os.path.isdir(path_to_png):
                 os.mkdir(path_to_png)
-            for d in adc.itertuples():
-                if d.StartByte != d.EndByte:
-                    # Save Image
-                    img = roi[d.StartByte:d.EndByte].reshape(d.ImageHeight, d.ImageWidth)
-                    # Save with ImageIO (slower)
-                    # imageio.imwrite(os.path.join(path_to_png, f'{bin_name}_{d.Index:05d}.png', img)
-                    if with_scale_bar and scale_bar_outside:
-                        img = np.append(img, np.zeros((outside_height, d.ImageWidth), dtype='uint8') - 1, axis=0)
-                    # Save with PILLOW
-                    img = Image.fromarray(img)
-                    if with_scale_bar:
-                        draw = ImageDraw.Draw(img)
-                        draw.line((2, img.size[1] - sb_offset, 2 + sb_width, img.size[1] - sb_offset), fill=0,
-                                  width=sb_height)
-                        draw.text((2 + sb_width / 2, img.size[1] - sb_offset), '10 µm', fill=0, anchor='md',
-                                  font=sb_font)
-                    img.save(os.path.join(path_to_png, f'{bin_name}_{d.Index:05d}.png'), 'PNG')
-                    # deprecated image name:  f'{bin_name_parts[1]}{bin_name_parts[0]}P{d.Index:05d}.png'; bin_name_parts = bin_name.split('_')
-                else:
-                    # Remove line from adc
-                    adc.drop(index=d.Index, inplace=True)
+            # Read ROI File at once or in chunks of ~memory_budget bytes for oversized bins
+            if self.memory_budget is None or roi_size <= self.memory_budget:
+                chunks = [adc]
+            else:
+                chunks = [chunk for _, chunk in adc.groupby(adc['StartByte'] // self.memory_budget)]
+            for chunk in chunks:
+                with self.profiler.timer('roi_read'):
+                    offset = chunk['StartByte'].min()
+                    roi = np.frombuffer(self.raw.read(bin_name, '.roi', offset, chunk['EndByte'].max() - offset),
+                                        'uint8')
+                self.profiler.count('bytes', len(roi))
+                with self.profiler.timer('png_encode'):
+                    for d in chunk.itertuples():
+                        if d.StartByte != d.EndByte:
+                            # Save Image
+                            img = roi[d.StartByte - offset:d.EndByte - offset].reshape(d.ImageHeight,
+                                                                                       d.ImageWidth)
+                            if hash_images:
+                                decoded[d.Index] = img
+                            # Save with ImageIO (slower)
+                            # imageio.imwrite(os.path.join(path_to_png, f'{bin_name}_{d.Index:05d}.png', img)
+                            if with_scale_bar and scale_bar_outside:
+                                img = np.append(img, np.zeros((outside_height, d.ImageWidth), dtype='uint8') - 1,
+                                                axis=0)
+                            # Save with PILLOW
+                            img = Image.fromarray(img)
+                            if with_scale_bar:
+                                draw = ImageDraw.Draw(img)
+                                draw.line((2, img.size[1] - sb_offset, 2 + sb_width, img.size[1] - sb_offset),
+                                          fill=0, width=sb_height)
+                                draw.text((2 + sb_width / 2, img.size[1] - sb_offset), '10 µm', fill=0,
+                                          anchor='md', font=sb_font)
+                            img.save(os.path.join(path_to_png, f'{bin_name}_{d.Index:05d}.png'), 'PNG')
+                            # deprecated image name:  f'{bin_name_parts[1]}{bin_name_parts[0]}P{d.Index:05d}.png'; bin_name_parts = bin_name.split('_')
+                        else:
+                            # Remove line from adc
+                            adc.drop(index=d.Index, inplace=True)
+                if hash_images:
+                    with self.profiler.timer('hash'):
+                        image_hashes.update(zip(decoded.keys(), dhash(decoded.values())))
+                    decoded.clear()
+            if hash_images:
+                self._save_hashes(bin_name, image_hashes)
+                if hashes is not None:
+                    hashes.update(image_hashes)
         else:
             for d in adc.itertuples():
                 if d.StartByte == d.EndByte:
                     # Remove line from adc
                     adc.drop(index=d.Index, inplace=True)
+        self.profiler.count('images', len(adc))
         # Keep only columns of interest
         adc = adc[ADC_COLUMN_SEL].astype({'NumberImagesInTrigger': 'uint8'})
         adc.index = adc.index.astype('uint32')
         return adc
 
+    def read_images(self, bin_name, image_ids=None):
+        """ Yield id and image (2D uint8 array) of each ROI of bin (or only of image_ids)
+            the roi file is read in chunks of memory_budget bytes if set """
+        with self.raw.open(bin_name, '.adc') as f:
+            adc = parse_adc(f)
+        adc = adc[adc['StartByte'] != adc['EndByte']]
+        if image_ids is not None:
+            adc = adc[adc.index.isin(image_ids)]
+        if adc.empty:
+            return
+        if self.raw.size(bin_name, '.roi') < adc['EndByte'].max():
+            raise CorruptedBin(f'CorruptedBin:{bin_name}: adc end byte is greater than roi size.')
+        if self.memory_budget is None:
+            chunks = [adc]
+        else:
+            chunks = [chunk for _, chunk in adc.groupby(adc['StartByte'] // self.memory_budget)]
+        for chunk in chunks:
+            with self.profiler.timer('roi_read'):
+                offset = chunk['StartByte'].min()
+                roi = np.frombuffer(self.raw.read(bin_name, '.roi', offset, chunk['EndByte'].max() - offset),
+                                    'uint8')
+            self.profiler.count('bytes', len(roi))
+            for d in chunk.itertuples():
+                yield d.Index, roi[d.StartByte - offset:d.EndByte - offset].reshape(d.ImageHeight, d.ImageWidth)
+
+    def _save_hashes(self, bin_name, hashes):
+        """ Save dHash of images of bin (dictionary of id and hash) in path_to_hashes if set """
+        if self.path_to_hashes is None:
+            return
+        from ifcb_duplicates import save_hashes
+        os.makedirs(self.path_to_hashes, exist_ok=True)
+        save_hashes(os.path.join(self.path_to_hashes, f'{bin_name}_dhash.npz'), list(hashes.keys()),
+                    list(hashes.values()), self.raw.fingerprint(bin_name, '.adc', '.roi'))
+
+    def bin_hashes(self, bin_name):
+        """ dHash of each ROI of bin (see ifcb_duplicates.py), hashes saved in path_to_hashes are reused if the raw
+        bin did not change """
+        if self.path_to_hashes is not None:
+            from ifcb_duplicates import load_hashes
+            filename = os.path.join(self.path_to_hashes, f'{bin_name}_dhash.npz')
+            if os.path.isfile(filename):
+                hashes, fingerprint = load_hashes(filename)
+                if fingerprint == self.raw.fingerprint(bin_name, '.adc', '.roi'):
+                    return hashes
+        from ifcb_duplicates import dhash
+        hashes, images = dict(), dict()
+        for image_id, img in self.read_images(bin_name):
+            images[image_id] = img
+            if len(images) == 1024:
+                hashes.update(zip(images.keys(), dhash(images.values())))
+                images.clear()
+        hashes.update(zip(images.keys(), dhash(images.values())))
+        self._save_hashes(bin_name, hashes)
+        return pd.Series(list(hashes.values()), index=pd.Index(list(hashes.keys()), dtype='uint32', name='ImageId'),
+                         dtype=np.uint64, name='DHash')
+
     def extract_header(self, bin_name):
         # Parse hdr file
-        hdr = dict()
-        with open(os.path.join(self.path_to_bin, bin_name + '.hdr')) as myfile:
-            for line in myfile:
-                name, var = line.partition(":")[::2]
-                hdr[name.strip()] = var
+        with io.TextIOWrapper(self.raw.open(bin_name, '.hdr')) as myfile:
+            hdr = parse_hdr(myfile)
         # Compute volume sampled
         look_time = float(hdr['runTime']) - float(hdr['inhibitTime'])  # seconds
         volume_sampled = IFCB_FLOW_RATE * look_time / 60
@@ -281,9 +855,11 @@ class BinExtractor:
     def extract_features_v2(self, bin_name, minimal_feature_flag=False):
         """ Extract features using a custom function (fastFeatureExtration)
             based on the ifcb-analysis main branch (default) """
+        if self.feature_daemon is not None:
+            return self.feature_daemon.extract_features(self.path_to_bin, bin_name, 'v2', minimal=minimal_feature_flag)
         if self.matlab_engine is None:
             # Start Matlab engine and add IFCB_analysis
-            self.matlab_engine = matlab.engine.start_matlab()
+            self.matlab_engine = start_matlab_engine()
 
         self.matlab_engine.addpath(os.path.join(PATH_TO_IFCB_ANALYSIS_V2, 'IFCB_tools'),
                                    os.path.join(PATH_TO_IFCB_ANALYSIS_V2, 'feature_extraction'),
@@ -291,9 +867,11 @@ class BinExtractor:
                                    os.path.join(PATH_TO_IFCB_ANALYSIS_V2, 'feature_extraction', 'biovolume'),
                                    PATH_TO_MATLAB_FUNCTIONS,
                                    PATH_TO_DIPUM)
-        features = self.matlab_engine.fastFeatureExtraction(self.path_to_bin, bin_name, minimal_feature_flag,
-                                                            self.matlab_parallel_flag, nargout=1)
-        features = pd.DataFrame(np.array(features._data).reshape(features.size[::-1]).T,
+        with self.raw.local(bin_name) as path_to_bin:  # Matlab reads files, bins in archives are extracted
+            features = self.matlab_engine.fastFeatureExtraction(path_to_bin, bin_name, minimal_feature_flag,
+                                                                self.matlab_parallel_flag, nargout=1)
+        # Wrap matlab buffer without copy (column-major)
+        features = pd.DataFrame(np.frombuffer(features._data, 'float64').reshape(features.size[::-1]).T,
                                 columns=FTR_V2_COLUMN_NAMES)
         features = features.astype({'ImageId': 'uint32', 'Area': 'uint64', 'NumberBlobsInImage': 'uint16'})
         features.set_index('ImageId', inplace=True)
@@ -306,9 +884,11 @@ class BinExtractor:
 
         level: 0: BLOB, 1: SLIM (recommended for ML or SCI), 2: ALL (recommended for EcoTaxa)
         """
+        if self.feature_daemon is not None:
+            return self.feature_daemon.extract_features(self.path_to_bin, bin_name, 'v4', level=level)
         if self.matlab_engine is None:
             # Start Matlab engine and add IFCB_analysis
-            self.matlab_engine = matlab.engine.start_matlab()
+            self.matlab_engine = start_matlab_engine()
 
         self.matlab_engine.addpath(os.path.join(PATH_TO_IFCB_ANALYSIS_V3, 'IFCB_tools'),
                                    os.path.join(PATH_TO_IFCB_ANALYSIS_V3, 'feature_extraction'),
@@ -320,76 +900,74 @@ class BinExtractor:
                                    PATH_TO_DIPUM)
         self.matlab_engine.cd(
             os.path.join(PATH_TO_IFCB_ANALYSIS_V3, 'Development', 'Heidi_explore', 'blobs_for_biovolume'))
-        features = self.matlab_engine.fastFeatureExtraction_v4(self.path_to_bin, bin_name, level,
-                                                               self.matlab_parallel_flag, nargout=1)
+        with self.raw.local(bin_name) as path_to_bin:  # Matlab reads files, bins in archives are extracted
+            features = self.matlab_engine.fastFeatureExtraction_v4(path_to_bin, bin_name, level,
+                                                                   self.matlab_parallel_flag, nargout=1)
         if level == 2:
             column_names = ALL_FTR_V4_COLUMN_NAMES
         elif level == 1:
             column_names = SLIM_FTR_V4_COLUMN_NAMES
         elif level == 0:
             column_names = BLOB_FTR_V4_COLUMN_NAMES
-        features = pd.DataFrame(np.array(features._data).reshape(features.size[::-1]).T, columns=column_names)
+        # Wrap matlab buffer without copy (column-major)
+        features = pd.DataFrame(np.frombuffer(features._data, 'float64').reshape(features.size[::-1]).T,
+                                columns=column_names)
         features = features.astype({'ImageId': 'uint32', 'Area': 'uint64', 'NumberBlobsInImage': 'uint16'})
         features.set_index('ImageId', inplace=True)
         return features
 
     def init_ecotaxa_classification(self, path_to_ecotaxa_tsv, path_to_taxonomic_grouping_csv):
-        """ Build a table with id, taxon, group, and status for each image extracted from EcoTaxa """
+        """ Build a table with id, taxon, group, and status for each image extracted from EcoTaxa
+        path_to_ecotaxa_tsv can be an EcoTaxa tsv file, a classification table (feather) made by getEcoTaxa.py,
+        or a directory containing any of those files """
         # Read EcoTaxa file(s)
         if os.path.isfile(path_to_ecotaxa_tsv):
-            self.classification_data = pd.read_csv(path_to_ecotaxa_tsv, header=0, sep='\t', engine='c',
-                                                   usecols=['object_id', 'object_annotation_status',
-                                                            'object_annotation_hierarchy'],
-                                                   dtype={'object_id': str, 'object_annotation_status': 'category',
-                                                          'object_annotation_hierarchy': 'category'})
+            self.classification_data = read_ecotaxa_classification(path_to_ecotaxa_tsv)
         elif os.path.isdir(path_to_ecotaxa_tsv):
-            list_tsv = glob.glob(os.path.join(path_to_ecotaxa_tsv, '**', '*.tsv'), recursive=True)
+            list_tsv = list_ecotaxa_files(path_to_ecotaxa_tsv)
             # Read each tsv file
             data = [None] * len(list_tsv)
-            for i, f in enumerate(tqdm(list_tsv, desc='Reading Ecotaxa Files')):
-                data[i] = pd.read_csv(f, header=0, sep='\t', engine='c',
-                                      usecols=['object_id', 'object_annotation_status', 'object_annotation_hierarchy'],
-                                      dtype={'object_id': str, 'object_annotation_status': 'category',
-                                             'object_annotation_hierarchy': 'category'})
+            for i, f in enumerate(progress(list_tsv, desc='Reading Ecotaxa Files')):
+                data[i] = read_ecotaxa_classification(f)
             # Union Categories
-            us = union_categoricals([d.object_annotation_status for d in data])
-            uh = union_categoricals([d.object_annotation_hierarchy for d in data])
-            for i in range(len(data)):
-                data[i].object_annotation_status = pd.Categorical(data[i].object_annotation_status,
-                                                                  categories=us.categories)
-                data[i].object_annotation_hierarchy = pd.Categorical(data[i].object_annotation_hierarchy,
-                                                                     categories=uh.categories)
+            for c in ['AnnotationStatus', 'Hierarchy', 'bin']:
+                u = union_categoricals([d[c] for d in data])
+                for i in range(len(data)):
+                    data[i][c] = pd.Categorical(data[i][c], categories=u.categories)
             # Merge all files
             self.classification_data = pd.concat(data, ignore_index=True, axis=0)
         else:
             raise ValueError('EcoTaxa TSV file not found.')
         # Read taxonomic grouping
-        taxonomic_grouping = pd.read_csv(path_to_taxonomic_grouping_csv, header=0, engine='c')
-
-        # Quick reformating of EcoTaxa table
-        self.classification_data.rename(columns={'object_id': 'id', 'object_annotation_status': 'AnnotationStatus',
-                                                 'object_annotation_hierarchy': 'Hierarchy'},
-                                        inplace=True)
+        taxon, group = read_taxonomic_grouping(path_to_taxonomic_grouping_csv)
         # Rename/Group categories
-        taxon = pd.Series(taxonomic_grouping.taxon.values, index=taxonomic_grouping.hierarchy).to_dict()
-        group = pd.Series(taxonomic_grouping.group.values, index=taxonomic_grouping.hierarchy).to_dict()
-        self.classification_data['Taxon'] = self.classification_data.Hierarchy\
-            .apply(lambda x: taxon[x] if x in taxon.keys() else x).astype('category')
-        self.classification_data['Group'] = self.classification_data.Hierarchy\
-            .apply(lambda x: group[x] if x in group.keys() else x).astype('category')
-        # self.classification_data['Taxon'] = self.classification_data.Hierarchy.cat.rename_categories(taxon)  # Non unique new categories so does not work
-        # self.classification_data['Group'] = self.classification_data.Hierarchy.cat.rename_categories(group)
+        self.classification_data.insert(1, 'Taxon', remap_categories(self.classification_data.Hierarchy, taxon))
+        self.classification_data.insert(2, 'Group', remap_categories(self.classification_data.Hierarchy, group))
         # Drop hierarchy
         self.classification_data.drop(columns={'Hierarchy'}, inplace=True)
-        # Remove Incorrect ids
-        sel = self.classification_data['id'].str.len() != 30
-        if np.any(sel):
-            sel = np.where(sel)[0]
-            print(f"Invalid id(s) in EcoTaxa file, dropping: {[self.classification_data['id'][i] for i in sel]}")
-            self.classification_data.drop(index=sel, inplace=True)
-        # Split EcoTaxa Id
-        self.classification_data['bin'] = self.classification_data['id'].apply(lambda x: x[0:24]).astype('category')
-        self.classification_data['ImageId'] = self.classification_data['id'].apply(lambda x: x[25:]).astype('uint32')
+        self._taxon_index = None
+
+    def taxon_index(self, path_to_index=None):
+        """ Inverted index of classification data by Taxon, Group, and AnnotationStatus (see ifcb_taxa.py)
+        if path_to_index is given, the index saved is loaded, updated (bins whose classification changed), and saved """
+        if self.classification_data is None:
+            raise IFCBTools('Classification data required to index images by taxon.')
+        import ifcb_taxa
+        if path_to_index is not None:
+            self._taxon_index = ifcb_taxa.update_index(self.classification_data, path_to_index)
+        elif self._taxon_index is None:
+            self._taxon_index = ifcb_taxa.TaxonIndex.from_classification(self.classification_data)
+        return self._taxon_index
+
+    def read_indexed_images(self, index, keys):
+        """ Yield bin name, id, and image (2D uint8 array) of images of keys of taxon index
+        e.g. read_indexed_images(index, index.select(Group='Diatoms')), bins are read once each """
+        for bin_name, image_ids in index.images(keys).groupby('bin', observed=True, sort=False)['ImageId']:
+            try:
+                for image_id, img in self.read_images(bin_name, image_ids.to_numpy()):
+                    yield bin_name, image_id, img
+            except (CorruptedBin, FileNotFoundError) as e:
+                print(e)
 
     def query_classification(self, bin_name, verbose=True):
         """ query classification data previously loaded with init_ecotaxa_classification"""
@@ -403,7 +981,7 @@ class BinExtractor:
             if not foo.ImageId.is_unique:
                 print("%s: Non unique classification for each image." % bin_name)
                 foo = foo.sort_values('AnnotationStatus', ascending=False).drop_duplicates('ImageId')
-            return foo.drop(columns=['id', 'bin']).set_index('ImageId')
+            return foo.drop(columns=['bin']).set_index('ImageId')
 
     def query_environmental_data(self, bin_name):
         foo = self.environmental_data[self.environmental_data['bin'].str.match(bin_name)]
@@ -413,68 +991,344 @@ class BinExtractor:
             raise ValueError('%s: Non unique bin names in environmental data.' % bin_name)
         return foo.drop(columns={'bin'})
 
+    def classification_fingerprints(self):
+        """ Fingerprint of classification of each bin (changes with annotations or taxonomic grouping) """
+        if self.classification_data is None:
+            return dict()
+        from ifcb_manifest import group_fingerprints
+        return group_fingerprints(self.classification_data[['bin', 'ImageId', 'AnnotationStatus', 'Taxon', 'Group']],
+                                  'bin', 'ImageId').to_dict()
+
+    def input_fingerprints(self, bin_name, env_fingerprints, cls_fingerprints):
+        """ Fingerprint of inputs of each stage of the outputs of bin (see ifcb_manifest.py) """
+        return {'data': self.raw.fingerprint(bin_name, '.adc', '.roi'),
+                'header': self.raw.fingerprint(bin_name, '.hdr'),
+                'environment': env_fingerprints.get(bin_name, 'none'),
+                'classification': cls_fingerprints.get(bin_name, 'none')}
+
     def get_bin_data(self, bin_name, write_images_to=None,
                      with_scale_bar=False, scale_bar_resolution=3.4, scale_bar_outside=False,
-                     feature_level=1):
+                     feature_level=1, hashes=None):
         # Extract cytometric data, features, clear environmental data, and classification for use in ecological studies
         cytometric_data = self.extract_images_and_cytometry(bin_name, write_images_to, with_scale_bar,
-                                                            scale_bar_resolution, scale_bar_outside)
-        features = self.extract_features_v4(bin_name, level=feature_level)
+                                                            scale_bar_resolution, scale_bar_outside, hashes)
+        with self.profiler.timer('feature_extraction'):
+            features = self.extract_features_v4(bin_name, level=feature_level)
         if len(features.index) != len(cytometric_data):
             raise ValueError('%s: Cytometric and features data frames have different sizes.' % bin_name)
-        if self.classification_data is not None:
-            classification_data = self.query_classification(bin_name, verbose=False)
-            if len(classification_data.index) != len(cytometric_data):
-                if classification_data.empty:
-                    print('%s: No classification data.' % bin_name)
-                else:
-                    raise ValueError('Classification data incomplete: %d/%d' %
-                                     (len(classification_data.index), len(cytometric_data)))
-            data = pd.concat([features, cytometric_data, classification_data], axis=1)
-        else:
-            data = pd.concat([features, cytometric_data], axis=1)
+        with self.profiler.timer('classification_join'):
+            if self.classification_data is not None:
+                classification_data = self.query_classification(bin_name, verbose=False)
+                if len(classification_data.index) != len(cytometric_data):
+                    if classification_data.empty:
+                        print('%s: No classification data.' % bin_name)
+                    else:
+                        raise ValueError('Classification data incomplete: %d/%d' %
+                                         (len(classification_data.index), len(cytometric_data)))
+                data = pd.concat([features, cytometric_data, classification_data], axis=1)
+            else:
+                data = pd.concat([features, cytometric_data], axis=1)
         return data
 
     def run_machine_learning_single_bin(self, bin_name, output_path):
         """  Extract png, cytometry, features, and obfuscated environmental data
-         to classify oceanic plankton images with machine learning algorithms """
-        # Write png and get cytometry and features
-        try:
-            data = self.get_bin_data(bin_name, write_images_to=output_path)
-        except CorruptedBin as e:
-            print(e)
-            return
-        # Get environmental data
-        environmental_data = self.query_environmental_data(bin_name)
-        environmental_data = pd.DataFrame(np.repeat(environmental_data.values, len(data.index), axis=0),
-                                          index=data.index, columns=environmental_data.columns)
-        # Write data for machine learning
-        data = pd.concat([data, environmental_data], axis=1)
-        data.to_csv(os.path.join(output_path, bin_name, bin_name + '_ml.csv'),
-                    index=False, na_rep='NaN', float_format='%.4f', date_format='%Y/%m/%d %H:%M:%S')
-
-    def run_machine_learning(self, output_path):
-        """ Run run_ml_classify_rt on list of bins loaded in environmental_data """
-        for i in tqdm(range(len(self.environmental_data.index))):
+         to classify oceanic plankton images with machine learning algorithms
+         Return path to csv file written (None if bin is corrupted) """
+        with self.profiler.bin(bin_name):
+            # Write png and get cytometry and features
             try:
-                if not os.path.isfile(os.path.join(self.path_to_bin, self.environmental_data['bin'][i] + '.roi')):
-                    print('%s: missing roi file.' % self.environmental_data['bin'][i])
+                data = self.get_bin_data(bin_name, write_images_to=output_path)
+            except CorruptedBin as e:
+                print(e)
+                self.profiler.status = 'corrupted'
+                return
+            # Get environmental data (constant for bin, broadcast while writing)
+            environmental_data = self.query_environmental_data(bin_name).iloc[0]
+            # Write data for machine learning
+            filename = os.path.join(output_path, bin_name, bin_name + '_ml.csv')
+            with self.profiler.timer('output_write'):
+                write_csv_with_constants(data, environmental_data, filename,
+                                         index=False, na_rep='NaN', float_format='%.4f',
+                                         date_format='%Y/%m/%d %H:%M:%S')
+            return filename
+
+    def run_machine_learning(self, output_path, bin_list=None):
+        """ Run run_ml_classify_rt on list of bins (default all bins loaded in environmental_data) """
+        if not bin_list:
+            bin_list = self.environmental_data['bin'].to_list()
+        for bin_name in progress(bin_list):
+            try:
+                if not self.raw.exists(bin_name, '.roi'):
+                    print('%s: missing roi file.' % bin_name)
                     continue
-                if os.path.exists(os.path.join(output_path, self.environmental_data['bin'][i])):
-                    print('%s: skipped' % self.environmental_data['bin'][i])
+                if os.path.exists(os.path.join(output_path, bin_name)):
+                    print('%s: skipped' % bin_name)
                     continue
-                self.run_machine_learning_single_bin(self.environmental_data['bin'][i], output_path)
-            except:
-                print('%s: Caught Error' % self.environmental_data['bin'][i])
+                self.run_machine_learning_single_bin(bin_name, output_path)
+            except Exception as e:
+                print('%s: Caught Error: %s' % (bin_name, e))
+        self.profiler.report()
+
+    def run_machine_learning_watch(self, output_path, settle_time=5, poll_interval=2, skip_existing=True):
+        """
+        Run run_machine_learning_single_bin on each new bin written in path_to_bin as soon as it is complete.
+        The matlab engine is kept warm between bins and the latency of each bin is appended to latency.csv
+        """
+        if not os.path.isdir(self.path_to_bin):
+            raise ValueError(f'{self.path_to_bin}: only directories of raw files can be watched.')
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        latency_filename = os.path.join(output_path, 'latency.csv')
+        if not os.path.isfile(latency_filename):
+            with open(latency_filename, 'w') as f:
+                f.write('bin,closed,processed,processing_time,latency\n')
+        if self.matlab_engine is None and self.feature_daemon is None:
+            # Start Matlab engine before first bin is complete
+            self.matlab_engine = start_matlab_engine()
+        env_mtime = os.path.getmtime(self.path_to_environmental_csv)
+        print(f'Watching {self.path_to_bin} ...')
+        for bin_name, closed_at in BinWatcher(self.path_to_bin, settle_time, poll_interval, skip_existing):
+            if os.path.exists(os.path.join(output_path, bin_name)):
+                print('%s: skipped' % bin_name)
+                continue
+            # Reload environmental data if updated since last bin
+            if os.path.getmtime(self.path_to_environmental_csv) != env_mtime:
+                env_mtime = os.path.getmtime(self.path_to_environmental_csv)
+                self.init_environmental_data(self.path_to_environmental_csv)
+            t0 = time()
+            try:
+                if self.run_machine_learning_single_bin(bin_name, output_path) is None:
+                    continue  # Corrupted, no latency to record
+            except Exception as e:
+                print('%s: Caught Error: %s' % (bin_name, e))
+                continue
+            t1 = time()
+            closed, processed = datetime.fromtimestamp(closed_at, timezone.utc), datetime.fromtimestamp(t1, timezone.utc)
+            with open(latency_filename, 'a') as f:
+                f.write(f'{bin_name},{closed:%Y/%m/%d %H:%M:%S},{processed:%Y/%m/%d %H:%M:%S},'
+                        f'{t1 - t0:.3f},{t1 - closed_at:.3f}\n')
+            print(f'{bin_name}: processed in {t1 - t0:.1f} s, latency {t1 - closed_at:.1f} s')
+
+    def run_ml_train(self, output_path, bin_list=None, annotation_status=('validated',), shard_size=2**28,
+                     n_open_shards=8, image_format='png', seed=None, selection=None, duplicate_distance=None,
+                     drop_duplicates=False):
+        """
+        Write images with their features, cytometry, classification (Taxon and Group labels), and environmental data
+        to tar shards (WebDataset format) to train machine learning algorithms with sequential reads.
+        Each sample <bin>_<image id> has the members: png (or npy), cls (index of taxon in classes.csv), and json.
+        Bins are processed in random order, images are shuffled within each bin and across n_open_shards shards.
+
+        :param annotation_status: keep images with these annotation status (None: all classified images)
+        :param shard_size: target size of each shard (bytes)
+        :param image_format: png or npy (raw pixels)
+        :param selection: images to write (see ifcb_sample.py), only these images are decoded, each subset (train
+            and test) is written to its own directory, classes are the labels of selection (Taxon or Group)
+            (annotation_status is ignored)
+        :param duplicate_distance: add DuplicateOf (key of the image each image is a near-duplicate of, hashes within
+            duplicate_distance bits, see ifcb_duplicates.py) to json and index.csv, None to disable
+        :param drop_duplicates: do not write near-duplicates
+        """
+        if self.classification_data is None:
+            raise ValueError('Classification data is required to build a training dataset.')
+        duplicates = None
+        if duplicate_distance is not None:
+            from ifcb_duplicates import HashIndex, dhash
+            duplicates = HashIndex(duplicate_distance)
+        if image_format not in ('png', 'npy'):
+            raise ValueError('image_format must be png or npy.')
+        from PIL import Image
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        # List classes
+        label, selected, subsets = 'Taxon', None, [None]
+        taxa = self.classification_data['Taxon'].cat.categories
+        if selection is not None:
+            label = 'Group' if 'Group' in selection.columns else 'Taxon'
+            taxa = pd.Index(sorted(selection[label].unique()))
+            selected = {b: s.set_index('ImageId')[[label, 'Subset']] for b, s in selection.groupby('bin', sort=False)}
+            subsets = sorted(selection['Subset'].unique())
+            bin_list = [b for b in bin_list if b in selected] if bin_list else list(selected)
+        class_ids = {t: i for i, t in enumerate(taxa)}
+        pd.DataFrame({label: taxa}).to_csv(os.path.join(output_path, 'classes.csv'), index_label='Class')
+        rng = np.random.default_rng(seed)
+        if not bin_list:
+            bin_list = self.environmental_data['bin'].to_list()
+        n = 0
+        with ExitStack() as stack:
+            shards = dict()
+            for subset in subsets:
+                path = output_path if subset is None else os.path.join(output_path, subset)
+                os.makedirs(path, exist_ok=True)
+                shards[subset] = stack.enter_context(ShardWriter(path, shard_size, n_open_shards,
+                                                                 seed=rng.integers(2**32)))
+            for bin_name in progress(rng.permutation(bin_list)):
+                with self.profiler.bin(bin_name):
+                    try:
+                        data = self.get_bin_data(bin_name)
+                    except (CorruptedBin, FileNotFoundError) as e:
+                        print(e)
+                        self.profiler.status = 'corrupted'
+                        continue
+                    if 'Taxon' not in data.columns:
+                        self.profiler.status = 'skipped'
+                        continue
+                    data = data[data['Taxon'].notna()]
+                    if selected is not None:
+                        data = data[data.index.isin(selected[bin_name].index)]
+                    elif annotation_status is not None:
+                        data = data[data['AnnotationStatus'].isin(annotation_status)]
+                    if data.empty:
+                        self.profiler.status = 'skipped'
+                        continue
+                    try:
+                        decoded = dict(self.read_images(bin_name, data.index))
+                    except CorruptedBin as e:
+                        print(e)
+                        self.profiler.status = 'corrupted'
+                        continue
+                    data = data[data.index.isin(list(decoded.keys()))]  # Rows without image (empty ROI)
+                    if duplicates is not None:
+                        # Find near-duplicates of images within bin and in bins written before
+                        with self.profiler.timer('hash'):
+                            hashes = pd.Series(dhash(decoded.values()), index=list(decoded.keys()), dtype=np.uint64)
+                            duplicate_of = duplicates.add(bin_name, hashes).reindex(data.index, fill_value='')
+                        data = data.assign(DuplicateOf=duplicate_of.to_numpy())
+                        if drop_duplicates:
+                            data = data[data['DuplicateOf'] == '']
+                    if selected is not None:
+                        subset = selected[bin_name].reindex(data.index)
+                        classes, subset = subset[label].to_numpy(), subset['Subset'].to_numpy()
+                    else:
+                        classes = data['Taxon'].to_numpy()
+                    # Encode images
+                    images = dict()
+                    with self.profiler.timer('png_encode'):
+                        for image_id in data.index:
+                            buffer = io.BytesIO()
+                            if image_format == 'png':
+                                Image.fromarray(decoded[image_id]).save(buffer, 'PNG')
+                            else:
+                                np.save(buffer, decoded[image_id])
+                            images[image_id] = buffer.getvalue()
+                    # Append environmental data (constant for bin) to json of each image
+                    env = json.loads(self.query_environmental_data(bin_name)
+                                     .to_json(orient='records', date_format='iso'))[0]
+                    records = json.loads(data.rename_axis('ImageId').reset_index()
+                                         .to_json(orient='records', date_format='iso'))
+                    labels = data[['Taxon', 'Group', 'AnnotationStatus'] +
+                                  ([] if duplicates is None else ['DuplicateOf'])].to_dict('records')
+                    with self.profiler.timer('output_write'):
+                        for i in rng.permutation(len(data.index)):
+                            image_id = data.index[i]
+                            shards[None if selected is None else subset[i]].write(
+                                f'{bin_name}_{image_id:05d}',
+                                {image_format: images[image_id],
+                                 'cls': str(class_ids[classes[i]]).encode(),
+                                 'json': json.dumps({**records[i], **env}).encode()},
+                                labels[i])
+                    n += len(data.index)
+        print(f'{n} images written to {sum(s.n_shards for s in shards.values())} shards.')
+        self.profiler.report()
+
+    def run_tensor_cache(self, output_path, bin_list=None, shape=(128, 128), interpolation='bilinear', pad_value=0,
+                         upscale=True, annotation_status=None, selection=None, duplicate_distance=None):
+        """
+        Resize each ROI to a fixed shape (preserving aspect ratio, see resize_and_pad) into one memory-mapped array
+        images.npy (N, H, W) uint8 aligned with index.csv (bin, ImageId, size, scale, and labels if classification is
+        loaded) so that training batches are loaded without decoding: np.load('images.npy', mmap_mode='r')[rows]
+
+        :param annotation_status: keep images with these annotation status (None: all images)
+        :param selection: images to write (see ifcb_sample.py) with their Subset (train or test) in index.csv,
+            only these images are decoded
+        :param duplicate_distance: add DuplicateOf (bin and id of the image each image is a near-duplicate of, hashes
+            within duplicate_distance bits, see ifcb_duplicates.py) to index.csv, None to disable
+        """
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        duplicates = None
+        if duplicate_distance is not None:
+            from ifcb_duplicates import HashIndex, dhash
+            duplicates = HashIndex(duplicate_distance)
+        selected = None
+        if selection is not None:
+            selected = {b: s.set_index('ImageId')['Subset'] for b, s in selection.groupby('bin', sort=False)}
+            bin_list = [b for b in bin_list if b in selected] if bin_list else list(selected)
+        if not bin_list:
+            bin_list = self.environmental_data['bin'].to_list()
+        # List images to get size of array
+        index = []
+        for bin_name in progress(bin_list, desc='Listing images'):
+            try:
+                with self.raw.open(bin_name, '.adc') as f:
+                    adc = parse_adc(f)
+                adc = adc[adc['StartByte'] != adc['EndByte']]
+                if self.raw.size(bin_name, '.roi') < adc['EndByte'].max():
+                    raise CorruptedBin(f'CorruptedBin:{bin_name}: adc end byte is greater than roi size.')
+            except (CorruptedBin, FileNotFoundError) as e:
+                print(e)
+                continue
+            listing = pd.DataFrame({'bin': bin_name, 'ImageId': adc.index.astype('uint32'),
+                                    'ImageWidth': adc['ImageWidth'], 'ImageHeight': adc['ImageHeight']})
+            if selected is not None:
+                listing = listing.join(selected[bin_name], on='ImageId', how='inner')
+            if self.classification_data is not None:
+                listing = listing.join(self.query_classification(bin_name, verbose=False), on='ImageId')
+                if annotation_status is not None and selected is None:
+                    listing = listing[listing['AnnotationStatus'].isin(annotation_status)]
+            index.append(listing)
+        # Empty index (and array) if every bin is skipped
+        index = pd.concat(index, ignore_index=True) if index else \
+            pd.DataFrame({'bin': pd.Series(dtype=object), 'ImageId': pd.Series(dtype='uint32'),
+                          'ImageWidth': pd.Series(dtype='int64'), 'ImageHeight': pd.Series(dtype='int64')})
+        index['Scale'] = np.nan
+        if duplicates is not None:
+            index['DuplicateOf'] = ''
+        # Resize images bin by bin, by groups of images of same size
+        images = np.lib.format.open_memmap(os.path.join(output_path, 'images.npy'), mode='w+', dtype='uint8',
+                                           shape=(len(index.index), shape[0], shape[1]))
+        for bin_name, rows in progress(index.groupby('bin', sort=False), desc='Resizing images'):
+            with self.profiler.bin(bin_name):
+                roi = dict(self.read_images(bin_name, rows['ImageId']))
+                if duplicates is not None:
+                    with self.profiler.timer('hash'):
+                        hashes = pd.Series(dhash(roi.values()), index=list(roi.keys()), dtype=np.uint64)
+                        index.loc[rows.index, 'DuplicateOf'] = \
+                            duplicates.add(bin_name, hashes).reindex(rows['ImageId'], fill_value='').to_numpy()
+                with self.profiler.timer('resize'):
+                    for _, group in rows.groupby(['ImageHeight', 'ImageWidth']):
+                        resized, scale = resize_and_pad(np.stack([roi[i] for i in group['ImageId']]), shape,
+                                                        interpolation, pad_value, upscale)
+                        images[group.index] = resized
+                        index.loc[group.index, 'Scale'] = scale
+                self.profiler.count('images', len(rows.index))
+        images.flush()
+        del images
+        write_csv(index, os.path.join(output_path, 'index.csv'), index_label='Row', float_format='%.4f')
+        print(f'{len(index.index)} images written to {os.path.join(output_path, "images.npy")}.')
+        self.profiler.report()
 
     def run_ecotaxa(self, output_path: str, bin_list: list = None,
                     acquisition: dict = {}, process: dict = {}, url: str = '',
-                    force: bool = False, update: list = [], scale_bar_outside: bool = True):
+                    force: bool = False, update: list = [], scale_bar_outside: bool = True, incremental: bool = False,
+                    failed: dict = None, duplicate_distance: int = None, drop_duplicates: bool = False):
         """
         Extract png with scale bar, cytometry, features, instrument configuration, environmental data
         for further validation with EcoTaxa.
 
+        :param incremental: update only the parts of the tsv files whose inputs changed since the previous incremental
+            run (fingerprints saved in <output_path>/manifest.db): images and features if the raw bin changed,
+            environment, acquisition (including header), or process otherwise (force and update are ignored)
+        :param failed: dictionary set with the error of each bin that could not be processed (e.g. corrupted)
+        :param duplicate_distance: add column object_duplicate_of with the id of the image each image is a
+            near-duplicate of (hashes within duplicate_distance bits, see ifcb_duplicates.py), None to disable
+        :param drop_duplicates: do not write nor upload near-duplicates (png and rows of tsv)
         """
+        if failed is None:
+            failed = dict()
+        duplicates = None
+        if duplicate_distance is not None:
+            from ifcb_duplicates import HashIndex
+            duplicates = HashIndex(duplicate_distance)
         if acquisition:
             for key in ['instrument', 'serial_number', 'resolution_pixel_per_micron']:
                 if key not in acquisition.keys():
@@ -488,100 +1342,179 @@ class BinExtractor:
         set_env = True if not update or 'environment' in update else False
         set_acq = True if not update or 'acquisition' in update else False
         set_proc = True if not update or 'process' in update else False
+        if incremental:
+            from ifcb_manifest import BuildManifest, config_fingerprint, row_fingerprints
+            manifest = BuildManifest(os.path.join(output_path, 'manifest.db'))
+            env_fingerprints = row_fingerprints(self.environmental_data).to_dict()
+            acq_fingerprint, proc_fingerprint = config_fingerprint(acquisition), config_fingerprint(process)
         # Files to process
         if not bin_list:
             bin_list = self.environmental_data['bin'].to_list()
-        for bin_name in tqdm(bin_list):
+        for bin_name in progress(bin_list):
+            tsv_filename = os.path.join(output_path, bin_name, 'ecotaxa_' + bin_name + '.tsv')
+            if incremental:
+                fingerprints = {'data': f"{self.raw.fingerprint(bin_name, '.adc', '.roi')},{scale_bar_outside},"
+                                        f"{acquisition.get('resolution_pixel_per_micron')}",
+                                'environment': f"{env_fingerprints.get(bin_name, 'none')},{url}",
+                                'acquisition': f"{acq_fingerprint},{self.raw.fingerprint(bin_name, '.hdr')}",
+                                'process': proc_fingerprint}
+                stale = manifest.stale(bin_name, fingerprints) if os.path.exists(tsv_filename) else set(fingerprints)
+                if not stale:
+                    self._index_hashes(duplicates, bin_name)
+                    continue
+                from_raw = 'data' in stale
+                set_env, set_acq, set_proc = [from_raw or k in stale for k in ('environment', 'acquisition', 'process')]
             # Skip if already processed
-            if not force and (os.path.exists(os.path.join(output_path, bin_name)) and
-                              os.path.exists(os.path.join(output_path, bin_name, 'ecotaxa_' + bin_name + '.tsv'))):
+            elif not force and os.path.exists(tsv_filename):
                 print(f'OutputExists:{bin_name}: Skipped')
+                self._index_hashes(duplicates, bin_name)
                 continue
-            if from_raw:
-                # Write images, read cytometry, and compute features
-                try:
-                    data = self.get_bin_data(bin_name, write_images_to=output_path, with_scale_bar=True,
-                                             scale_bar_resolution=acquisition['resolution_pixel_per_micron'],
-                                             scale_bar_outside=scale_bar_outside,
-                                             feature_level=2)
-                except (CorruptedBin, FileNotFoundError) as e:
-                    print(e)
-                    continue
-                if data.empty:
-                    print(f'EmptyBin:{bin_name}: Skipped')
-                    continue
-                # Create DataFrame for EcoTaxa
-                object_id = bin_name + '_' + data.index.astype('str').str.zfill(5)
-                et = pd.DataFrame({'img_file_name': object_id + '.png', 'object_id': object_id}, index=data.index)
-            else:
-                if not os.path.exists(os.path.join(output_path, bin_name, 'ecotaxa_' + bin_name + '.tsv')):
-                    print(f'MissingBin:{bin_name}: Skipped')
-                    continue
-                # Read already computed features and cytometry; skip image extraction
-                et = pd.read_csv(os.path.join(output_path, bin_name, 'ecotaxa_' + bin_name + '.tsv'),
-                                 header=[0, 1], delimiter='\t', dtype={'object_date': str, 'object_time': str})
-            if set_env:
-                # Get environmental data
-                env = self.query_environmental_data(bin_name)
-                # Object
-                if url:
-                    et['object_link'] = f'{url}&bin={bin_name}'
-                et['object_lat'] = env.Latitude.values[0] if not env.Latitude.isna().any() else 44.9012018
-                et['object_lon'] = env.Longitude.values[0] if not env.Latitude.isna().any() else -68.6704788
-                et['object_date'] = env.DateTime.dt.strftime('%Y%m%d').values[0]
-                et['object_time'] = env.DateTime.dt.strftime('%H%M%S').values[0]
-                if 'Depth' in env.columns:
-                    et['object_depth'] = env.Depth.values[0]
-                elif 'DepthMin' not in env.columns or 'DepthMax' not in env.columns:
-                    raise KeyError('Environmental data requires column "Depth" or "DepthMin" and "DepthMax"')
-            if from_raw:
-                # Append all features and cytometry to Object
-                # Done here to add columns in order
-                cols = et.columns.to_list()
-                et = pd.concat([et, data], axis=1)
-                et.columns = cols + ['object_' + upper_to_under(k) for k in data.columns]
-            # Sample
-            if set_env:
-                et['sample_id'] = bin_name
-                for k in env.columns:
-                    if k not in ['DateTime', 'Latitude', 'Longitude', 'Depth']:
-                        et['sample_' + upper_to_under(k)] = env[k].astype(str).values[0]
-            # Acquisition
-            if set_acq:
-                et['acq_id'] = acquisition['instrument'] + str(acquisition['serial_number']) + '.' + bin_name
-                # User Input
-                for k, v in acquisition.items():
-                    et['acq_' + upper_to_under(k)] = str(v)
-                # Bin Header (e.g. volume sampled, pmt settings)
-                hdr = self.extract_header(bin_name)
-                for k, v in hdr.items():
-                    et['acq_' + upper_to_under(k)] = v
-            # Process
-            if set_proc:
-                for k, v in process.items():
-                    et['process_' + upper_to_under(k)] = str(v)
-            # Write tsv (with line indicating type)
-            if from_raw:
-                cols = [(c, '[t]' if et[c].dtype == 'O' else '[f]') for c in et.columns]
-            else:
-                # Already multi-index, assign type only to unknown cols
-                cols = []
-                for c in et.columns:
-                    if not c[1]:
-                        cols.append((c[0], '[t]' if et[c[0]].dtype == 'O' else '[f]'))
-                    else:
-                        cols.append(c)
-                # et[('object_time', '[t]')] = et[('object_time', '[t]')].apply(lambda r: f'{r:06d}')  # Patch object time
-            et.columns = pd.MultiIndex.from_tuples(cols)
-            et.to_csv(os.path.join(output_path, bin_name, 'ecotaxa_' + bin_name + '.tsv'),
-                      index=False, na_rep='NaN', float_format='%.4f', sep='\t')
+            with self.profiler.bin(bin_name):
+                if from_raw:
+                    # Write images, read cytometry, and compute features
+                    hashes = None if duplicates is None else dict()
+                    try:
+                        data = self.get_bin_data(bin_name, write_images_to=output_path, with_scale_bar=True,
+                                                 scale_bar_resolution=acquisition['resolution_pixel_per_micron'],
+                                                 scale_bar_outside=scale_bar_outside,
+                                                 feature_level=2, hashes=hashes)
+                    except (CorruptedBin, FileNotFoundError) as e:
+                        print(e)
+                        failed[bin_name] = str(e)
+                        self.profiler.status = 'corrupted'
+                        continue
+                    if data.empty:
+                        print(f'EmptyBin:{bin_name}: Skipped')
+                        self.profiler.status = 'empty'
+                        continue
+                    # Create DataFrame for EcoTaxa
+                    object_id = bin_name + '_' + data.index.astype('str').str.zfill(5)
+                    et = pd.DataFrame({'img_file_name': object_id + '.png', 'object_id': object_id}, index=data.index)
+                    if duplicates is not None:
+                        et['object_duplicate_of'] = duplicates.add(bin_name, pd.Series(hashes, dtype=np.uint64)) \
+                            .reindex(data.index, fill_value='').to_numpy()
+                        if drop_duplicates:
+                            drop = et['object_duplicate_of'] != ''
+                            for f in et.loc[drop, 'img_file_name']:
+                                os.remove(os.path.join(output_path, bin_name, f))
+                            et, data = et[~drop], data[~drop]
+                else:
+                    self._index_hashes(duplicates, bin_name)
+                    if not os.path.exists(tsv_filename):
+                        print(f'MissingBin:{bin_name}: Skipped')
+                        failed[bin_name] = f'MissingBin:{bin_name}'
+                        self.profiler.status = 'skipped'
+                        continue
+                    # Read already computed features and cytometry; skip image extraction
+                    et = pd.read_csv(tsv_filename,
+                                     header=[0, 1], delimiter='\t', dtype={'object_date': str, 'object_time': str})
+                if set_env:
+                    # Get environmental data
+                    env = self.query_environmental_data(bin_name)
+                    # Object
+                    if url:
+                        et['object_link'] = f'{url}&bin={bin_name}'
+                    et['object_lat'] = env.Latitude.values[0] if not env.Latitude.isna().any() else 44.9012018
+                    et['object_lon'] = env.Longitude.values[0] if not env.Latitude.isna().any() else -68.6704788
+                    et['object_date'] = env.DateTime.dt.strftime('%Y%m%d').values[0]
+                    et['object_time'] = env.DateTime.dt.strftime('%H%M%S').values[0]
+                    if 'Depth' in env.columns:
+                        et['object_depth'] = env.Depth.values[0]
+                    elif 'DepthMin' not in env.columns or 'DepthMax' not in env.columns:
+                        raise KeyError('Environmental data requires column "Depth" or "DepthMin" and "DepthMax"')
+                if from_raw:
+                    # Append all features and cytometry to Object
+                    # Done here to add columns in order
+                    cols = et.columns.to_list()
+                    et = pd.concat([et, data], axis=1)
+                    et.columns = cols + ['object_' + upper_to_under(k) for k in data.columns]
+                # Sample
+                if set_env:
+                    et['sample_id'] = bin_name
+                    for k in env.columns:
+                        if k not in ['DateTime', 'Latitude', 'Longitude', 'Depth']:
+                            et['sample_' + upper_to_under(k)] = env[k].astype(str).values[0]
+                # Acquisition
+                if set_acq:
+                    et['acq_id'] = acquisition['instrument'] + str(acquisition['serial_number']) + '.' + bin_name
+                    # User Input
+                    for k, v in acquisition.items():
+                        et['acq_' + upper_to_under(k)] = str(v)
+                    # Bin Header (e.g. volume sampled, pmt settings)
+                    hdr = self.extract_header(bin_name)
+                    for k, v in hdr.items():
+                        et['acq_' + upper_to_under(k)] = v
+                # Process
+                if set_proc:
+                    for k, v in process.items():
+                        et['process_' + upper_to_under(k)] = str(v)
+                # Write tsv (with line indicating type)
+                if from_raw:
+                    cols = [(c, '[t]' if et[c].dtype == 'O' else '[f]') for c in et.columns]
+                else:
+                    # Already multi-index, assign type only to unknown cols
+                    cols = []
+                    for c in et.columns:
+                        if not c[1]:
+                            cols.append((c[0], '[t]' if et[c[0]].dtype == 'O' else '[f]'))
+                        else:
+                            cols.append(c)
+                    # et[('object_time', '[t]')] = et[('object_time', '[t]')].apply(lambda r: f'{r:06d}')  # Patch object time
+                et.columns = pd.MultiIndex.from_tuples(cols)
+                with self.profiler.timer('output_write'):
+                    write_csv(et, tsv_filename, index=False, na_rep='NaN', float_format='%.4f', sep='\t')
+                if incremental:
+                    manifest.record(bin_name, fingerprints)
+        self.profiler.report()
+
+    def _index_hashes(self, duplicates, bin_name):
+        """ Add hashes of images of bin not extracted again to index of near-duplicates (if any) """
+        if duplicates is None:
+            return
+        try:
+            duplicates.add(bin_name, self.bin_hashes(bin_name))
+        except (CorruptedBin, FileNotFoundError) as e:
+            print(e)
+
+    def load_science_metadata(self, output_path):
+        """ Load metadata of previous run_science or create new one from environmental data """
+        metadata_filename = os.path.join(output_path, 'metadata.csv')
+        if os.path.isfile(metadata_filename):
+            metadata = pd.read_csv(metadata_filename)
+            metadata.rename(columns={'BinId': 'bin'}, inplace=True)
+            if 'Validated' in metadata.columns:
+                metadata.rename(columns={'Validated': 'AnnotationValidated'}, inplace=True)
+            return metadata, False
+        metadata = self.environmental_data.copy()
+        for c in HDR_COLUMN_NAMES:
+            metadata[c] = np.nan
+        metadata['TriggerSelection'] = -9999
+        metadata['AnnotationValidated'] = np.nan
+        return metadata, True
+
+    @staticmethod
+    def write_science_metadata(metadata, output_path):
+        metadata['TriggerSelection'] = metadata['TriggerSelection'].astype('int32')
+        write_csv(metadata.rename(columns={'bin': 'BinId'}), os.path.join(output_path, 'metadata.csv'),
+                  index=False, na_rep='NaN', float_format='%.4f', date_format='%Y/%m/%d %H:%M:%S')
 
     def run_science(self, output_path, bin_list=None, update_all=False, update_classification=False,
-                    make_matlab_table=False, matlab_table_info=None):
+                    make_matlab_table=False, matlab_table_info=None, write_metadata=True, incremental=False,
+                    failed=None):
         """
         Generate a file per bin with cytometry, features, and classification data
         Generate a metadata file with all environmental data and bin header information
+
+        :param write_metadata: write metadata.csv (disabled by workers sharing output_path, see ifcb_queue.py)
+        :param incremental: update only the parts of outputs whose inputs changed since the previous incremental run
+            (fingerprints of inputs are saved in <output_path>/manifest.db): features and cytometry if the raw bin
+            changed, classification if annotations or taxonomic grouping of bin changed, and columns of metadata if
+            the header or the environmental data of bin changed (update_all and update_classification are ignored)
+        :param failed: dictionary set with the error of each bin that could not be processed (e.g. corrupted)
+        :return: metadata of each bin
         """
+        if failed is None:
+            failed = dict()
         if make_matlab_table:
             if not isinstance(matlab_table_info, dict):
                 raise ValueError('matlab_table_info is required and must be a dictionary')
@@ -590,97 +1523,123 @@ class BinExtractor:
                 if k not in matlab_table_info.keys():
                     raise ValueError(f'matlab_table_info must have field: {k}')
         # Load previous metadata or create new one
-        metadata_filename = os.path.join(output_path, 'metadata.csv')
-        if os.path.isfile(metadata_filename):
-            new_metadata_file = False
-            metadata = pd.read_csv(metadata_filename)
-            metadata.rename(columns={'BinId': 'bin'}, inplace=True)
-            if 'Validated' in metadata.columns:
-                metadata.rename(columns={'Validated': 'AnnotationValidated'}, inplace=True)
-        else:
-            new_metadata_file = True
-            metadata = self.environmental_data
-            for c in HDR_COLUMN_NAMES:
-                metadata[c] = np.nan
-            metadata['TriggerSelection'] = -9999
-            metadata['AnnotationValidated'] = np.nan
+        metadata, new_metadata_file = self.load_science_metadata(output_path)
         # Check classification
         if self.classification_data is None:
             print('Warning: classification missing.')
+        if incremental:
+            from ifcb_manifest import BuildManifest, row_fingerprints
+            manifest = BuildManifest(os.path.join(output_path, 'manifest.db'))
+            env_fingerprints = row_fingerprints(self.environmental_data).to_dict()
+            cls_fingerprints = self.classification_fingerprints()
+            # Add bins new in environmental data
+            new_bins = self.environmental_data[~self.environmental_data['bin'].isin(metadata['bin'])]
+            if not new_metadata_file and not new_bins.empty:
+                new_bins = new_bins.assign(DateTime=new_bins['DateTime'].dt.strftime('%Y/%m/%d %H:%M:%S'),
+                                           TriggerSelection=-9999)
+                metadata = pd.concat([metadata, new_bins], ignore_index=True)
         # Set list to parse
         if not bin_list:
             bin_list = metadata['bin']
-        for bin_name in tqdm(bin_list):
+        for bin_name in progress(bin_list):
             i = metadata.index[metadata['bin'] == bin_name]
             try:
-                if not os.path.isfile(os.path.join(self.path_to_bin, bin_name + '.roi')):
-                    print('%s: missing roi file.' % bin_name)
-                    metadata.drop(index=i, inplace=True)
-                    continue
-                bin_filename = os.path.join(output_path, bin_name + '_sci.csv')
-                if new_metadata_file or update_all or not os.path.isfile(bin_filename):
-                    # Get header information
-                    metadata.loc[i, HDR_COLUMN_NAMES] = self.extract_header(bin_name).to_list()
-                if not os.path.isfile(bin_filename) or update_all:
-                    # Get cytometry, features, and classification and write to <bin_name>_sci.csv
-                    try:
-                        data = self.get_bin_data(bin_name)
-                    except CorruptedBin as e:
-                        print(e)
+                with self.profiler.bin(bin_name):
+                    if not self.raw.exists(bin_name, '.roi'):
+                        print('%s: missing roi file.' % bin_name)
+                        metadata.drop(index=i, inplace=True)
+                        self.profiler.status = 'missing'
                         continue
-                    data.to_csv(bin_filename,
-                                na_rep='NaN', float_format='%.4f', index_label='ImageId')
-                    # Get percent validated
-                    if not data.empty and 'AnnotationStatus' in data.keys():
-                        metadata.loc[i, 'AnnotationValidated'] = np.sum(data['AnnotationStatus'] == 'validated') / len(
-                            data.index)
-                elif update_classification and self.classification_data is not None:
-                    # Get classification data to get validation percentage for metadata file
-                    data = self.query_classification(bin_name, verbose=True)
-                    if not data.empty:
-                        foo = pd.read_csv(bin_filename, index_col='ImageId')
-                        if foo.shape[0] != data.shape[0]:
-                            print('%s: Unable to update classification, different sizes.' % bin_name)
+                    bin_filename = os.path.join(output_path, bin_name + '_sci.csv')
+                    if incremental:
+                        fingerprints = self.input_fingerprints(bin_name, env_fingerprints, cls_fingerprints)
+                        stale = manifest.stale(bin_name + '_sci.csv', fingerprints) \
+                            if os.path.isfile(bin_filename) else set(fingerprints)
+                        update_data = 'data' in stale
+                        update_header = 'header' in stale or new_metadata_file
+                        update_env = 'environment' in stale and not new_metadata_file
+                        reclassify = 'classification' in stale and self.classification_data is not None
+                    else:
+                        update_data = not os.path.isfile(bin_filename) or update_all
+                        update_header = new_metadata_file or update_data
+                        update_env = False
+                        reclassify = update_classification and self.classification_data is not None
+                    if update_header:
+                        # Get header information
+                        metadata.loc[i, HDR_COLUMN_NAMES] = self.extract_header(bin_name).to_list()
+                    if update_env:
+                        # Stamp environmental data of bin (previous metadata has dates formatted)
+                        env = self.query_environmental_data(bin_name)
+                        for c in env.columns:
+                            metadata.loc[i, c] = env[c].dt.strftime('%Y/%m/%d %H:%M:%S').values \
+                                if c == 'DateTime' else env[c].values
+                    if update_data:
+                        # Get cytometry, features, and classification and write to <bin_name>_sci.csv
+                        try:
+                            data = self.get_bin_data(bin_name)
+                        except CorruptedBin as e:
+                            print(e)
+                            failed[bin_name] = str(e)
+                            self.profiler.status = 'corrupted'
                             continue
-                        # Rename old column Status to AnnotationStatus (for old NAAMES files)
-                        if 'Status' in foo.columns:
-                            foo.rename(columns={'Status': 'AnnotationStatus'}, inplace=True)
-                        # Replace old columns by new ones
-                        foo.drop(columns=data.columns, axis=0, inplace=True)
-                        data = pd.concat([foo, data], axis=1)
-                        data.to_csv(bin_filename,
-                                    na_rep='NaN', float_format='%.4f', index_label='ImageId')
-                        # Update percent validated in metadata
-                        metadata.loc[i, 'AnnotationValidated'] = np.sum(data['AnnotationStatus'] == 'validated') / len(
-                            data.index)
-                elif new_metadata_file and self.classification_data is not None:
-                    # Get classification data to get validation percentage for metadata file
-                    data = self.query_classification(bin_name, verbose=True)
-                    if not data.empty:
-                        # Get percent validated in metadata
-                        metadata.loc[i, 'AnnotationValidated'] = np.sum(data['AnnotationStatus'] == 'validated') / len(
-                            data.index)
-                else:
-                    # Bin already processed and does not need to be processed
-                    # print('%s: skipped' % bin_name)
-                    continue
+                        with self.profiler.timer('output_write'):
+                            write_csv(data, bin_filename, na_rep='NaN', float_format='%.4f', index_label='ImageId')
+                        # Get percent validated
+                        if not data.empty and 'AnnotationStatus' in data.keys():
+                            metadata.loc[i, 'AnnotationValidated'] = \
+                                np.sum(data['AnnotationStatus'] == 'validated') / len(data.index)
+                    elif reclassify:
+                        # Get classification data to get validation percentage for metadata file
+                        data = self.query_classification(bin_name, verbose=True)
+                        if not data.empty:
+                            foo = pd.read_csv(bin_filename, index_col='ImageId')
+                            if foo.shape[0] != data.shape[0]:
+                                print('%s: Unable to update classification, different sizes.' % bin_name)
+                                failed[bin_name] = 'Unable to update classification, different sizes.'
+                                continue
+                            # Rename old column Status to AnnotationStatus (for old NAAMES files)
+                            if 'Status' in foo.columns:
+                                foo.rename(columns={'Status': 'AnnotationStatus'}, inplace=True)
+                            # Replace old columns by new ones
+                            foo.drop(columns=data.columns, axis=0, inplace=True, errors='ignore')
+                            data = pd.concat([foo, data], axis=1)
+                            with self.profiler.timer('output_write'):
+                                write_csv(data, bin_filename,
+                                          na_rep='NaN', float_format='%.4f', index_label='ImageId')
+                            # Update percent validated in metadata
+                            metadata.loc[i, 'AnnotationValidated'] = \
+                                np.sum(data['AnnotationStatus'] == 'validated') / len(data.index)
+                    elif new_metadata_file and self.classification_data is not None:
+                        # Get classification data to get validation percentage for metadata file
+                        data = self.query_classification(bin_name, verbose=True)
+                        if not data.empty:
+                            # Get percent validated in metadata
+                            metadata.loc[i, 'AnnotationValidated'] = \
+                                np.sum(data['AnnotationStatus'] == 'validated') / len(data.index)
+                    elif not (update_header or update_env):
+                        # Bin already processed and does not need to be processed
+                        # print('%s: skipped' % bin_name)
+                        self.profiler.status = 'skipped'
+                        continue
+                    if incremental:
+                        manifest.record(bin_name + '_sci.csv', fingerprints)
             except Exception as e:
                 # raise e
                 print('%s: Caught Error: %s' % (bin_name, e))
-        # Write metadata
-        metadata['TriggerSelection'] = metadata['TriggerSelection'].astype('int32')
-        metadata.rename(columns={'bin': 'BinId'}).to_csv(metadata_filename,
-                                                         index=False, na_rep='NaN', float_format='%.4f',
-                                                         date_format='%Y/%m/%d %H:%M:%S')
-        # Make matlab table calling appropriate helper
+                failed[bin_name] = f'{type(e).__name__}: {e}'
+        self.profiler.report()
+        if not write_metadata:
+            return metadata
+        self.write_science_metadata(metadata, output_path)
+        if self.classification_data is not None:
+            # Index images by taxon, group, and status (only bins whose classification changed are indexed again)
+            self.taxon_index(os.path.join(output_path, TAXON_INDEX_FILENAME))
+        # Make consolidated table (mat and parquet)
         if make_matlab_table:
-            if self.matlab_engine is None:
-                # Start Matlab engine and add IFCB_analysis
-                self.matlab_engine = matlab.engine.start_matlab()
-
-            self.matlab_engine.addpath(PATH_TO_MATLAB_FUNCTIONS)
             cfg = dict(path_to_input_data=output_path, path_to_output_table=output_path)
-            self.matlab_engine.make_ifcb_table(matlab_table_info, cfg, nargout=0)
+            from makeIFCBTable import make_ifcb_table
+            make_ifcb_table(matlab_table_info, cfg)
+        return metadata
 
     @staticmethod
     def run_seabass(path_to_sci: str, output_path: str, metadata: dict):
@@ -727,7 +1686,7 @@ class BinExtractor:
             else metadata['dashboard_url']
 
         sci = pd.read_csv(os.path.join(path_to_sci, 'metadata.csv'), parse_dates=['DateTime'])
-        for _, r in tqdm(sci.iterrows(), total=len(sci), desc='Exporting to SeaBASS'):
+        for _, r in progress(sci.iterrows(), total=len(sci), desc='Exporting to SeaBASS'):
             sb_bin_id = r.BinId[1:9] + r.BinId[10:16]  # date & time of IFCB sample
             cruise = f"{metadata['cruise']}{r.Campaign}"
             filename = f"{metadata['experiment']}-{cruise}_{metadata['filename_descriptor']}_" \
@@ -796,13 +1755,13 @@ class BinExtractor:
             # Write data
             with open(os.path.join(output_path, filename), 'w') as f:
                 f.writelines(hdr)
-                bin.to_csv(f, index=False, header=False, float_format='%.3f', na_rep=fmt(float('nan')))
+                write_csv(bin, f, index=False, header=False, float_format='%.3f', na_rep=fmt(float('nan')))
 
     def check_machine_learning(self, path_to_data):
         flag = False
         # Get list of bins from 3 sources
         list_bins_env = list(self.environmental_data['bin'])
-        list_bins_in = [b[0:-4] for b in os.listdir(self.path_to_bin) if b[-4:] == '.roi']
+        list_bins_in = self.raw.bins()
         list_bins_out = os.listdir(path_to_data)
 
         # Check no bins are missing
@@ -828,7 +1787,7 @@ class BinExtractor:
 
         # Check that each bin is complete
         n = 0
-        for b in tqdm(list_bins_out):
+        for b in progress(list_bins_out):
             path_to_metadata = os.path.join(path_to_data, b, b + '_ml.csv')
             if not os.path.exists(path_to_metadata):
                 flag = True
@@ -866,9 +1825,10 @@ class BinExtractor:
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('mode', type=str, help="Set data extraction mode."
-                                               " Options available are: ml-train, ml-classify-batch, ml-classify-rt, ecotaxa, ecology.")
+                                               " Options available are: ml-train, ml-tensor, ml-classify-batch,"
+                                               " ml-classify-rt, ml-classify-watch, ecotaxa, ecology.")
     parser.add_argument('-r', '--raw', type=str, required=True,
-                        help="Set path to raw IFCB directory (adc, hdr, and roi files).")
+                        help="Set path to raw IFCB directory or zip/tar archive (adc, hdr, and roi files).")
     parser.add_argument('-m', '--environmental', type=str, required=True,
                         help="Set path to environmental metadata file.")
     parser.add_argument('-t', '--taxonomy', type=str, required=False,
@@ -885,12 +1845,43 @@ if __name__ == '__main__':
                         help="Force update of all data in mode ecology.")
     parser.add_argument('-u', '--update-classification', action='store_true',
                         help="Update classification data in mode ecology.")
+    parser.add_argument('--shape', type=int, nargs=2, default=[128, 128], metavar=('HEIGHT', 'WIDTH'),
+                        help="Set shape of images in mode ml-tensor.")
+    parser.add_argument('--interpolation', type=str, default='bilinear',
+                        help="Set interpolation to resize images in mode ml-tensor (nearest, bilinear, bicubic, box).")
+    parser.add_argument('--profile', type=str,
+                        help="Set path to log of time spent in each stage of each bin (jsonl).")
+    parser.add_argument('--memory-budget', type=float,
+                        help="Set maximum size of roi file loaded at once in MB (oversized bins are read in chunks).")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="Update only outputs whose inputs changed (raw bin, environmental data, classification) "
+                             "in modes ecology and ecotaxa.")
+    parser.add_argument('--daemon', type=str,
+                        help="Set address of feature daemon (ifcb_daemon.py) to extract features with warm engines, "
+                             "http://host:port or unix:///path.")
+    parser.add_argument('--selection', type=str,
+                        help="Set path to selection of images (see ifcb_sample.py) to write in modes ml-train and "
+                             "ml-tensor.")
+    parser.add_argument('--duplicates', type=int, metavar='DISTANCE',
+                        help="Find near-duplicate images (hashes within DISTANCE bits, see ifcb_duplicates.py) and add "
+                             "their DuplicateOf column in modes ml-train, ml-tensor, and ecotaxa.")
+    parser.add_argument('--drop-duplicates', action='store_true',
+                        help="Do not write near-duplicate images in modes ml-train and ecotaxa "
+                             "(requires --duplicates).")
+    parser.add_argument('--hashes', type=str,
+                        help="Set path to directory of hashes of images of each bin (see ifcb_duplicates.py).")
+    parser.add_argument('--scan', type=str,
+                        help="Check integrity of raw bins before processing them (see ifcb_scan.py), save report to "
+                             "SCAN (bins unchanged since previous scan are not checked again), and skip invalid bins.")
 
     args = parser.parse_args()
 
     # Initialize extractor based on running mode
-    extractor = BinExtractor(args.raw, args.environmental, matlab_parallel_flag=args.parallel)
-    if 'ml' not in args.mode:
+    extractor = BinExtractor(args.raw, args.environmental, matlab_parallel_flag=args.parallel,
+                             path_to_profile_log=args.profile,
+                             memory_budget=int(args.memory_budget * 2**20) if args.memory_budget else None,
+                             feature_daemon=args.daemon, path_to_hashes=args.hashes)
+    if 'ml' not in args.mode or args.mode == 'ml-train':
         if not args.ecotaxa:
             print('argument -e, --ecotaxa required')
             sys.exit(-1)
@@ -898,21 +1889,50 @@ if __name__ == '__main__':
             print('argument -t, --taxonomy required')
             sys.exit(-1)
         extractor.init_ecotaxa_classification(args.ecotaxa, args.taxonomy)
+    elif args.mode == 'ml-tensor' and args.ecotaxa and args.taxonomy:
+        extractor.init_ecotaxa_classification(args.ecotaxa, args.taxonomy)
+
+    # Scan bins present (missing bins are reported by each mode)
+    bin_list = None
+    if args.scan and args.mode in ('ml-train', 'ml-tensor', 'ml-classify-batch', 'ecotaxa', 'ecology'):
+        from ifcb_scan import scan_bins, print_report, VALID_STATUS
+        report = scan_bins(args.raw, [b for b in extractor.environmental_data['bin']
+                                      if extractor.raw.exists(b, '.roi')], args.scan)
+        print_report(report)
+        invalid = set(report.loc[~report['status'].isin(VALID_STATUS), 'bin'])
+        bin_list = [b for b in extractor.environmental_data['bin'] if b not in invalid]
+        if not bin_list:
+            print('No valid bin to process.')
+            sys.exit(-1)
+
+    selection = None
+    if args.selection and args.mode in ('ml-train', 'ml-tensor'):
+        from ifcb_sample import read_selection
+        selection = read_selection(args.selection)
 
     # Run extractor
     if args.mode == 'ml-train':
-        extractor.run_ml_train(args.output)
+        extractor.run_ml_train(args.output, bin_list, selection=selection, duplicate_distance=args.duplicates,
+                               drop_duplicates=args.drop_duplicates)
+    elif args.mode == 'ml-tensor':
+        extractor.run_tensor_cache(args.output, bin_list, shape=args.shape, interpolation=args.interpolation,
+                                   selection=selection, duplicate_distance=args.duplicates)
     elif args.mode == 'ml-classify-batch':
-        extractor.run_machine_learning(args.output)
+        extractor.run_machine_learning(args.output, bin_list)
         extractor.check_machine_learning(args.output)
     elif args.mode == 'ml-classify-rt':
         if not args.sample:
             print('argument -s, --sample required')
             sys.exit(-1)
         extractor.run_machine_learning_single_bin(args.sample, args.output)
+        extractor.profiler.report()
+    elif args.mode == 'ml-classify-watch':
+        extractor.run_machine_learning_watch(args.output)
     elif args.mode == 'ecotaxa':
-        extractor.run_ecotaxa(args.output)
+        extractor.run_ecotaxa(args.output, bin_list, incremental=args.incremental, duplicate_distance=args.duplicates,
+                              drop_duplicates=args.drop_duplicates)
     elif args.mode == 'ecology':
-        extractor.run_science(args.output, update_all=args.force, update_classification=args.update_classification)
+        extractor.run_science(args.output, bin_list, update_all=args.force,
+                              update_classification=args.update_classification, incremental=args.incremental)
     else:
         print('mode not supported.')
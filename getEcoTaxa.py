@@ -6,18 +6,40 @@ import datetime
 import os
 import zipfile
 import getpass
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from time import sleep
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+ECOTAXA_URL = 'https://ecotaxa.obs-vlfr.fr'
 MAXQUEUESIZE = 5
+MAXDOWNLOADS = 2
+POLL_MIN_INTERVAL = 2     # seconds
+POLL_MAX_INTERVAL = 60    # seconds
+CHUNK_SIZE = 2**20        # bytes
+PARTIAL_FOLDER = 'EcoTaxa_partial'  # Interrupted downloads (<id>.zip.part) and their export task (<id>.task)
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+
+def makeSession(pool_size=MAXQUEUESIZE):
+    # Session with a connection pool large enough for concurrent downloads and task polling
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 def loginUser(session, usr, auth=None):
-    url = "https://ecotaxa.obs-vlfr.fr/login"
+    url = ECOTAXA_URL + "/login"
     csrfpage = session.get(url, verify=False)
-    soup = BeautifulSoup(csrfpage.content, 'html5lib')
+    soup = BeautifulSoup(csrfpage.content, HTML_PARSER)
     csrftoken = soup.find('input', attrs={'name': 'csrf_token'})['value']
     if auth is not None:
         pw = auth
@@ -30,8 +52,8 @@ def loginUser(session, usr, auth=None):
                  "password": pw
                  }
     session.post(url, data=logincred, verify=False)
-    cfmloginpage = session.get("https://ecotaxa.obs-vlfr.fr", verify=False)
-    soup = BeautifulSoup(cfmloginpage.content, 'html5lib')
+    cfmloginpage = session.get(ECOTAXA_URL, verify=False)
+    soup = BeautifulSoup(cfmloginpage.content, HTML_PARSER, parse_only=SoupStrainer('a'))
     logstat = soup.find('a', attrs={'href':'/logout'})
     if logstat is not None:
         print("Log-in of "+usr+" successful!")
@@ -79,9 +101,9 @@ def recursiveRemove(given, match):
     return given
 
 def fetchIDs(session, ids=None):
-    url = "https://ecotaxa.obs-vlfr.fr/prj/"
+    url = ECOTAXA_URL + "/prj/"
     projpage = session.get(url, verify=False)
-    soup = BeautifulSoup(projpage.content, 'html5lib')
+    soup = BeautifulSoup(projpage.content, HTML_PARSER, parse_only=SoupStrainer('a'))
     projects = soup.find_all('a', attrs={'class': 'btn btn-primary'})
     projids = []
     for i in projects:
@@ -96,27 +118,70 @@ def fetchIDs(session, ids=None):
             return ids
 
 
-def fetchFile(session, export):
-    url = 'https://ecotaxa.obs-vlfr.fr/Task/Show/' + str(export[1])
+def downloadFile(session, url, filename, attempts=3, part=None):
+    """ Stream url to filename in chunks, resuming partial download (part, default filename.part) with http range
+    requests """
+    part = filename + '.part' if part is None else part
+    for attempt in range(attempts):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, verify=False) as file:
+                if file.status_code == 416:  # Range not satisfiable: partial download is already complete
+                    break
+                file.raise_for_status()
+                mode = 'ab' if offset and file.status_code == 206 else 'wb'  # Restart if range not supported
+                with open(part, mode) as code:
+                    for chunk in file.iter_content(CHUNK_SIZE):
+                        code.write(chunk)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == attempts - 1:
+                raise
+            print("Download interrupted (" + str(e) + "), resuming...")
+    os.replace(part, filename)
+
+
+def extractFile(filename):
+    with zipfile.ZipFile(filename, 'r') as zip_ref:
+        zip_ref.extractall(os.path.dirname(filename))
+    os.remove(filename)
+    print("Extraction of " + os.path.basename(filename) + " complete!")
+
+
+def convertFile(filename):
+    # Convert each tsv of the export into a classification table (feather) without extracting the archive
+    from extractIFCBdata import read_ecotaxa_classification
+    with zipfile.ZipFile(filename, 'r') as zip_ref:
+        for member in zip_ref.namelist():
+            if not member.endswith('.tsv'):
+                continue
+            with zip_ref.open(member) as tsv:
+                data = read_ecotaxa_classification(tsv)
+            data.to_feather(os.path.join(os.path.dirname(filename),
+                                         os.path.splitext(os.path.basename(member))[0] + '.feather'))
+    os.remove(filename)
+    print("Conversion of " + os.path.basename(filename) + " complete!")
+
+
+def fetchFile(session, export, path='.', part=None):
+    # returns path to zip file downloaded, resuming partial download part (if any)
+    url = ECOTAXA_URL + '/Task/Show/' + str(export[1])
     taskpage = session.get(url, verify=False)
-    soup = BeautifulSoup(taskpage.content, 'html5lib')
+    soup = BeautifulSoup(taskpage.content, HTML_PARSER, parse_only=SoupStrainer('a'))
     rawname = soup.find('a', attrs={'href': '/prj/'+str(export[0])})
-    folder = parsePrjName(rawname)
-    os.mkdir(folder)
-    os.chdir(folder)
+    folder = os.path.join(path, parsePrjName(rawname))
+    os.makedirs(folder, exist_ok=True)
     rawfile = soup.find('a', attrs={'class': 'btn btn-primary btn-sm'})
     filename = parseFileName(rawfile)
-    file = session.get('https://ecotaxa.obs-vlfr.fr/Task/GetFile/'+str(export[1])+'/'+filename)
-    with open(filename,'wb') as code:
-        code.write(file.content)
-    with zipfile.ZipFile(filename, 'r') as zip_ref:
-        zip_ref.extractall()
-    os.remove(filename)
-    print("Download & extraction complete!")
+    downloadFile(session, ECOTAXA_URL + '/Task/GetFile/'+str(export[1])+'/'+filename, os.path.join(folder, filename),
+                 part=part)
+    print("Download of project " + str(export[0]) + " complete!")
+    return os.path.join(folder, filename)
 
 
 def startTask(session, id):
-    url = "https://ecotaxa.obs-vlfr.fr/Task/Create/TaskExportTxt?projid=" + str(id)
+    url = ECOTAXA_URL + "/Task/Create/TaskExportTxt?projid=" + str(id)
     downprops = {
         'exportimagesdoi': '',
         'splitcsvby': '',
@@ -125,58 +190,91 @@ def startTask(session, id):
         'what': 'TSV'
     }
     infopage = session.post(url, data = downprops, verify = False)
-    soup = BeautifulSoup(infopage.content, 'html5lib')
+    soup = BeautifulSoup(infopage.content, HTML_PARSER, parse_only=SoupStrainer('div'))
     subtaskraw = soup.find_all('div', attrs={'class':'alert alert-success alert-dismissible'})
     return parseSubtask(subtaskraw)
 
-def newQueueElement(session, id):
+def taskExists(session, task):
+    taskpage = session.get(ECOTAXA_URL + '/Task/listall', verify=False)
+    soup = BeautifulSoup(taskpage.content, HTML_PARSER, parse_only=SoupStrainer('a'))
+    return soup.find('a', attrs={'href': '/Task/Show/' + str(task)}) is not None
+
+def newQueueElement(session, id, partial=None):
     # returns tuple of id, task
+    # the export task of an interrupted download (saved in partial folder) is reused to resume the download of the
+    # same file, a new export would differ from the bytes already downloaded
+    taskfile = os.path.join(partial, str(id) + '.task') if partial else None
+    if taskfile and os.path.exists(taskfile):
+        with open(taskfile) as f:
+            task = int(f.read())
+        if taskExists(session, task):
+            print("Resuming export of project " + str(id) + " from task " + str(task))
+            return (id, task)
     task = startTask(session, id)
     print("Exporting project " + str(id) + " as task " + str(task))
+    if taskfile:
+        part = os.path.join(partial, str(id) + '.zip.part')
+        if os.path.exists(part):
+            os.remove(part)  # Download of an export removed from server
+        with open(taskfile, 'w') as f:
+            f.write(str(task))
     return (id,task)
 
-def downloadProjs(session, idlist, path=None):
-    url = 'https://ecotaxa.obs-vlfr.fr/Task/listall'
+def downloadProjs(session, idlist, path=None, columnar=False):
+    url = ECOTAXA_URL + '/Task/listall'
 
     # queue of tuples w/ structure (id, task)
     activequeue = []
-
-    # setup queue
-    if len(idlist) > MAXQUEUESIZE:
-        for i in range(MAXQUEUESIZE):
-            activequeue.append(newQueueElement(session, idlist[i]))
-
-        del idlist[:MAXQUEUESIZE]
-    else:
-        for i in idlist:
-            activequeue.append(newQueueElement(session, i))
-        idlist = []
+    idlist = list(idlist)
 
     dt = datetime.datetime.now()
-    folder = "EcoTaxa_" + dt.strftime("%Y%m%d_%H%M%S")
-    os.mkdir(folder)
-    os.chdir(folder)
-    homedir = os.getcwd()
-    while True:
-        taskpage = session.get(url, verify=False)
-        soup = BeautifulSoup(taskpage.content, 'html5lib')
-        for item in activequeue:
-            print('Pinging project '+str(item[0])+ '\'s status')
-            rawstatus = soup.find_all('a', attrs={'href': ('/Task/Show/'+str(item[1]))})
-            if "Done" in str(rawstatus[1]):
-                print("Task "+str(item[1])+' completed, downloading...')
-                fetchFile(session, item)
-                print("Removing task from Ecotaxa server")
-                session.get('https://ecotaxa.obs-vlfr.fr/Task/Clean/'+str(item[1]))
-                activequeue.remove(item)
-                os.chdir(homedir)
-        if len(idlist) > 0 and len(activequeue) < MAXQUEUESIZE:
-            activequeue.append(newQueueElement(session, idlist.pop(0)))
-        if len(activequeue) == 0:
-            return
-        else:
-            sleep(2)
+    folder = os.path.join(path if path else '.', "EcoTaxa_" + dt.strftime("%Y%m%d_%H%M%S"))
+    os.makedirs(folder, exist_ok=True)
+    # Partial downloads are kept in a folder independent of the run to be resumed by the next run
+    partial = os.path.join(path if path else '.', PARTIAL_FOLDER)
+    os.makedirs(partial, exist_ok=True)
 
+    def fetchAndExtract(item):
+        filename = fetchFile(session, item, folder, os.path.join(partial, str(item[0]) + '.zip.part'))
+        print("Removing task from Ecotaxa server")
+        session.get(ECOTAXA_URL + '/Task/Clean/'+str(item[1]), verify=False)
+        os.remove(os.path.join(partial, str(item[0]) + '.task'))
+        # Extract while other exports are downloaded
+        return extractions.submit(convertFile if columnar else extractFile, filename)
+
+    # downloads and extractions run in background while polling for other tasks
+    # downloads are shut down first so none is left waiting on (or submitting to) a stopped extraction worker
+    jobs = []
+    with ThreadPoolExecutor(1) as extractions:
+        with ThreadPoolExecutor(MAXDOWNLOADS) as downloads:
+            try:
+                delay = POLL_MIN_INTERVAL
+                while True:
+                    while len(idlist) > 0 and len(activequeue) < MAXQUEUESIZE:
+                        activequeue.append(newQueueElement(session, idlist.pop(0), partial))
+                    if len(activequeue) == 0:
+                        break
+                    sleep(delay)
+                    taskpage = session.get(url, verify=False)
+                    soup = BeautifulSoup(taskpage.content, HTML_PARSER, parse_only=SoupStrainer('a'))
+                    done = False
+                    for item in list(activequeue):
+                        print('Pinging project '+str(item[0])+ '\'s status')
+                        rawstatus = soup.find_all('a', attrs={'href': ('/Task/Show/'+str(item[1]))})
+                        if "Done" in str(rawstatus[1]):
+                            print("Task "+str(item[1])+' completed, downloading...')
+                            jobs.append(downloads.submit(fetchAndExtract, item))
+                            activequeue.remove(item)
+                            done = True
+                    # Poll less often while exports are running on server
+                    delay = POLL_MIN_INTERVAL if done else min(2 * delay, POLL_MAX_INTERVAL)
+            except BaseException:
+                downloads.shutdown(cancel_futures=True)
+                raise
+        for job in jobs:
+            job.result().result()  # Raise download or extraction error (if any)
+    if not os.listdir(partial):
+        os.rmdir(partial)
 
 if __name__ == "__main__":
     # Command line arguments
@@ -202,19 +300,32 @@ if __name__ == "__main__":
         required =False,
         help='<optional> Provide EcoTaxa password through command line. Not recommended.'
     )
+    parser.add_argument(
+        '-c', '--columnar',
+        action='store_true',
+        help='<optional> Convert exports to classification tables (feather) used by extractIFCBdata.py '
+             'instead of extracting tsv files.'
+    )
+    parser.add_argument(
+        '--url',
+        required=False,
+        default=ECOTAXA_URL,
+        help='<optional> Set URL of EcoTaxa server (default ' + ECOTAXA_URL + ').'
+    )
 
     args = parser.parse_args()
 
     print(args.ids)
 
-    if not os.path.isdir(args.path):
+    if args.path and not os.path.isdir(args.path):
         print("Error: Path to download directory does not exist.")
         sys.exit()
+    ECOTAXA_URL = args.url.rstrip('/')
 
-    with requests.Session() as r:
+    with makeSession() as r:
         loginUser(r, args.user, args.authorization)
         fetched_ids = fetchIDs(r, args.ids)
         if fetched_ids is None:
             print('Error: No matching project.')
             sys.exit()
-        downloadProjs(r, fetched_ids, args.path)
+        downloadProjs(r, fetched_ids, args.path, args.columnar)
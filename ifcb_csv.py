@@ -0,0 +1,208 @@
+"""
+Write DataFrames to csv/tsv byte for byte like DataFrame.to_csv, formatting each column at once with numpy:
+    + floats with float_format '%.<n>f' are rounded to integers and assembled digit by digit
+    + integers are assembled digit by digit
+    + text, boolean, and categorical columns are formatted once per unique value
+    + dates are formatted with date_format
+Each column is a matrix of bytes (one row per line) with a mask of the bytes to keep, the lines are the concatenation
+of the masked bytes of all columns. Values that cannot be rounded exactly in double precision (ties after scaling)
+are formatted with python like pandas does. Tables that are not supported (e.g. other float_format) are written
+with DataFrame.to_csv.
+"""
+import csv
+import io
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+FLOAT_FORMAT = re.compile(r'^%\.(\d)f$')
+MAX_EXACT = 2.0 ** 50  # Larger scaled floats or integers are formatted with python
+POWERS = 10 ** np.arange(16, dtype=np.int64)
+DIGITS4 = np.frombuffer(''.join(f'{i:04d}' for i in range(10000)).encode(), dtype=np.uint32)  # 4 digits per item
+
+
+def _text_block(strings):
+    """ Return bytes matrix and mask of an array of python str """
+    encoded = [s.encode() for s in strings]
+    lengths = np.fromiter((len(s) for s in encoded), dtype=np.int64, count=len(encoded))
+    width = int(lengths.max()) if len(encoded) else 0
+    block = np.frombuffer(b''.join(s.ljust(width) for s in encoded), dtype=np.uint8).reshape(len(encoded), width)
+    return block, np.arange(width) < lengths[:, None]
+
+
+def _quote(s, sep):
+    """ Quote field like csv.QUOTE_MINIMAL """
+    return f'"{s.replace(chr(34), chr(34) * 2)}"' if any(c in s for c in (sep, '"', '\r', '\n')) else s
+
+
+def _override(block, mask, rows, strings):
+    """ Replace values of rows by strings (appended as extra bytes) """
+    if not len(rows):
+        return block, mask
+    extra_block, extra_mask = _text_block(strings)
+    extra = np.zeros((len(block), extra_block.shape[1]), dtype=np.uint8)
+    extra_valid = np.zeros(extra.shape, dtype=bool)
+    extra[rows], extra_valid[rows] = extra_block, extra_mask
+    mask[rows] = False
+    return np.hstack((block, extra)), np.hstack((mask, extra_valid))
+
+
+def _groups(values, width):
+    """ Return bytes matrix of the last width digits of non-negative integers (looked up 4 digits at a time) """
+    n_groups = -(-width // 4)
+    groups = np.empty((len(values), n_groups), dtype=DIGITS4.dtype)
+    for g in range(n_groups - 1, -1, -1):
+        values, group = np.divmod(values, 10000)
+        groups[:, g] = DIGITS4[group]
+    return groups.view(np.uint8)[:, 4 * n_groups - width:]
+
+
+def _digits(values, n_decimals=0, negative=None):
+    """ Return bytes matrix and mask of integers (absolute value < MAX_EXACT) with a decimal point before n digits """
+    integer, fraction = np.divmod(values, 10 ** n_decimals)
+    n_digits = np.maximum(np.searchsorted(POWERS, integer, side='right'), 1)
+    width = int(n_digits.max()) if len(values) else 1
+    # Sign, integer digits, decimal point, and decimals
+    block = np.empty((len(values), 1 + width + (n_decimals + 1 if n_decimals else 0)), dtype=np.uint8)
+    mask = np.ones(block.shape, dtype=bool)
+    block[:, 0], mask[:, 0] = ord('-'), negative if negative is not None else False
+    block[:, 1:width + 1] = _groups(integer, width)
+    mask[:, 1:width + 1] = np.arange(width, 0, -1) <= n_digits[:, None]
+    if n_decimals:
+        block[:, width + 1] = ord('.')
+        block[:, width + 2:] = _groups(fraction, n_decimals)
+    return block, mask
+
+
+def _format_float(values, float_format, n_decimals, na_rep):
+    values = values.astype(np.float64, copy=False)
+    finite = np.isfinite(values)
+    scaled = np.where(finite, np.abs(values), 0) * 10.0 ** n_decimals
+    rounded = np.rint(scaled)
+    # Multiplication by 10^n is off by half an ulp at most, rounding is exact unless scaled is close to a tie
+    fraction = scaled - np.floor(scaled)
+    inexact = finite & ((np.abs(fraction - 0.5) <= 4 * np.spacing(scaled)) | (scaled >= MAX_EXACT))
+    rounded[inexact | ~finite] = 0
+    block, mask = _digits(rounded.astype(np.int64), n_decimals, np.signbit(values) & finite)
+    rows = np.flatnonzero(inexact | ~finite)
+    strings = [na_rep if v != v else float_format % v for v in values[rows]]
+    return _override(block, mask, rows, strings)
+
+
+def _format_int(values):
+    if len(values) and (values.max() >= MAX_EXACT or values.min() <= -MAX_EXACT):
+        return _format_text(values.astype(object), '', '')
+    return _digits(np.abs(values.astype(np.int64)), negative=values < 0)
+
+
+def _format_text(values, na_rep, sep):
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    block, mask = _text_block([_quote(na_rep, sep)] + [_quote(str(u), sep) for u in uniques])
+    return block[codes + 1], mask[codes + 1]
+
+
+def _format_column(column, sep, na_rep, float_format, date_format):
+    """ Return bytes matrix and mask of column, None if not supported """
+    dtype = column.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy()
+        block, mask = _text_block([_quote(na_rep, sep)] + [_quote(str(u), sep) for u in column.cat.categories])
+        return block[codes + 1], mask[codes + 1]
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        if date_format is None:
+            return None
+        return _format_text(column.dt.strftime(date_format).to_numpy(dtype=object), na_rep, sep)
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype) and not isinstance(dtype, pd.StringDtype):
+        return None
+    if dtype.kind == 'f':
+        if float_format is None:
+            return None
+        return _format_float(column.to_numpy(), float_format, int(FLOAT_FORMAT.match(float_format).group(1)), na_rep)
+    if dtype.kind in 'iu':
+        return _format_int(column.to_numpy())
+    if dtype.kind in 'bOU' or isinstance(dtype, pd.StringDtype):
+        return _format_text(column.to_numpy(dtype=object), na_rep, sep)
+    return None
+
+
+def _header(data, sep, index, index_label):
+    """ Return header lines like DataFrame.to_csv """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=sep, lineterminator=os.linesep, quoting=csv.QUOTE_MINIMAL)
+    if isinstance(data.columns, pd.MultiIndex):
+        for level in range(data.columns.nlevels):
+            writer.writerow(data.columns.get_level_values(level))
+    else:
+        label = [index_label if index_label is not None else (data.index.name or '')] if index else []
+        writer.writerow(label + list(data.columns))
+    return buffer.getvalue()
+
+
+def _supported(data, float_format, index):
+    if float_format is not None and not FLOAT_FORMAT.match(float_format):
+        return False
+    if isinstance(data.index, pd.MultiIndex) and index:
+        return False
+    if isinstance(data.columns, pd.MultiIndex) and index:
+        return False
+    # csv quotes the only field of a line if empty
+    return len(data.columns) + int(index) > 1
+
+
+def _lines(data, sep, na_rep, float_format, index, date_format):
+    """ Return lines of data (without header) as bytes, None if not supported """
+    n = len(data.index)
+    columns = ([data.index.to_series(index=range(n))] if index else []) + \
+              [data.iloc[:, j] for j in range(len(data.columns))]
+    blocks, masks = [], []
+    separator = np.frombuffer(sep.encode(), dtype=np.uint8)
+    for j, column in enumerate(columns):
+        formatted = _format_column(column, sep, na_rep, float_format, date_format)
+        if formatted is None:
+            return None
+        if j:
+            blocks.append(np.broadcast_to(separator, (n, len(separator))))
+            masks.append(np.ones((n, len(separator)), dtype=bool))
+        blocks.append(formatted[0])
+        masks.append(formatted[1])
+    terminator = np.frombuffer(os.linesep.encode(), dtype=np.uint8)
+    blocks.append(np.broadcast_to(terminator, (n, len(terminator))))
+    masks.append(np.ones((n, len(terminator)), dtype=bool))
+    return np.compress(np.hstack(masks).ravel(), np.hstack(blocks).ravel()).tobytes()
+
+
+def write_csv(data, path_or_buf, sep=',', na_rep='', float_format=None, index=True, index_label=None, header=True,
+              date_format=None, chunk_size=50000):
+    """
+    Write DataFrame to csv like data.to_csv(path_or_buf, sep, na_rep, float_format, index=index,
+    index_label=index_label, header=header, date_format=date_format) but faster
+
+    :param path_or_buf: file name or open file (text or binary)
+    :param chunk_size: number of lines formatted at once (bounds memory)
+    """
+    if isinstance(path_or_buf, (str, os.PathLike)):
+        with open(path_or_buf, 'wb') as f:
+            return write_csv(data, f, sep, na_rep, float_format, index, index_label, header, date_format, chunk_size)
+    binary = not isinstance(path_or_buf, io.TextIOBase)
+    kwargs = dict(sep=sep, na_rep=na_rep, float_format=float_format, index=index, index_label=index_label,
+                  date_format=date_format)
+    if not _supported(data, float_format, index):
+        if binary:
+            # pandas handles encoding of binary buffers
+            data.to_csv(path_or_buf, header=header, **kwargs)
+        else:
+            path_or_buf.write(data.to_csv(header=header, **kwargs))
+        return
+    if header:
+        text = _header(data, sep, index, index_label)
+        path_or_buf.write(text.encode() if binary else text)
+    for i in range(0, len(data.index), chunk_size):
+        chunk = data.iloc[i:i + chunk_size]
+        lines = _lines(chunk, sep, na_rep, float_format, index, date_format)
+        if lines is None:
+            text = chunk.to_csv(header=False, **kwargs)
+            path_or_buf.write(text.encode() if binary else text)
+        else:
+            path_or_buf.write(lines if binary else lines.decode())
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Feature extraction daemon keeping warm engines (MATLAB or native) between bins
+
+Starting a MATLAB engine takes 10 to 30 seconds. The daemon starts its engines once and serves bins over localhost
+HTTP or a Unix domain socket, so short jobs (real-time bins, reprocessing) share warm engines:
+    ./ifcb_daemon.py -n 2                               # serve on http://127.0.0.1:8642
+    ./extractIFCBdata.py ... --daemon http://127.0.0.1:8642 ml-classify-rt
+
+Endpoints:
+    POST /features  {"path_to_bin": ..., "bin": ..., "version": "v4", "level": 1, "minimal": false}
+                    returns features of bin in npy format (structured array with one field per column)
+    GET  /status    engines, queue, and configuration (json)
+    GET  /metrics   counters in Prometheus text format
+
+Requests are queued (up to max_queue, 503 when full) and each engine takes one bin at a time, identical requests
+waiting in the queue share the same extraction.
+"""
+
+import argparse
+import http.client
+import importlib
+import io
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time, perf_counter
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from extractIFCBdata import BinExtractor, IFCBTools, CorruptedBin, start_matlab_engine, __version__
+
+DEFAULT_ADDRESS = 'http://127.0.0.1:8642'
+FEATURE_VERSIONS = ('v2', 'v4')
+
+
+class Job:
+    """ Request of features of one bin, result is set by an engine (shared by n_requests identical requests) """
+
+    def __init__(self, path_to_bin, bin_name, version='v4', level=1, minimal=False):
+        if version not in FEATURE_VERSIONS:
+            raise ValueError(f'Feature version must be one of {FEATURE_VERSIONS}.')
+        self.key = (path_to_bin, bin_name, version, int(level), bool(minimal))
+        self.result, self.error = None, None
+        self.n_requests = 1
+        self.done = threading.Event()
+
+
+class FeatureDaemon:
+    """
+    Pool of warm feature engines processing queued requests
+
+    :param n_engines: number of engines (bins extracted concurrently)
+    :param max_queue: maximum number of requests waiting (further requests are rejected)
+    :param extractor_class: BinExtractor subclass computing features natively (None: BinExtractor with MATLAB engines
+        started with the daemon)
+    """
+
+    def __init__(self, n_engines=1, max_queue=64, matlab_parallel_flag=False, extractor_class=None):
+        self.n_engines = n_engines
+        self.max_queue = max_queue
+        self.matlab_parallel_flag = matlab_parallel_flag
+        self.extractor_class = extractor_class
+        self.jobs = queue.Queue(max_queue)
+        self.waiting = dict()  # Jobs queued by key (identical requests are deduplicated at submit)
+        self.engines = [{'id': i, 'state': 'starting', 'bin': None, 'since': time(), 'bins': 0, 'starts': 0}
+                        for i in range(n_engines)]
+        self.metrics = {'requests_total': 0, 'requests_rejected_total': 0, 'requests_failed_total': 0,
+                        'bins_extracted_total': 0, 'bins_deduplicated_total': 0,
+                        'extraction_seconds_total': 0., 'engine_starts_total': 0}
+        self.lock = threading.Lock()
+        self.started_at = time()
+        self.workers = [threading.Thread(target=self._work, args=(e,), daemon=True) for e in self.engines]
+        for w in self.workers:
+            w.start()
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.metrics[name] += value
+
+    def _new_extractor(self, engine):
+        engine['state'], engine['since'] = 'starting', time()
+        try:
+            if self.extractor_class is None:
+                extractor = BinExtractor(None, matlab_engine=start_matlab_engine(),
+                                         matlab_parallel_flag=self.matlab_parallel_flag)
+            else:
+                extractor = self.extractor_class(None, matlab_parallel_flag=self.matlab_parallel_flag)
+        except Exception as e:
+            engine['state'] = 'failed'
+            raise IFCBTools(f'Engine {engine["id"]} failed to start: {e}')
+        engine['starts'] += 1
+        self._count('engine_starts_total')
+        return extractor
+
+    def _work(self, engine):
+        extractor = None
+        while True:
+            if extractor is None:
+                try:  # Start engine before next request
+                    extractor = self._new_extractor(engine)
+                except IFCBTools as e:
+                    print(e)
+            if extractor is not None:
+                engine['state'], engine['bin'], engine['since'] = 'idle', None, time()
+            job = self.jobs.get()
+            if job is None:
+                return
+            with self.lock:  # Identical requests submitted from now on are extracted again
+                del self.waiting[job.key]
+            path_to_bin, bin_name, version, level, minimal = job.key
+            engine['state'], engine['bin'], engine['since'] = 'busy', bin_name, time()
+            result, error = None, None
+            t0 = perf_counter()
+            try:
+                if extractor is None:
+                    extractor = self._new_extractor(engine)
+                extractor.path_to_bin = path_to_bin
+                if version == 'v2':
+                    result = extractor.extract_features_v2(bin_name, minimal_feature_flag=minimal)
+                else:
+                    result = extractor.extract_features_v4(bin_name, level=level)
+            except (IFCBTools, FileNotFoundError) as e:
+                error = e
+            except Exception as e:
+                # Engine might be in a bad state (e.g. MATLAB crashed), start a new one for next request
+                print(f'Engine {engine["id"]}: {bin_name}: {type(e).__name__}: {e}')
+                extractor, error = None, e  # BinExtractor.__del__ quits MATLAB engine
+            self._count('extraction_seconds_total', perf_counter() - t0)
+            if error is None:
+                self._count('bins_extracted_total')
+            else:
+                self._count('requests_failed_total', job.n_requests)
+            engine['bins'] += 1
+            job.result, job.error = result, error
+            job.done.set()
+
+    def submit(self, job):
+        """
+        Queue job and return it, or return the identical job already waiting (to wait for instead).
+        Raise queue.Full if max_queue requests are waiting.
+        """
+        with self.lock:
+            self.metrics['requests_total'] += 1
+            waiting = self.waiting.get(job.key)
+            if waiting is not None:
+                waiting.n_requests += 1
+                self.metrics['bins_deduplicated_total'] += 1
+                return waiting
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                self.metrics['requests_rejected_total'] += 1
+                raise
+            self.waiting[job.key] = job
+        return job
+
+    def extract_features(self, path_to_bin, bin_name, version='v4', level=1, minimal=False):
+        """ Queue request and wait for its features (same as BinExtractor.extract_features_*) """
+        job = self.submit(Job(path_to_bin, bin_name, version, level, minimal))
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def status(self):
+        return {'version': __version__, 'pid': os.getpid(), 'uptime': time() - self.started_at,
+                'n_engines': self.n_engines, 'max_queue': self.max_queue,
+                'queue': self.jobs.qsize(),
+                'engines': [{**e, 'since': time() - e['since']} for e in self.engines]}
+
+    def prometheus_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['queue_depth'] = self.jobs.qsize()
+        metrics['engines_busy'] = sum(e['state'] == 'busy' for e in self.engines)
+        metrics['engines_up'] = sum(e['state'] in ('idle', 'busy') for e in self.engines)
+        return ''.join(f'ifcb_daemon_{k} {v}\n' for k, v in metrics.items())
+
+    def close(self):
+        """ Stop engines once the requests queued are processed """
+        for _ in self.workers:
+            self.jobs.put(None)
+        for w in self.workers:
+            w.join()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'ifcb-daemon/' + __version__
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def send(self, code, body, content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send(200, self.server.feature_daemon.status())
+        elif self.path == '/metrics':
+            self.send(200, self.server.feature_daemon.prometheus_metrics(), 'text/plain; version=0.0.4')
+        else:
+            self.send(404, {'error': f'Unknown endpoint {self.path}', 'type': 'NotFound'})
+
+    def do_POST(self):
+        if self.path != '/features':
+            self.send(404, {'error': f'Unknown endpoint {self.path}', 'type': 'NotFound'})
+            return
+        try:
+            r = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = Job(r['path_to_bin'], r['bin'], r.get('version', 'v4'), r.get('level', 1), r.get('minimal', False))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send(400, {'error': f'Invalid request: {e}', 'type': 'ValueError'})
+            return
+        try:
+            job = self.server.feature_daemon.submit(job)
+        except queue.Full:
+            self.send(503, {'error': 'Too many requests queued', 'type': 'Busy'}, headers={'Retry-After': '5'})
+            return
+        job.done.wait()
+        if job.error is not None:
+            e = job.error
+            code = 404 if isinstance(e, FileNotFoundError) else 422 if isinstance(e, IFCBTools) else 500
+            self.send(code, {'error': str(e), 'type': type(e).__name__})
+            return
+        buffer = io.BytesIO()
+        np.save(buffer, job.result.reset_index().to_records(index=False), allow_pickle=False)
+        self.send(200, buffer.getvalue(), 'application/x-npy')
+
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):  # Not available on Windows
+    class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def serve(daemon, address=DEFAULT_ADDRESS):
+    """ Serve daemon on address (http://host:port or unix:///path/to/socket) until interrupted """
+    url = urlparse(address)
+    if url.scheme == 'unix':
+        if os.path.exists(url.path):
+            os.remove(url.path)  # Stale socket
+        server = UnixHTTPServer(url.path, RequestHandler)
+    else:
+        server = HTTPServer((url.hostname or '127.0.0.1', url.port or 8642), RequestHandler)
+    server.feature_daemon = daemon
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f'Serving {daemon.n_engines} engine(s) on {address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if url.scheme == 'unix' and os.path.exists(url.path):
+            os.remove(url.path)
+        daemon.close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost')
+        self.socket_path, self.socket_timeout = path, timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.socket_timeout)
+        self.sock.connect(self.socket_path)
+
+
+class FeatureClient:
+    """
+    Client of FeatureDaemon, used by BinExtractor in place of a MATLAB engine
+
+    :param address: http://host:port or unix:///path/to/socket
+    :param timeout: seconds to wait for a response (None: wait until bin is extracted)
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        self.address = address
+        self.url = urlparse(address)
+        self.timeout = timeout
+
+    def request(self, method, endpoint, body=None):
+        if self.url.scheme == 'unix':
+            connection = UnixHTTPConnection(self.url.path, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 8642, timeout=self.timeout)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            connection.request(method, endpoint, json.dumps(body) if body is not None else None, headers)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            error = json.loads(data)
+            if response.status == 404 and error['type'] == 'FileNotFoundError':
+                raise FileNotFoundError(error['error'])
+            if error['type'] == 'CorruptedBin':
+                raise CorruptedBin(error['error'])
+            raise IFCBTools(f"Feature daemon: {error['type']}: {error['error']}")
+        return data
+
+    def extract_features(self, path_to_bin, bin_name, version='v4', level=1, minimal=False):
+        """ Return features of bin indexed by ImageId (same as BinExtractor.extract_features_*) """
+        data = self.request('POST', '/features', {'path_to_bin': os.path.abspath(path_to_bin), 'bin': bin_name,
+                                                  'version': version, 'level': level, 'minimal': minimal})
+        features = pd.DataFrame(np.load(io.BytesIO(data), allow_pickle=False))
+        return features.set_index('ImageId')
+
+    def status(self):
+        return json.loads(self.request('GET', '/status'))
+
+    def metrics(self):
+        return self.request('GET', '/metrics').decode()
+
+
+def import_class(name):
+    """ Import class from module:Class """
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve feature extraction with warm engines.')
+    parser.add_argument('-a', '--address', type=str, default=DEFAULT_ADDRESS,
+                        help=f'Set address to listen to, http://host:port or unix:///path (default {DEFAULT_ADDRESS}).')
+    parser.add_argument('-n', '--engines', type=int, default=1, help='Set number of engines.')
+    parser.add_argument('--max-queue', type=int, default=64, help='Set maximum number of requests waiting.')
+    parser.add_argument('-p', '--parallel', action='store_true', help='Enable Matlab parallel processing.')
+    parser.add_argument('--extractor', type=str,
+                        help='Set BinExtractor subclass extracting features natively (module:Class).')
+    args = parser.parse_args()
+
+    serve(FeatureDaemon(args.engines, args.max_queue, args.parallel,
+                        import_class(args.extractor) if args.extractor else None), args.address)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Find near-duplicate images (flushes, bubbles, stuck particles) within and across bins with a perceptual hash:
+    + dHash of each ROI: image averaged in 8 x 9 blocks, a bit is set if a block is brighter than its left neighbour
+      (64 bits), computed at once for all ROIs of same size
+    + hashes are stored per bin (<bin>_dhash.npz with the fingerprint of the raw bin) by BinExtractor if path_to_hashes
+      is set, while extracting images (extract_images_and_cytometry) or on demand (bin_hashes)
+    + near-duplicates are found with a multi-index Hamming search: hashes are split in max_distance + 1 bands, two
+      hashes within max_distance bits share at least one band, so only hashes sharing a band are compared
+    + the first image of a group of near-duplicates (in order of bins processed) is kept, the others are DuplicateOf it
+    ./ifcb_duplicates.py -r raw/ -m metadata.csv -o duplicates.csv --hashes hashes/
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+MAX_DISTANCE = 4  # bits
+HASH_SHAPE = (8, 9)  # rows, columns of blocks (8 x 8 differences)
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _block_means(stack, n, axis):
+    """ Mean of n blocks of stack along axis (blocks of 1 pixel repeated if axis is shorter than n) """
+    size = stack.shape[axis]
+    starts = (np.arange(n) * size) // n
+    sums = np.add.reduceat(stack, starts, axis=axis, dtype=np.float64)
+    counts = np.maximum(np.diff(np.r_[starts, size]), 1)
+    return sums / counts.reshape([-1 if a == axis else 1 for a in range(stack.ndim)])
+
+
+def dhash(images):
+    """ dHash (uint64) of each image (2D uint8 array), images of same size are hashed together """
+    images = list(images)
+    hashes = np.zeros(len(images), dtype=np.uint64)
+    shapes = dict()
+    for i, img in enumerate(images):
+        shapes.setdefault(img.shape, []).append(i)
+    for rows in shapes.values():
+        stack = np.stack([images[i] for i in rows])
+        blocks = _block_means(_block_means(stack, HASH_SHAPE[0], 1), HASH_SHAPE[1], 2)
+        bits = (blocks[:, :, 1:] > blocks[:, :, :-1]).reshape(len(rows), -1)
+        hashes[rows] = np.packbits(bits, axis=1).view('>u8').ravel()
+    return hashes
+
+
+def hamming(a, b):
+    """ Number of bits different between hashes a and b """
+    x = np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))
+    return POPCOUNT[np.ascontiguousarray(x).view(np.uint8)].reshape(*x.shape, 8).sum(axis=-1)
+
+
+def object_ids(bin_name, image_ids):
+    """ Id of images as in EcoTaxa and ML exports: <bin>_<image id> """
+    return bin_name + '_' + pd.Index(image_ids).astype(str).str.zfill(5)
+
+
+def save_hashes(filename, image_ids, hashes, fingerprint=''):
+    np.savez(filename, ImageId=np.asarray(image_ids, dtype=np.uint32), DHash=np.asarray(hashes, dtype=np.uint64),
+             fingerprint=np.array(fingerprint))
+
+
+def load_hashes(filename):
+    """ Hashes of images of bin (Series of DHash indexed by ImageId) and fingerprint of raw bin they are from """
+    with np.load(filename) as f:
+        return pd.Series(f['DHash'], index=pd.Index(f['ImageId'], name='ImageId'), name='DHash'), \
+            str(f['fingerprint'])
+
+
+class HashIndex:
+    """ Multi-index of hashes of images kept (not duplicates), queried with hashes of bins in order of processing """
+
+    def __init__(self, max_distance=MAX_DISTANCE):
+        self.max_distance = max_distance
+        n_bands = max_distance + 1
+        widths = [64 // n_bands + (i < 64 % n_bands) for i in range(n_bands)]
+        self.bands = [(int(s), (1 << w) - 1) for s, w in zip(np.cumsum([0] + widths[:-1]), widths)]  # shift, mask
+        self.tables = [dict() for _ in self.bands]  # value of band: positions of hashes kept
+        self.exact = dict()  # hash: position of hash kept
+        self.hashes, self.ids = [], []  # Hashes and object ids of images kept
+
+    def _find(self, h):
+        if h in self.exact:
+            return self.exact[h]
+        candidates = set()
+        for (shift, mask), table in zip(self.bands, self.tables):
+            candidates.update(table.get((h >> shift) & mask, ()))
+        if not candidates:
+            return None
+        candidates = np.fromiter(candidates, dtype=np.int64)
+        distance = hamming(np.array([self.hashes[i] for i in candidates], dtype=np.uint64), h)
+        if distance.min() > self.max_distance:
+            return None
+        # Earliest image kept within max_distance
+        return int(candidates[distance <= self.max_distance].min())
+
+    def _add(self, h, object_id):
+        position = len(self.hashes)
+        self.hashes.append(h)
+        self.ids.append(object_id)
+        self.exact[h] = position
+        for (shift, mask), table in zip(self.bands, self.tables):
+            table.setdefault((h >> shift) & mask, []).append(position)
+
+    def add(self, bin_name, hashes):
+        """
+        Find near-duplicates of images of bin among images of bins added before and of bin, index images kept
+        :param hashes: Series of DHash indexed by ImageId
+        :return: Series of DuplicateOf (object id of image duplicated, '' if image is kept) indexed by ImageId
+        """
+        ids = object_ids(bin_name, hashes.index)
+        duplicate_of = np.full(len(ids), '', dtype=object)
+        # Identical hashes within bin are searched once
+        unique, first, inverse = np.unique(hashes.to_numpy(dtype=np.uint64), return_index=True, return_inverse=True)
+        for u in np.argsort(first, kind='stable'):
+            h, i = int(unique[u]), first[u]
+            position = self._find(h)
+            if position is None:
+                self._add(h, ids[i])
+            else:
+                duplicate_of[i] = self.ids[position]
+            others = np.flatnonzero(inverse == u)
+            duplicate_of[others[others != i]] = ids[i] if position is None else self.ids[position]
+        return pd.Series(duplicate_of, index=hashes.index, name='DuplicateOf')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find near-duplicate IFCB images within and across bins.')
+    parser.add_argument('-r', '--raw', type=str, required=True,
+                        help='Set path to raw IFCB directory or zip/tar archive (adc, hdr, and roi files).')
+    parser.add_argument('-m', '--environmental', type=str, required=True,
+                        help='Set path to environmental metadata file (bins are processed in its order).')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Set path to table of duplicates (csv: bin, ImageId, DuplicateOf).')
+    parser.add_argument('-d', '--distance', type=int, default=MAX_DISTANCE,
+                        help='Set maximum number of bits different between hashes of near-duplicates.')
+    parser.add_argument('--hashes', type=str, help='Set path to directory of hashes of each bin (reused if the bin did '
+                                                   'not change).')
+    args = parser.parse_args()
+
+    from extractIFCBdata import BinExtractor, CorruptedBin, progress
+    from ifcb_csv import write_csv
+    extractor = BinExtractor(args.raw, args.environmental, path_to_hashes=args.hashes)
+    index, duplicates = HashIndex(args.distance), []
+    for bin_name in progress(extractor.environmental_data['bin']):
+        try:
+            hashes = extractor.bin_hashes(bin_name)
+        except (CorruptedBin, FileNotFoundError) as e:
+            print(e)
+            continue
+        duplicates.append(index.add(bin_name, hashes).reset_index().assign(bin=bin_name))
+    duplicates = pd.concat(duplicates, ignore_index=True)[['bin', 'ImageId', 'DuplicateOf']] if duplicates else \
+        pd.DataFrame(columns=['bin', 'ImageId', 'DuplicateOf'])
+    write_csv(duplicates, args.output, index=False)
+    print(f'{(duplicates["DuplicateOf"] != "").sum()} near-duplicates of {len(duplicates.index)} images.')
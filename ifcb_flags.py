@@ -0,0 +1,104 @@
+"""
+Convert the flags of IFCB samples (free text from the sampling log, e.g. "bad focus; flush") to bitmasks
+and select samples based on their flags.
+
+Bit  Flag
+0    good (no flag)
+1    incomplete, aborted, contaminated
+2    bad, ignore, delete, failed, bubble, empty
+3    questionable
+4    custom_trigger
+5    flush
+6    custom_volume
+7    bad_alignment
+8    bad_focus
+9    time_offset
+10   corrupted
+11   questionable_alignment
+"""
+
+import numpy as np
+import pandas as pd
+
+FLAG_BITS = {'good': 0, 'incomplete': 1, 'bad': 2, 'questionable': 3, 'custom_trigger': 4, 'flush': 5,
+             'custom_volume': 6, 'bad_alignment': 7, 'bad_focus': 8, 'time_offset': 9, 'corrupted': 10,
+             'questionable_alignment': 11}
+FLAG_ALIASES = {
+    'questionable_alignment': ('questionable alignment', 'questionable_alignment', 'questionablealignment',
+                               'questionable allignement'),
+    'corrupted': ('corrupted',),
+    'time_offset': ('timeoffset', 'time_offset'),
+    'bad_focus': ('bad focus', 'bad_focus', 'badfocus', 'bfocus'),
+    'bad_alignment': ('bad alignment', 'bad_alignment', 'badalignment', 'balignment'),
+    'custom_volume': ('cvolume', 'customvolume', 'custom_volume', 'custom volume'),
+    'flush': ('flush',),
+    'custom_trigger': ('ctrigger', 'customtrigger', 'custom_trigger', 'custom trigger', 'scatter trigger'),
+    'questionable': ('questionnable', 'questionable'),
+    'bad': ('bad', 'ignore', 'delete', 'failed', 'bubble', 'bubbles', 'empty'),
+    'incomplete': ('incomplete', 'aborted', 'contaminated', 'soap contamination'),
+    'good': ('good',),
+}
+FLAG_LUT = {alias: 2 ** FLAG_BITS[flag] for flag, aliases in FLAG_ALIASES.items() for alias in aliases}
+
+
+def flag_str_to_int(flag_str):
+    """ Convert flags separated by semicolons to a bitmask (1 if no flag) """
+    if pd.isna(flag_str):
+        return 1
+    flag_str = flag_str.strip()
+    if flag_str == '':  # Good
+        return 1
+    flag_int = 0
+    for f in flag_str.split(';'):
+        try:
+            flag_int |= FLAG_LUT[f.strip()]
+        except KeyError:
+            raise ValueError(f'Unknown flag: {flag_str}')
+    return flag_int
+
+
+def parse_flags(flags):
+    """
+    Convert a column of flags to bitmasks. Each unique string is parsed once and mapped to all rows with its
+    categorical codes. Columns already converted (integers) are returned as is.
+    """
+    if not isinstance(flags, (pd.Series, np.ndarray)):
+        flags = pd.Series(flags)
+    if pd.api.types.is_integer_dtype(flags):
+        return flags
+    index = flags.index if isinstance(flags, pd.Series) else None
+    flags = pd.Categorical(flags)
+    lut = np.array([flag_str_to_int(f) for f in flags.categories] + [1], dtype=int)  # Last for missing (code -1)
+    return pd.Series(lut[flags.codes], index=index, dtype=int)
+
+
+def flags_to_bitmask(names):
+    """ Combine flag names (or their aliases) into one bitmask """
+    bitmask = 0
+    for name in names:
+        if name in FLAG_BITS:
+            bitmask |= 2 ** FLAG_BITS[name]
+        elif name in FLAG_LUT:
+            bitmask |= FLAG_LUT[name]
+        else:
+            raise ValueError(f'Unknown flag: {name}')
+    return bitmask
+
+
+def flag_mask(flags, include=None, exclude=None, match_all=False):
+    """
+    Select samples based on their flags
+
+    :param flags: bitmasks (see parse_flags) or flag strings
+    :param include: keep samples with any of those flags (all of them if match_all)
+    :param exclude: remove samples with any of those flags
+    :return: boolean mask, e.g. meta[flag_mask(meta.Flag, exclude=['corrupted', 'bad', 'flush'])]
+    """
+    values = np.asarray(parse_flags(flags))
+    mask = np.ones(len(values), dtype=bool)
+    if exclude:
+        mask &= (values & flags_to_bitmask(exclude)) == 0
+    if include:
+        bitmask = flags_to_bitmask(include)
+        mask &= (values & bitmask) == bitmask if match_all else (values & bitmask) != 0
+    return pd.Series(mask, index=flags.index) if isinstance(flags, pd.Series) else mask
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Query the images of the science data exported by extractIFCBdata.py (metadata.csv and <bin>_sci.csv) by time, region,
+and depth without reading every bin. The index is built once in <path_to_sci>/index:
+    + images.parquet: data of every image, one row group per bin, bins sorted by DateTime
+    + bins.parquet: metadata of each bin with its row group, number of images, and cell of a latitude/longitude grid
+A query selects bins by time (binary search), region (grid cells), and depth, then reads only the row groups of these
+bins and the columns requested (requires pyarrow).
+    ./ifcb_index.py sci/
+    >>> index = ImageIndex('sci/index')
+    >>> index.query(('2023-05-01', '2023-05-02'), bbox=(-70, 42, -68, 44), columns=['Biovolume', 'Taxon'])
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from makeIFCBTable import CATEGORICAL_COLUMNS, read_sci
+
+GRID_RESOLUTION = 0.5  # degrees
+INTEGER_COLUMNS = ['ImageId']  # Other numeric columns are float as they can be missing in some bins
+
+
+def grid_cells(latitude, longitude, resolution=GRID_RESOLUTION):
+    """ Cell of a regular latitude/longitude grid, -1 if position is missing """
+    n_rows, n_cols = int(np.ceil(180 / resolution)), int(np.ceil(360 / resolution))
+    row = np.minimum(np.floor((np.asarray(latitude, dtype=float) + 90) / resolution), n_rows - 1)  # North pole
+    col = np.floor((np.mod(np.asarray(longitude, dtype=float) + 180, 360)) / resolution)
+    cell = row * n_cols + col
+    return np.where(np.isfinite(cell), cell, -1).astype(np.int64)
+
+
+def _csv_columns(filename):
+    with open(filename) as f:
+        return f.readline().strip().split(',')
+
+
+def build_index(path_to_sci, path_to_index=None, resolution=GRID_RESOLUTION, n_workers=4):
+    """
+    Build index of science data of run_science (metadata.csv and <bin>_sci.csv)
+
+    :param path_to_index: directory of index (default <path_to_sci>/index)
+    :param resolution: size of cells of grid in degrees
+    :param n_workers: number of bins read in parallel
+    :return: metadata of bins indexed
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if path_to_index is None:
+        path_to_index = os.path.join(path_to_sci, 'index')
+    os.makedirs(path_to_index, exist_ok=True)
+    meta = pd.read_csv(os.path.join(path_to_sci, 'metadata.csv'), parse_dates=['DateTime'])
+    meta = meta.sort_values('DateTime', kind='stable').reset_index(drop=True)
+    # Schema of images is the union of the columns of all bins (only headers are read)
+    filenames = [os.path.join(path_to_sci, b + '_sci.csv') for b in meta['BinId']]
+    columns = dict()
+    for f in filenames:
+        if os.path.isfile(f):
+            columns.update(dict.fromkeys('AnnotationStatus' if c == 'Status' else c for c in _csv_columns(f)))
+    schema = pa.schema([(c, pa.string() if c in CATEGORICAL_COLUMNS else
+                         pa.int64() if c in INTEGER_COLUMNS else pa.float64()) for c in columns])
+    # Write one row group per bin in order of time (bins are read in parallel, written in order)
+    n_images = np.zeros(len(meta.index), dtype=np.int64)
+    row_group = np.full(len(meta.index), -1, dtype=np.int64)
+    with ThreadPoolExecutor(n_workers) as executor, \
+            pq.ParquetWriter(os.path.join(path_to_index, 'images.parquet'), schema, compression='zstd') as writer:
+        for i, data in enumerate(executor.map(lambda b: read_sci(path_to_sci, b), meta['BinId'])):
+            if data is None or data.empty:
+                continue
+            data = data.reindex(columns=schema.names)
+            for c in CATEGORICAL_COLUMNS:
+                if c in data.columns:
+                    data[c] = data[c].astype(object).where(data[c].notna(), None)
+            writer.write_table(pa.Table.from_pandas(data, schema=schema, preserve_index=False),
+                               row_group_size=len(data.index))
+            n_images[i], row_group[i] = len(data.index), row_group.max() + 1
+    meta['NumberImages'], meta['RowGroup'] = n_images, row_group
+    meta['Cell'] = grid_cells(meta['Latitude'], meta['Longitude'], resolution)
+    table = pa.Table.from_pandas(meta, preserve_index=False)
+    info = {'resolution': resolution, 'path_to_sci': os.path.abspath(path_to_sci)}
+    table = table.replace_schema_metadata({**table.schema.metadata, b'ifcb_index': json.dumps(info).encode()})
+    pq.write_table(table, os.path.join(path_to_index, 'bins.parquet'))
+    print(f'{len(meta.index)} bins and {n_images.sum()} images indexed in {path_to_index}.')
+    return meta
+
+
+class ImageIndex:
+    """ Index of science data built with build_index """
+
+    def __init__(self, path_to_index):
+        import pyarrow.parquet as pq
+        self.path = path_to_index
+        table = pq.read_table(os.path.join(path_to_index, 'bins.parquet'))
+        self.info = json.loads(table.schema.metadata[b'ifcb_index'])
+        self.resolution = self.info['resolution']
+        self.meta = table.to_pandas()  # Sorted by DateTime
+        self.images = pq.ParquetFile(os.path.join(path_to_index, 'images.parquet'))
+        # Bins sorted by cell, bins of a range of cells are contiguous
+        self._cell_order = np.argsort(self.meta['Cell'].to_numpy(), kind='stable')
+        self._cells = self.meta['Cell'].to_numpy()[self._cell_order]
+        self._times = self.meta['DateTime'].to_numpy()
+
+    def _in_time_range(self, time_range):
+        start, end = (None, None) if time_range is None else time_range
+        first = 0 if start is None else np.searchsorted(self._times, np.datetime64(pd.Timestamp(start)), 'left')
+        last = len(self._times) if end is None else \
+            np.searchsorted(self._times, np.datetime64(pd.Timestamp(end)), 'right')
+        sel = np.zeros(len(self._times), dtype=bool)
+        sel[first:last] = True
+        return sel
+
+    def _in_bbox(self, bbox):
+        lon_min, lat_min, lon_max, lat_max = bbox
+        n_rows, n_cols = int(np.ceil(180 / self.resolution)), int(np.ceil(360 / self.resolution))
+        row_min, row_max = np.clip(np.floor((np.array([lat_min, lat_max]) + 90) / self.resolution),
+                                   0, n_rows - 1).astype(int)
+        col_min, col_max = np.clip(np.floor((np.array([lon_min, lon_max]) + 180) / self.resolution),
+                                   0, n_cols - 1).astype(int)
+        crossing = lon_min > lon_max  # bbox crosses the antimeridian
+        col_ranges = [(col_min, n_cols - 1), (0, col_max)] if crossing else [(col_min, col_max)]
+        # Bins in cells overlapping bbox (cells of a row of the grid are contiguous)
+        candidates = [np.empty(0, dtype=np.int64)]
+        for row in range(row_min, row_max + 1):
+            for c0, c1 in col_ranges:
+                first = np.searchsorted(self._cells, row * n_cols + c0, 'left')
+                last = np.searchsorted(self._cells, row * n_cols + c1, 'right')
+                candidates.append(self._cell_order[first:last])
+        candidates = np.concatenate(candidates)
+        # Exact test of positions of candidates (cells on the edges of bbox are partially inside)
+        lat = self.meta['Latitude'].to_numpy(dtype=float)[candidates]
+        lon = self.meta['Longitude'].to_numpy(dtype=float)[candidates]
+        inside = (lat_min <= lat) & (lat <= lat_max) & \
+            (((lon_min <= lon) | (lon <= lon_max)) if crossing else ((lon_min <= lon) & (lon <= lon_max)))
+        sel = np.zeros(len(self._times), dtype=bool)
+        sel[candidates[inside]] = True
+        return sel
+
+    def bins(self, time_range=None, bbox=None, depth_range=None):
+        """
+        Metadata of bins matching query
+
+        :param time_range: (start, end) inclusive, either can be None
+        :param bbox: (lon_min, lat_min, lon_max, lat_max), lon_min > lon_max crosses the antimeridian
+        :param depth_range: (min, max) inclusive, bins without depth are excluded
+        """
+        sel = self._in_time_range(time_range)
+        if bbox is not None:
+            sel &= self._in_bbox(bbox)
+        if depth_range is not None:
+            depth = self.meta['Depth'].to_numpy(dtype=float)
+            sel &= (depth_range[0] <= depth) & (depth <= depth_range[1])
+        return self.meta[sel]
+
+    def query(self, time_range=None, bbox=None, depth_range=None, columns=None):
+        """
+        Images of bins matching query (see bins) with columns of images or of bins (all columns of images if None),
+        only the row groups of the bins selected are read
+        """
+        bins = self.bins(time_range, bbox, depth_range)
+        bins = bins[bins['RowGroup'] >= 0]
+        names = self.images.schema_arrow.names
+        image_columns = names if columns is None else [c for c in columns if c in names]
+        bin_columns = [] if columns is None else [c for c in columns if c not in names and c != 'BinId']
+        missing = [c for c in bin_columns if c not in self.meta.columns]
+        if missing:
+            raise KeyError(f'Unknown column(s): {missing}')
+        data = self.images.read_row_groups(bins['RowGroup'].to_list(), columns=image_columns).to_pandas()
+        n = bins['NumberImages'].to_numpy()
+        data.insert(0, 'BinId', pd.Categorical.from_codes(np.repeat(np.arange(len(bins.index)), n),
+                                                          categories=bins['BinId']))
+        for c in bin_columns:
+            data[c] = np.repeat(bins[c].to_numpy(), n)
+        return data if columns is None else data[['BinId', *[c for c in columns if c != 'BinId']]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build time/space index of science data of extractIFCBdata.py.')
+    parser.add_argument('sci', type=str, help='Set path to science data (metadata.csv and <bin>_sci.csv).')
+    parser.add_argument('-o', '--output', type=str, help='Set path to index (default <sci>/index).')
+    parser.add_argument('-g', '--grid', type=float, default=GRID_RESOLUTION,
+                        help='Set resolution of latitude/longitude grid in degrees.')
+    parser.add_argument('-n', '--workers', type=int, default=4, help='Set number of bins read in parallel.')
+    args = parser.parse_args()
+
+    build_index(args.sci, args.output, args.grid, args.workers)
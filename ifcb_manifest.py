@@ -0,0 +1,109 @@
+"""
+Record the fingerprints of the inputs used to build each output (e.g. <bin>_sci.csv) to recompute only the stages
+of outputs whose inputs changed:
+    + raw files: size and modification time (or content hash)
+    + environmental data: hash of row of bin
+    + classification: hash of rows of bin after taxonomic grouping (changes of annotations or of taxonomic grouping)
+    + configuration: hash of parameters (e.g. acquisition or process of EcoTaxa export)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from time import time
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (output TEXT, stage TEXT, fingerprint TEXT, updated REAL,
+                                         PRIMARY KEY (output, stage));
+"""
+
+
+def file_fingerprint(*paths, content=False):
+    """ Fingerprint of files from their size and modification time, or from their content (slower) """
+    parts = []
+    for path in paths:
+        if not os.path.isfile(path):
+            parts.append('missing')
+        elif content:
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    h.update(block)
+            parts.append(h.hexdigest())
+        else:
+            stat = os.stat(path)
+            parts.append(f'{stat.st_size}:{stat.st_mtime_ns}')
+    return ','.join(parts)
+
+
+def config_fingerprint(config):
+    """ Fingerprint of json serializable parameters """
+    return hashlib.blake2b(json.dumps(config, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def row_fingerprints(data, key='bin'):
+    """ Fingerprint of each row of data indexed by key """
+    h = pd.util.hash_pandas_object(data.drop(columns=key), index=False)
+    return pd.Series(h.map('{:016x}'.format).to_numpy(), index=data[key].to_numpy())
+
+
+def group_fingerprints(data, key='bin', sort_by=None):
+    """ Fingerprint of rows of each group of data (independent of order of rows if sort_by is given) """
+    if data.empty:
+        return pd.Series(dtype=str)
+    # Rows of each group are contiguous once sorted by key
+    data = data.sort_values([key, sort_by] if sort_by else key, kind='stable')
+    h = pd.util.hash_pandas_object(data.drop(columns=key), index=False).to_numpy()
+    keys = data[key].to_numpy()
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+    return pd.Series([hashlib.blake2b(h[s:e].tobytes(), digest_size=16).hexdigest() for s, e in zip(starts, ends)],
+                     index=keys[starts])
+
+
+class BuildManifest:
+    """
+    Fingerprints of the inputs of each stage of each output, saved in a SQLite file (safe with several workers)
+
+    >>> manifest = BuildManifest('sci/manifest.db')
+    >>> stale = manifest.stale('D20230501T000000_IFCB107_sci.csv', {'data': ..., 'classification': ...})
+    >>> ...  # recompute stale stages
+    >>> manifest.record('D20230501T000000_IFCB107_sci.csv', {'data': ..., 'classification': ...})
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            self.recorded = {(o, s): f for o, s, f in db.execute('SELECT output, stage, fingerprint FROM fingerprints')}
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:  # Commit
+                yield db
+        finally:
+            db.close()
+
+    def stale(self, output, fingerprints):
+        """ Return stages of output whose inputs changed since recorded (all stages if output was never recorded) """
+        return {stage for stage, f in fingerprints.items() if self.recorded.get((output, stage)) != f}
+
+    def record(self, output, fingerprints):
+        """ Save fingerprints of inputs once the stages of output are up to date """
+        now = time()
+        with self.connect() as db:
+            db.executemany('INSERT OR REPLACE INTO fingerprints (output, stage, fingerprint, updated) VALUES '
+                           '(?, ?, ?, ?)', [(output, s, f, now) for s, f in fingerprints.items()])
+        self.recorded.update({(output, s): f for s, f in fingerprints.items()})
+
+    def forget(self, output):
+        """ Remove fingerprints of output (recomputed entirely next time) """
+        with self.connect() as db:
+            db.execute('DELETE FROM fingerprints WHERE output=?', (output,))
+        self.recorded = {k: f for k, f in self.recorded.items() if k[0] != output}
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Process one list of bins on several nodes sharing a filesystem, without broker
+
+The work queue is a SQLite file on the shared filesystem. Each worker claims bins with a lease renewed by a heartbeat,
+bins leased by a dead worker are claimed again once their lease expires (up to max_attempts times). Outputs of each
+bin are written by a single worker, metadata.csv of mode ecology is written once all bins are done (finalize).
+    ./ifcb_queue.py init queue.db sci -m metadata.csv
+    ./ifcb_queue.py work queue.db sci -r raw/ -m metadata.csv -t grouping.csv -e ecotaxa/ -o sci/ ecology  # each node
+    ./ifcb_queue.py status queue.db sci
+    ./ifcb_queue.py finalize queue.db sci -r raw/ -m metadata.csv -t grouping.csv -e ecotaxa/ -o sci/
+
+SQLite relies on the locks of the filesystem, which must be supported by the network filesystem (NFS with lockd).
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from time import time, sleep
+
+import pandas as pd
+
+from extractIFCBdata import BinExtractor, HDR_COLUMN_NAMES, TAXON_INDEX_FILENAME
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (job TEXT, bin TEXT, state TEXT DEFAULT 'pending', worker TEXT, lease_expires REAL,
+                                  attempts INTEGER DEFAULT 0, result TEXT, error TEXT, updated REAL,
+                                  PRIMARY KEY (job, bin));
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (job, state, lease_expires);
+CREATE TABLE IF NOT EXISTS workers (job TEXT, worker TEXT, started REAL, heartbeat REAL, lease REAL, state TEXT,
+                                    PRIMARY KEY (job, worker));
+"""
+MODES = ('ecology', 'ecotaxa')
+
+
+class WorkQueue:
+    """
+    Bins of a job to process, shared by workers through a SQLite file
+
+    :param path: path to SQLite file (created if missing)
+    :param job: name of job, several jobs can share the same file
+    :param lease: seconds a claimed bin is reserved to a worker without heartbeat
+    :param max_attempts: number of times a bin is claimed before being marked as failed
+    :param worker: name of worker (default <hostname>:<pid>)
+    """
+
+    def __init__(self, path, job, lease=300, max_attempts=3, worker=None):
+        self.path = path
+        self.job = job
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker = worker if worker else f'{socket.gethostname()}:{os.getpid()}'
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """ Short lived connection (safe to use from several threads and with network filesystems) """
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def transaction(self):
+        """ Write transaction, locks the database until committed """
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def add(self, bins, retry_failed=False):
+        """ Add bins to job (bins already in job are kept), return number of bins added """
+        with self.transaction() as db:
+            n = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO tasks (job, bin, updated) VALUES (?, ?, ?)',
+                           [(self.job, b, time()) for b in bins])
+            if retry_failed:
+                db.execute("UPDATE tasks SET state='pending', attempts=0, error=NULL WHERE job=? AND state='failed'",
+                           (self.job,))
+            return db.total_changes - n
+
+    def claim(self, n=1):
+        """ Lease up to n bins pending or with an expired lease, return list of bins """
+        now = time()
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET state='failed', error='Lease expired ' || attempts || ' times (worker died)' "
+                       "WHERE job=? AND state='leased' AND lease_expires<? AND attempts>=?",
+                       (self.job, now, self.max_attempts))
+            bins = [r[0] for r in db.execute(
+                "SELECT bin FROM tasks WHERE job=? AND (state='pending' OR (state='leased' AND lease_expires<?)) "
+                "ORDER BY rowid LIMIT ?", (self.job, now, n))]
+            db.executemany("UPDATE tasks SET state='leased', worker=?, lease_expires=?, attempts=attempts+1, updated=? "
+                           "WHERE job=? AND bin=?", [(self.worker, now + self.lease, now, self.job, b) for b in bins])
+        return bins
+
+    def heartbeat(self, state='working'):
+        """ Renew leases of worker, return number of bins leased """
+        now = time()
+        with self.transaction() as db:
+            db.execute('INSERT INTO workers (job, worker, started, heartbeat, lease, state) VALUES (?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT (job, worker) DO UPDATE SET heartbeat=excluded.heartbeat, state=excluded.state',
+                       (self.job, self.worker, now, now, self.lease, state))
+            return db.execute("UPDATE tasks SET lease_expires=? WHERE job=? AND worker=? AND state='leased'",
+                              (now + self.lease, self.job, self.worker)).rowcount
+
+    def complete(self, bin_name, result=None):
+        """
+        Mark bin as done with its result (json serializable), return False if the lease was lost (bin claimed by
+        another worker after expiry), outputs are then written twice with the same content
+        """
+        with self.transaction() as db:
+            return db.execute("UPDATE tasks SET state='done', result=?, error=NULL, lease_expires=NULL, updated=? "
+                              "WHERE job=? AND bin=? AND worker=? AND state='leased'",
+                              (json.dumps(result), time(), self.job, bin_name, self.worker)).rowcount > 0
+
+    def fail(self, bin_name, error):
+        """ Release bin to be claimed again, or mark it as failed after max_attempts """
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END, error=?, "
+                       "lease_expires=NULL, updated=? WHERE job=? AND bin=? AND worker=? AND state='leased'",
+                       (self.max_attempts, str(error), time(), self.job, bin_name, self.worker))
+
+    def release(self, state='stopped'):
+        """ Release bins leased by worker (e.g. interrupted) without counting an attempt """
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET state='pending', attempts=attempts-1, lease_expires=NULL, updated=? "
+                       "WHERE job=? AND worker=? AND state='leased'", (time(), self.job, self.worker))
+            db.execute('UPDATE workers SET state=?, heartbeat=? WHERE job=? AND worker=?',
+                       (state, time(), self.job, self.worker))
+
+    def remaining(self):
+        """ Number of bins pending or leased """
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE job=? AND state IN ('pending', 'leased')",
+                              (self.job,)).fetchone()[0]
+
+    def results(self):
+        """ Results of bins done by bin """
+        with self.connect() as db:
+            return {b: json.loads(r) for b, r in db.execute(
+                "SELECT bin, result FROM tasks WHERE job=? AND state='done'", (self.job,))}
+
+    def progress(self):
+        """ Return number of bins in each state, throughput (bins/s), estimated time left (s), and workers """
+        with self.connect() as db:
+            tasks = pd.read_sql_query('SELECT bin, state, worker, lease_expires, attempts, error, updated FROM tasks '
+                                      'WHERE job=?', db, params=(self.job,))
+            workers = pd.read_sql_query('SELECT worker, started, heartbeat, lease, state FROM workers WHERE job=?', db,
+                                        params=(self.job,))
+        now = time()
+        counts = {s: int((tasks['state'] == s).sum()) for s in ('pending', 'leased', 'done', 'failed')}
+        counts['expired'] = int(((tasks['state'] == 'leased') & (tasks['lease_expires'] < now)).sum())
+        done = tasks[tasks['state'] == 'done']
+        workers['done'] = workers['worker'].map(done['worker'].value_counts()).fillna(0).astype(int)
+        workers['leased'] = workers['worker'].map(tasks.loc[tasks['state'] == 'leased', 'worker'].value_counts()) \
+            .fillna(0).astype(int)
+        workers['alive'] = (workers['state'] == 'working') & (now - workers['heartbeat'] < workers['lease'])
+        elapsed = now - workers['started'].min() if not workers.empty else 0
+        rate = len(done) / elapsed if elapsed > 0 else float('nan')
+        left = (counts['pending'] + counts['leased']) / rate if rate > 0 else float('nan')
+        return {'counts': counts, 'total': len(tasks), 'rate': rate, 'eta': left, 'workers': workers,
+                'failed': tasks.loc[tasks['state'] == 'failed', ['bin', 'attempts', 'error']]}
+
+    def print_progress(self):
+        p = self.progress()
+        c = p['counts']
+        print(f"{self.job}: {c['done']}/{p['total']} done ({100 * c['done'] / max(p['total'], 1):.1f}%), "
+              f"{c['leased']} in progress ({c['expired']} expired leases), {c['pending']} pending, "
+              f"{c['failed']} failed")
+        if p['rate'] > 0:
+            print(f"{p['rate'] * 3600:.0f} bins/hour, {p['eta'] / 3600:.2f} hours left")
+        if not p['workers'].empty:
+            w = p['workers'].copy()
+            w['heartbeat'] = (time() - w['heartbeat']).round().astype(int).astype(str) + ' s ago'
+            print(w[['worker', 'state', 'alive', 'heartbeat', 'leased', 'done']].to_string(index=False))
+        if not p['failed'].empty:
+            print('Failed:\n' + p['failed'].to_string(index=False))
+
+
+class Heartbeat(threading.Thread):
+    """ Renew leases of queue in the background while bins are processed """
+
+    def __init__(self, queue, interval=None):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.interval = interval if interval else queue.lease / 3
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.queue.heartbeat()
+            except sqlite3.OperationalError as e:  # Database busy, next beat will renew leases
+                print(f'Heartbeat: {e}')
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def science_results(metadata, bins):
+    """ Columns of metadata.csv set by run_science for each bin (missing if bin was dropped) """
+    metadata = metadata.set_index('bin')
+    results = dict()
+    for b in bins:
+        if b not in metadata.index:
+            results[b] = {'missing': True}
+            continue
+        results[b] = {c: None if pd.isna(v) else v.item() if hasattr(v, 'item') else v
+                      for c, v in metadata.loc[b, HDR_COLUMN_NAMES + ['AnnotationValidated']].items()}
+    return results
+
+
+def run_worker(queue, extractor, mode, output_path, batch=1, poll_interval=10, **kwargs):
+    """
+    Claim and process bins until all bins of queue are done
+
+    :param mode: ecology (run_science without writing metadata.csv, see finalize_science) or ecotaxa (run_ecotaxa)
+    :param batch: number of bins claimed at once
+    :param poll_interval: seconds to wait when all bins left are leased by other workers (claimed if they die)
+    :param kwargs: keyword arguments of run_science or run_ecotaxa
+    :return: number of bins processed by worker
+    """
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {MODES}.')
+    if not os.path.exists(output_path):
+        os.makedirs(output_path, exist_ok=True)
+    queue.heartbeat()
+    heartbeat = Heartbeat(queue)
+    heartbeat.start()
+    n, state = 0, 'interrupted'
+    try:
+        while True:
+            bins = queue.claim(batch)
+            if not bins:
+                if queue.remaining() == 0:
+                    break
+                sleep(poll_interval)
+                continue
+            failed = dict()
+            try:
+                if mode == 'ecology':
+                    results = science_results(extractor.run_science(output_path, bins, write_metadata=False,
+                                                                    failed=failed, **kwargs), bins)
+                else:
+                    extractor.run_ecotaxa(output_path, bins, failed=failed, **kwargs)
+                    results = dict()
+            except Exception as e:
+                print(f'{queue.worker}: {bins}: {type(e).__name__}: {e}')
+                for b in bins:
+                    queue.fail(b, f'{type(e).__name__}: {e}')
+                continue
+            for b in bins:
+                if b in failed:
+                    queue.fail(b, failed[b])
+                elif not queue.complete(b, results.get(b)):
+                    print(f'{b}: lease lost, processed by another worker')
+                else:
+                    n += 1
+        state = 'finished'
+    finally:
+        heartbeat.stop()
+        queue.release(state)
+    return n
+
+
+def finalize_science(queue, extractor, output_path, make_matlab_table=False, matlab_table_info=None):
+    """ Write metadata.csv, taxon index (if extractor has classification), and consolidated table of bins processed by
+    workers in mode ecology """
+    if queue.remaining():
+        print(f'Warning: {queue.remaining()} bins are not processed yet.')
+    metadata, _ = extractor.load_science_metadata(output_path)
+    metadata.set_index('bin', inplace=True)
+    results = pd.DataFrame.from_dict(queue.results(), orient='index')
+    if not results.empty:
+        if 'missing' in results.columns:
+            metadata.drop(index=results.index[results['missing'].notna()], errors='ignore', inplace=True)
+            results = results[results['missing'].isna()].drop(columns='missing')
+        updated = results.index.intersection(metadata.index)
+        metadata.loc[updated, results.columns] = results.loc[updated].astype(float).to_numpy()
+    metadata.reset_index(inplace=True)
+    extractor.write_science_metadata(metadata, output_path)
+    if extractor.classification_data is not None:
+        extractor.taxon_index(os.path.join(output_path, TAXON_INDEX_FILENAME))
+    if make_matlab_table:
+        from makeIFCBTable import make_ifcb_table
+        make_ifcb_table(matlab_table_info, dict(path_to_input_data=output_path, path_to_output_table=output_path))
+    return metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process bins on several nodes sharing a work queue (SQLite file).')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ['init', 'work', 'status', 'finalize']:
+        p = commands.add_parser(name)
+        p.add_argument('queue', type=str, help='Set path to queue (SQLite file on shared filesystem).')
+        p.add_argument('job', type=str, help='Set name of job.')
+        if name == 'init':
+            p.add_argument('-m', '--environmental', type=str,
+                           help='Set path to environmental metadata file (add all bins).')
+            p.add_argument('-b', '--bins', type=str, help='Set path to file listing bins to add (one per line).')
+            p.add_argument('--retry-failed', action='store_true', help='Set failed bins as pending.')
+        if name in ('work', 'finalize'):
+            if name == 'work':
+                p.add_argument('mode', type=str, choices=MODES, help='Set data extraction mode.')
+            p.add_argument('-r', '--raw', type=str, required=True,
+                           help='Set path to raw IFCB directory (adc, hdr, and roi files).')
+            p.add_argument('-m', '--environmental', type=str, required=True,
+                           help='Set path to environmental metadata file.')
+            p.add_argument('-o', '--output', type=str, required=True,
+                           help='Set path to directory of formatted output data.')
+            p.add_argument('--kwargs', type=str,
+                           help='Set path to json file with keyword arguments of run_science or run_ecotaxa '
+                                '(finalize: make_matlab_table and matlab_table_info).')
+            p.add_argument('-t', '--taxonomy', type=str, help='Set path to taxonomic grouping file.')
+            p.add_argument('-e', '--ecotaxa', type=str, help='Set path to EcoTaxa classification directory or file.')
+        if name == 'work':
+            p.add_argument('-p', '--parallel', action='store_true', help='Enable Matlab parallel processing.')
+            p.add_argument('--daemon', type=str, help='Set address of feature daemon (ifcb_daemon.py).')
+            p.add_argument('--batch', type=int, default=1, help='Set number of bins claimed at once.')
+            p.add_argument('--lease', type=float, default=300,
+                           help='Set seconds before bins of a worker without heartbeat are claimed again.')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue, args.job, lease=getattr(args, 'lease', 300))
+    kwargs = dict()
+    if getattr(args, 'kwargs', None):
+        with open(args.kwargs) as f:
+            kwargs = json.load(f)
+    if args.command == 'init':
+        bins = []
+        if args.environmental:
+            bins += pd.read_csv(args.environmental, usecols=['bin'])['bin'].to_list()
+        if args.bins:
+            with open(args.bins) as f:
+                bins += [line.strip() for line in f if line.strip()]
+        print(f'{queue.add(bins, args.retry_failed)} bins added to {args.job}.')
+        queue.print_progress()
+    elif args.command == 'work':
+        extractor = BinExtractor(args.raw, args.environmental, matlab_parallel_flag=args.parallel,
+                                 feature_daemon=args.daemon)
+        if args.ecotaxa and args.taxonomy:
+            extractor.init_ecotaxa_classification(args.ecotaxa, args.taxonomy)
+        n = run_worker(queue, extractor, args.mode, args.output, batch=args.batch, **kwargs)
+        print(f'{queue.worker}: {n} bins processed.')
+        queue.print_progress()
+    elif args.command == 'status':
+        queue.print_progress()
+    elif args.command == 'finalize':
+        extractor = BinExtractor(args.raw, args.environmental)
+        if args.ecotaxa and args.taxonomy:
+            extractor.init_ecotaxa_classification(args.ecotaxa, args.taxonomy)
+        finalize_science(queue, extractor, args.output, **kwargs)
@@ -0,0 +1,276 @@
+"""
+Read raw IFCB bins (adc, hdr, and roi files) from a directory or directly from a zip or tar archive
+(e.g. <experiment>.IFCB.raw.zip) without extracting it:
+    + members are found by file name anywhere in the archive
+    + uncompressed members (zip stored, plain tar) are read at their offset in the archive (random access)
+    + compressed members are decompressed in blocks kept in a cache (LRU) to slice ROIs in any order
+    + bins are extracted to a temporary directory only for Matlab, which requires files (see RawSource.local)
+
+>>> raw = open_raw('EXPORTS.IFCB.raw.zip')
+>>> adc = parse_adc(raw.open('D20230501T000000_IFCB107', '.adc'))
+>>> roi = raw.read('D20230501T000000_IFCB107', '.roi', offset, size)
+"""
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+RAW_EXTENSIONS = ('.adc', '.hdr', '.roi')
+BLOCK_SIZE = 2**20
+CACHE_SIZE = 2**26  # Bytes of decompressed blocks kept in cache
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ')  # gzip, bzip2, and xz
+
+
+def open_raw(path, block_size=BLOCK_SIZE, cache_size=CACHE_SIZE):
+    """ Return raw source for a directory or a zip or tar archive """
+    if os.path.isdir(path):
+        return RawDirectory(path)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'{path}: raw directory or archive not found.')
+    if zipfile.is_zipfile(path):
+        return RawZip(path, block_size, cache_size)
+    if tarfile.is_tarfile(path):
+        return RawTar(path, block_size, cache_size)
+    raise ValueError(f'{path}: not a directory nor a zip or tar archive.')
+
+
+class RawSource:
+    """ Raw files of bins, identified by bin name and extension (.adc, .hdr, or .roi) """
+
+    def __init__(self, path):
+        self.path = path
+
+    def bins(self):
+        """ Return sorted names of bins with a roi file """
+        raise NotImplementedError
+
+    def exists(self, bin_name, ext):
+        raise NotImplementedError
+
+    def size(self, bin_name, ext):
+        raise NotImplementedError
+
+    def open(self, bin_name, ext):
+        """ Return binary file object of raw file (to close by caller) """
+        raise NotImplementedError
+
+    def read(self, bin_name, ext, offset=0, size=None):
+        """ Return size bytes (all if None) of raw file starting at offset """
+        raise NotImplementedError
+
+    def fingerprint(self, bin_name, *exts):
+        """ Fingerprint of raw files from their size and modification time or crc (see ifcb_manifest.py) """
+        raise NotImplementedError
+
+    @contextmanager
+    def local(self, bin_name):
+        """ Yield path to a directory holding the raw files of bin (for Matlab) """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RawDirectory(RawSource):
+
+    def _filename(self, bin_name, ext):
+        return os.path.join(self.path, bin_name + ext)
+
+    def bins(self):
+        return sorted(f[:-4] for f in os.listdir(self.path) if f.endswith('.roi'))
+
+    def exists(self, bin_name, ext):
+        return os.path.isfile(self._filename(bin_name, ext))
+
+    def size(self, bin_name, ext):
+        return os.path.getsize(self._filename(bin_name, ext))
+
+    def open(self, bin_name, ext):
+        return open(self._filename(bin_name, ext), 'rb')
+
+    def read(self, bin_name, ext, offset=0, size=None):
+        with self.open(bin_name, ext) as f:
+            f.seek(offset)
+            return f.read(-1 if size is None else size)
+
+    def fingerprint(self, bin_name, *exts):
+        from ifcb_manifest import file_fingerprint
+        return file_fingerprint(*[self._filename(bin_name, ext) for ext in exts])
+
+    @contextmanager
+    def local(self, bin_name):
+        yield self.path
+
+
+class BlockCache:
+    """ Least recently used blocks of the members of an archive """
+
+    def __init__(self, block_size=BLOCK_SIZE, cache_size=CACHE_SIZE):
+        self.block_size = block_size
+        self.max_blocks = max(1, cache_size // block_size)
+        self.blocks = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def read(self, key, offset, size, read_block):
+        """ Return size bytes at offset of member key, read_block(i) returns bytes of block i of member """
+        first, last = offset // self.block_size, (offset + size - 1) // self.block_size
+        parts = []
+        for i in range(first, last + 1):
+            block = self.blocks.get((key, i))
+            if block is None:
+                self.misses += 1
+                block = read_block(i)
+                self.blocks[(key, i)] = block
+                if len(self.blocks) > self.max_blocks:
+                    self.blocks.popitem(last=False)
+            else:
+                self.hits += 1
+                self.blocks.move_to_end((key, i))
+            parts.append(block)
+        start = offset - first * self.block_size
+        return b''.join(parts)[start:start + size] if len(parts) > 1 else parts[0][start:start + size]
+
+
+class RawArchive(RawSource):
+    """
+    Members of an archive indexed by file name (bins can be in any directory of the archive).
+    Uncompressed members are read at their offset in the archive, others through a stream of the member.
+    """
+
+    def __init__(self, path, block_size=BLOCK_SIZE, cache_size=CACHE_SIZE):
+        super().__init__(path)
+        self.cache = BlockCache(block_size, cache_size)
+        # file name: (member, offset of data in archive or None if compressed, size, crc or modification time)
+        self.members = dict()
+        self._file = open(path, 'rb')
+        self._streams = OrderedDict()  # Member streams kept open to read blocks in sequence
+        self._index()
+
+    def _index(self):
+        raise NotImplementedError
+
+    def _add(self, name, member, offset, size, version):
+        name = os.path.basename(name)
+        if os.path.splitext(name)[1] in RAW_EXTENSIONS and name not in self.members:
+            self.members[name] = (member, offset, size, version)
+
+    def _stream(self, member):
+        raise NotImplementedError
+
+    def _member(self, bin_name, ext):
+        try:
+            return self.members[bin_name + ext]
+        except KeyError:
+            raise FileNotFoundError(f'{bin_name + ext} not found in {self.path}.') from None
+
+    def bins(self):
+        return sorted(name[:-4] for name in self.members if name.endswith('.roi'))
+
+    def exists(self, bin_name, ext):
+        return bin_name + ext in self.members
+
+    def size(self, bin_name, ext):
+        return self._member(bin_name, ext)[2]
+
+    def open(self, bin_name, ext):
+        return self._stream(self._member(bin_name, ext)[0])
+
+    def _read_block(self, name, i):
+        member, offset, size, _ = self.members[name]
+        start = i * self.cache.block_size
+        if offset is not None:
+            self._file.seek(offset + start)
+            return self._file.read(min(self.cache.block_size, size - start))
+        # Streams are only read forward, reading an earlier block decompresses the member from the start again
+        stream = self._streams.pop(name, None)
+        if stream is None or stream.tell() > start:
+            if stream is not None:
+                stream.close()
+            stream = self._stream(member)
+        if stream.tell() < start:
+            stream.seek(start)
+        block = stream.read(self.cache.block_size)
+        self._streams[name] = stream
+        if len(self._streams) > len(RAW_EXTENSIONS):
+            self._streams.popitem(last=False)[1].close()
+        return block
+
+    def read(self, bin_name, ext, offset=0, size=None):
+        name = bin_name + ext
+        member_size = self._member(bin_name, ext)[2]
+        size = member_size - offset if size is None else min(size, member_size - offset)
+        if size <= 0:
+            return b''
+        return self.cache.read(name, offset, size, lambda i: self._read_block(name, i))
+
+    def fingerprint(self, bin_name, *exts):
+        return ','.join(f'{m[2]}:{m[3]}' if m else 'missing' for m in (self.members.get(bin_name + ext)
+                                                                       for ext in exts))
+
+    @contextmanager
+    def local(self, bin_name):
+        path = tempfile.mkdtemp(prefix=f'{bin_name}_')
+        try:
+            for ext in RAW_EXTENSIONS:
+                if self.exists(bin_name, ext):
+                    with self.open(bin_name, ext) as src, open(os.path.join(path, bin_name + ext), 'wb') as dst:
+                        shutil.copyfileobj(src, dst, self.cache.block_size)
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        for stream in self._streams.values():
+            stream.close()
+        self._streams.clear()
+        self._file.close()
+
+
+class RawZip(RawArchive):
+
+    def _index(self):
+        self._zip = zipfile.ZipFile(self._file)
+        for info in self._zip.infolist():
+            offset = None
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:  # Not encrypted
+                self._file.seek(info.header_offset)
+                header = ZIP_LOCAL_HEADER.unpack(self._file.read(ZIP_LOCAL_HEADER.size))
+                offset = info.header_offset + ZIP_LOCAL_HEADER.size + header[9] + header[10]
+            self._add(info.filename, info, offset, info.file_size, f'{info.CRC:08x}')
+
+    def _stream(self, member):
+        return self._zip.open(member)
+
+    def close(self):
+        self._zip.close()
+        super().close()
+
+
+class RawTar(RawArchive):
+
+    def _index(self):
+        self._tar = tarfile.open(self.path, 'r:*')
+        compressed = self._file.read(6).startswith(COMPRESSED_MAGIC)
+        for member in self._tar:
+            if member.isfile():
+                self._add(member.name, member, None if compressed else member.offset_data, member.size,
+                          member.mtime)
+        self._file.seek(0)
+
+    def _stream(self, member):
+        return self._tar.extractfile(member)
+
+    def close(self):
+        self._tar.close()
+        super().close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Select a balanced training set from the classification (EcoTaxa annotations with taxonomic grouping) in one streaming
+pass over the EcoTaxa exports (getSubsetSize of deprecated/BuildMLDataSet.py held everything in memory):
+    + each class keeps a reservoir of at most cap images: the images with the smallest random keys, keys are a hash of
+      seed, bin, and ImageId so the selection does not depend on the order of files or rows (deterministic)
+    + classes with fewer than min_count images or excluded are not selected
+    + the images of each class are split in train and test sets (stratified, at least one test image per class)
+    + memory is proportional to the number of images selected, exports are read in chunks
+The selection (bin, ImageId, label, Subset) is consumed by modes ml-train and ml-tensor of extractIFCBdata.py so only
+the images selected are decoded and written.
+    ./ifcb_sample.py -e ecotaxa/ -t taxonomic_grouping.csv -o selection.csv -c 5000
+    ./extractIFCBdata.py -r raw/ -m metadata.csv -e ecotaxa/ -t taxonomic_grouping.csv -o train/ \
+        --selection selection.csv ml-train
+"""
+
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def _mix(x):
+    """ splitmix64 finalizer of uint64 array """
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def random_keys(bins, image_ids, seed=0):
+    """ Random key of each image, function of seed, bin name, and ImageId only """
+    codes, names = pd.factorize(np.asarray(bins, dtype=object))
+    bin_hashes = np.array([int.from_bytes(hashlib.blake2b(str(b).encode(), digest_size=8).digest(), 'little')
+                           for b in names], dtype=np.uint64)
+    ids = np.asarray(image_ids, dtype=np.uint64) ^ np.uint64(seed % 2**64)
+    return _mix(bin_hashes[codes] ^ _mix(ids))
+
+
+class StratifiedSampler:
+    """ Reservoir of images of each class fed with chunks of classification table (bin, ImageId, label) """
+
+    def __init__(self, cap=None, test_fraction=0.05, min_count=10, exclude=(), seed=0, label='Taxon',
+                 annotation_status=('validated',)):
+        """
+        :param cap: maximum number of images of each class (None: all images)
+        :param test_fraction: fraction of images of each class in test set
+        :param min_count: minimum number of images of a class to select it
+        :param exclude: classes not selected
+        :param label: column of classes (Taxon or Group)
+        :param annotation_status: keep images with these annotation status (None: all classified images)
+        """
+        self.cap, self.test_fraction, self.min_count = cap, test_fraction, min_count
+        self.exclude, self.seed, self.label = set(exclude), seed, label
+        self.annotation_status = annotation_status
+        self.counts = dict()  # Number of images of each class seen
+        self.reservoirs = dict()  # Keys, bins, and image ids of images kept of each class
+
+    def add(self, data):
+        """ Add chunk of classification table to reservoirs """
+        data = data[data[self.label].notna()]
+        if self.annotation_status is not None:
+            data = data[data['AnnotationStatus'].isin(self.annotation_status)]
+        if data.empty:
+            return
+        keys = random_keys(data['bin'].to_numpy(), data['ImageId'].to_numpy(), self.seed)
+        bins, image_ids = data['bin'].to_numpy(dtype=object), data['ImageId'].to_numpy(dtype=np.uint32)
+        codes, classes = pd.factorize(data[self.label].to_numpy(dtype=object))
+        order = np.argsort(codes, kind='stable')
+        bounds = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1], True])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            c, rows = classes[codes[order[start]]], order[start:end]
+            self.counts[c] = self.counts.get(c, 0) + len(rows)
+            if c in self.exclude:
+                continue
+            reservoir = (keys[rows], bins[rows], image_ids[rows])
+            if c in self.reservoirs:
+                reservoir = tuple(np.concatenate(a) for a in zip(self.reservoirs[c], reservoir))
+            if self.cap is not None and len(reservoir[0]) > self.cap:
+                keep = np.argpartition(reservoir[0], self.cap - 1)[:self.cap]
+                reservoir = tuple(a[keep] for a in reservoir)
+            self.reservoirs[c] = reservoir
+
+    def _selected(self, c):
+        return c not in self.exclude and self.counts[c] >= self.min_count
+
+    def _n_test(self, n):
+        return 0 if self.test_fraction <= 0 else min(n, max(1, int(round(self.test_fraction * n))))
+
+    def selection(self):
+        """ Images selected with their class and subset (train or test), sorted by bin and ImageId """
+        selection = []
+        for c, (keys, bins, image_ids) in self.reservoirs.items():
+            if not self._selected(c):
+                continue
+            order = np.argsort(keys, kind='stable')  # Images with the smallest keys are in test set
+            subset = np.where(np.arange(len(order)) < self._n_test(len(order)), 'test', 'train')
+            selection.append(pd.DataFrame({'bin': bins[order], 'ImageId': image_ids[order], self.label: c,
+                                           'Subset': subset}))
+        if not selection:
+            return pd.DataFrame({'bin': pd.Series(dtype=object), 'ImageId': pd.Series(dtype='uint32'),
+                                 self.label: pd.Series(dtype=object), 'Subset': pd.Series(dtype=object)})
+        return pd.concat(selection, ignore_index=True).drop_duplicates(['bin', 'ImageId']) \
+            .sort_values(['bin', 'ImageId'], kind='stable').reset_index(drop=True)
+
+    def summary(self):
+        """ Number of images seen, in train set, and in test set of each class, and status of class """
+        rows = []
+        for c in sorted(self.counts):
+            n = min(self.counts[c], self.cap) if self.cap is not None else self.counts[c]
+            status = 'excluded' if c in self.exclude else 'short' if self.counts[c] < self.min_count else 'selected'
+            n_test = self._n_test(n) if status == 'selected' else 0
+            rows.append((c, self.counts[c], n - n_test if status == 'selected' else 0, n_test, status))
+        return pd.DataFrame(rows, columns=[self.label, 'Count', 'Train', 'Test', 'Status']).set_index(self.label)
+
+
+def iter_classification(path_to_ecotaxa_tsv, path_to_taxonomic_grouping_csv, chunksize=2**18):
+    """ Yield chunks of classification table (see BinExtractor.init_ecotaxa_classification) from EcoTaxa file(s) """
+    from extractIFCBdata import list_ecotaxa_files, read_ecotaxa_classification, read_taxonomic_grouping, \
+        remap_categories
+    if os.path.isfile(path_to_ecotaxa_tsv):
+        files = [path_to_ecotaxa_tsv]
+    elif os.path.isdir(path_to_ecotaxa_tsv):
+        files = list_ecotaxa_files(path_to_ecotaxa_tsv)
+    else:
+        raise ValueError('EcoTaxa TSV file not found.')
+    taxon, group = read_taxonomic_grouping(path_to_taxonomic_grouping_csv)
+    for f in files:
+        for data in read_ecotaxa_classification(f, chunksize):
+            data.insert(1, 'Taxon', remap_categories(data['Hierarchy'], taxon))
+            data.insert(2, 'Group', remap_categories(data['Hierarchy'], group))
+            yield data.drop(columns='Hierarchy')
+
+
+def sample_classification(chunks, **kwargs):
+    """ Selection of images of chunks of classification table, kwargs are parameters of StratifiedSampler """
+    sampler = StratifiedSampler(**kwargs)
+    for data in chunks:
+        sampler.add(data)
+    return sampler.selection(), sampler.summary()
+
+
+def read_selection(filename):
+    return pd.read_csv(filename, dtype={'bin': str, 'ImageId': 'uint32', 'Subset': str})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Select a balanced training set (per class cap, stratified train/test '
+                                                 'split) of IFCB images from EcoTaxa classification.')
+    parser.add_argument('-e', '--ecotaxa', type=str, required=True,
+                        help='Set path to EcoTaxa classification directory or file.')
+    parser.add_argument('-t', '--taxonomy', type=str, required=True, help='Set path to taxonomic grouping file.')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Set path to selection (csv).')
+    parser.add_argument('-c', '--cap', type=int, help='Set maximum number of images of each class.')
+    parser.add_argument('--test', type=float, default=0.05, help='Set fraction of images of each class in test set.')
+    parser.add_argument('--min-count', type=int, default=10, help='Set minimum number of images of a class.')
+    parser.add_argument('-x', '--exclude', type=str, nargs='+', default=[], help='Set classes to exclude.')
+    parser.add_argument('--label', type=str, default='Taxon', choices=['Taxon', 'Group'], help='Set column of classes.')
+    parser.add_argument('--status', type=str, nargs='+', default=['validated'],
+                        help='Set annotation status of images to select.')
+    parser.add_argument('--seed', type=int, default=0, help='Set seed of random selection.')
+    args = parser.parse_args()
+
+    from ifcb_csv import write_csv
+    selection, summary = sample_classification(iter_classification(args.ecotaxa, args.taxonomy), cap=args.cap,
+                                               test_fraction=args.test, min_count=args.min_count,
+                                               exclude=args.exclude, seed=args.seed, label=args.label,
+                                               annotation_status=args.status)
+    write_csv(selection, args.output, index=False)
+    print(summary.to_string())
+    print(f'{len(selection.index)} images of {summary["Status"].eq("selected").sum()} classes selected.')
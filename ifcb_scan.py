@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Check the integrity of raw bins in parallel before processing them, so runs schedule only valid bins instead of
+finding corrupted bins after spending time extracting them:
+    + complete triplet (adc, hdr, and roi files)
+    + hdr file parses with the keys required by BinExtractor.extract_header
+    + adc file parses with valid start bytes and image dimensions
+    + no zero-length images (width or height of 0 while the other is not) and no overlapping images
+    + roi file is as long as the end byte of the last image
+The report of the scan is also the catalog of bins: a bin is checked again only if its raw files changed (fingerprint).
+    ./ifcb_scan.py -r raw/ -o scan.csv
+    ./extractIFCBdata.py -r raw/ -m metadata.csv -o sci/ ... --scan scan.csv ecology
+"""
+
+import argparse
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from extractIFCBdata import HDR_REQUIRED_KEYS, RAW_EXTENSIONS, parse_adc, parse_hdr, progress
+from ifcb_csv import write_csv
+
+REPORT_COLUMNS = ['bin', 'status', 'error', 'images', 'end_byte', 'roi_size', 'fingerprint']
+VALID_STATUS = ('valid', 'empty')  # empty: no image in bin
+
+
+def check_bin(raw, bin_name):
+    """ Check raw files of bin (see ifcb_raw.py), return status, error, number of images, end byte, and roi size """
+    result = {'bin': bin_name, 'status': 'valid', 'error': '', 'images': 0, 'end_byte': 0,
+              'roi_size': raw.size(bin_name, '.roi') if raw.exists(bin_name, '.roi') else 0}
+
+    def invalid(status, error):
+        result['status'], result['error'] = status, error
+        return result
+
+    missing = [ext for ext in RAW_EXTENSIONS if not raw.exists(bin_name, ext)]
+    if missing:
+        return invalid('incomplete', f'missing {", ".join(missing)} file')
+    # Header
+    try:
+        with io.TextIOWrapper(raw.open(bin_name, '.hdr')) as f:
+            hdr = parse_hdr(f)
+    except UnicodeDecodeError as e:
+        return invalid('header', f'hdr file is not text: {e}')
+    missing = [k for k in HDR_REQUIRED_KEYS if k not in hdr]
+    if missing:
+        return invalid('header', f'hdr file missing key(s): {", ".join(missing)}')
+    try:
+        for k in HDR_REQUIRED_KEYS:
+            (int if k == 'PMTtriggerSelection_DAQ_MCConly' else float)(hdr[k])
+    except ValueError:
+        return invalid('header', f'hdr file invalid value of {k}: {hdr[k].strip()}')
+    # Cytometry and images
+    try:
+        with raw.open(bin_name, '.adc') as f:
+            adc = parse_adc(f)
+    except pd.errors.EmptyDataError:
+        return invalid('empty', '') if result['roi_size'] == 0 else \
+            invalid('roi_size', f'adc file is empty but roi file is {result["roi_size"]} bytes')
+    except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as e:
+        return invalid('adc', f'adc file does not parse: {e}')
+    dims = adc[['StartByte', 'ImageWidth', 'ImageHeight']]
+    if dims.isna().any().any() or (dims < 0).any().any() or (dims % 1 != 0).any().any():
+        return invalid('adc', 'adc file has missing, negative, or fractional start byte or image dimensions')
+    width, height = adc['ImageWidth'].to_numpy(), adc['ImageHeight'].to_numpy()
+    zero_length = ((width == 0) != (height == 0))
+    if zero_length.any():
+        return invalid('zero_length', f'zero-length image(s): {adc.index[zero_length][:10].to_list()}')
+    images = adc[width * height > 0]
+    result['images'] = len(images.index)
+    if images.empty:
+        return invalid('empty', '') if result['roi_size'] == 0 else \
+            invalid('roi_size', f'no image in adc file but roi file is {result["roi_size"]} bytes')
+    start, end = images['StartByte'].to_numpy(), images['EndByte'].to_numpy()
+    overlap = start[1:] < end[:-1]
+    if overlap.any():
+        return invalid('overlap', f'image(s) overlapping previous one: {images.index[1:][overlap][:10].to_list()}')
+    result['end_byte'] = int(end[-1])
+    if result['end_byte'] != result['roi_size']:
+        return invalid('roi_size', f'adc end byte ({result["end_byte"]}) does not match roi size '
+                                   f'({result["roi_size"]})')
+    return result
+
+
+def scan_bins(path_to_bin, bins=None, path_to_report=None, n_workers=8):
+    """
+    Check bins of raw directory or archive in parallel (n_workers threads), default all bins with a roi file
+
+    :param path_to_report: csv report of bins, also read as catalog of bins already checked (if it exists)
+    :return: report with status of each bin (valid, empty, incomplete, header, adc, zero_length, overlap, roi_size)
+    """
+    from ifcb_raw import open_raw
+    local, sources = threading.local(), []  # Raw source of each thread (archives are not thread safe)
+    with open_raw(path_to_bin) as raw:
+        if bins is None:
+            bins = raw.bins()
+        bins = list(dict.fromkeys(bins))
+        fingerprints = pd.Series([raw.fingerprint(b, *RAW_EXTENSIONS) for b in bins], index=bins, dtype=object)
+    # Reuse results of bins unchanged since last scan
+    catalog = pd.DataFrame(columns=REPORT_COLUMNS)
+    if path_to_report is not None and os.path.isfile(path_to_report):
+        catalog = pd.read_csv(path_to_report, dtype={'error': str, 'fingerprint': str}, keep_default_na=False)
+    unchanged = catalog[catalog['bin'].isin(bins)]
+    unchanged = unchanged[unchanged['fingerprint'].to_numpy() == fingerprints[unchanged['bin']].to_numpy()]
+    to_check = [b for b in bins if b not in set(unchanged['bin'])]
+
+    def check(bin_name):
+        if not hasattr(local, 'raw'):
+            local.raw = open_raw(path_to_bin)
+            sources.append(local.raw)
+        try:
+            result = check_bin(local.raw, bin_name)
+        except OSError as e:
+            result = {'bin': bin_name, 'status': 'incomplete', 'error': f'{type(e).__name__}: {e}', 'images': 0,
+                      'end_byte': 0, 'roi_size': 0}
+        result['fingerprint'] = fingerprints[bin_name]
+        return result
+
+    with ThreadPoolExecutor(n_workers) as executor:
+        checked = list(progress(executor.map(check, to_check), total=len(to_check), desc='Scanning bins'))
+    for source in sources:
+        source.close()
+    report = concat([unchanged, pd.DataFrame(checked, columns=REPORT_COLUMNS)])
+    if path_to_report is not None:
+        # Keep bins of catalog not scanned this time
+        write_csv(concat([catalog[~catalog['bin'].isin(bins)], report]).sort_values('bin', kind='stable'),
+                  path_to_report, index=False)
+    return report.set_index('bin').reindex(bins).reset_index()
+
+
+def concat(reports):
+    reports = [r for r in reports if not r.empty]
+    if not reports:
+        return pd.DataFrame({c: pd.Series(dtype='int64' if c in ('images', 'end_byte', 'roi_size') else object)
+                             for c in REPORT_COLUMNS})
+    return pd.concat(reports, ignore_index=True).astype({'images': 'int64', 'end_byte': 'int64',
+                                                         'roi_size': 'int64'})
+
+
+def valid_bins(report):
+    """ Names of bins of report that can be processed """
+    return report.loc[report['status'].isin(VALID_STATUS), 'bin'].to_list()
+
+
+def print_report(report):
+    counts = report['status'].value_counts()
+    print(f'{len(report.index)} bins scanned: ' + ', '.join(f'{n} {s}' for s, n in counts.items()))
+    for r in report[~report['status'].isin(VALID_STATUS)].itertuples():
+        print(f'{r.bin}: {r.status}: {r.error}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check integrity of raw IFCB bins before processing them.')
+    parser.add_argument('-r', '--raw', type=str, required=True,
+                        help='Set path to raw IFCB directory or zip/tar archive (adc, hdr, and roi files).')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Set path to report (csv), bins unchanged since the previous scan are not checked again.')
+    parser.add_argument('-m', '--environmental', type=str,
+                        help='Set path to environmental metadata file (scan only its bins).')
+    parser.add_argument('-n', '--workers', type=int, default=8, help='Set number of bins checked concurrently.')
+    args = parser.parse_args()
+
+    bins = pd.read_csv(args.environmental, usecols=['bin'])['bin'].to_list() if args.environmental else None
+    report = scan_bins(args.raw, bins, args.output, args.workers)
+    print_report(report)
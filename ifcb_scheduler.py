@@ -27,7 +27,8 @@ import subprocess
 import sys
 from datetime import datetime, timedelta, date
 from datetime import time as dtime
-from threading import Thread
+from queue import Queue
+from threading import Thread, Lock
 from time import time, sleep
 
 
@@ -39,6 +40,7 @@ IFCB_ACQUIRE_EXE = ('/home/ifcb/IFCBacquire/gLauncher/IFCBacquire.Gtk', 'noUI')
 # IFCB_ACQUIRE_EXE = ('ls', )  # Dummy for test
 IFCB_ACQUIRE_PROCESS_NAME = b'IFCBacquire.Gtk'
 WEB_BROWSER_PROCESS_NAME = b'chromium'
+EXTRACT_IFCB_DATA_EXE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'extractIFCBdata.py')
 
 
 ifcb_acquire_process = None
@@ -99,9 +101,86 @@ def stop_ifcb_acquire():
             ifcb_acquire_process.kill()
 
 
+class PostAcquisitionProcessor:
+    """
+    Process bins in the background once their acquisition is stopped.
+    Each bin is exported with extractIFCBdata.py (default mode ml-classify-rt) in a low priority subprocess,
+    the number of workers bounds the CPU taken away from IFCB Acquire.
+    """
+    def __init__(self, path_to_raw, path_to_output, path_to_environmental, mode='ml-classify-rt',
+                 workers=1, niceness=10, settle_time=10):
+        self.path_to_raw = path_to_raw
+        self.path_to_output = path_to_output
+        self.path_to_environmental = path_to_environmental
+        self.mode = mode
+        self.niceness = niceness
+        self.settle_time = settle_time
+        self._queue = Queue()
+        self._threads = [Thread(name=f'{self!r}.{i}', target=self._run, daemon=True) for i in range(workers)]
+        self._processed, self._lock = set(), Lock()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}>'
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def join(self, timeout=None):
+        for t in self._threads:
+            t.join(timeout)
+
+    def submit(self, acquisition_start):
+        """ Queue bin(s) acquired since acquisition_start (datetime) """
+        self._queue.put((acquisition_start, time()))
+        logger.debug(f'Queued processing of acquisition started at {acquisition_start}, '
+                     f'queue depth: {self._queue.qsize()}.')
+
+    def find_bins(self, acquisition_start):
+        """ List bins written since acquisition start that were not processed yet """
+        t0 = acquisition_start.timestamp()
+        bins = [os.path.splitext(f.name)[0] for f in os.scandir(self.path_to_raw)
+                if f.name.endswith('.roi') and f.stat().st_mtime >= t0]
+        return sorted(b for b in bins if b not in self._processed)
+
+    def process(self, bin_name):
+        cmd = [sys.executable, EXTRACT_IFCB_DATA_EXE, self.mode, '-r', self.path_to_raw,
+               '-m', self.path_to_environmental, '-o', self.path_to_output, '-s', bin_name]
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           preexec_fn=(lambda: os.nice(self.niceness)) if hasattr(os, 'nice') else None)
+        if p.returncode != 0:
+            logger.error(f'Processing {bin_name} failed: {p.stdout.decode(errors="replace").strip()}')
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            acquisition_start, stopped_at = item
+            # Let IFCB Acquire finish writing files
+            sleep(max(0, self.settle_time - (time() - stopped_at)))
+            with self._lock:
+                bins = self.find_bins(acquisition_start)
+                self._processed.update(bins)
+            if not bins:
+                logger.warning(f'No bin found for acquisition started at {acquisition_start}.')
+            for bin_name in bins:
+                t0 = time()
+                if self.process(bin_name):
+                    logger.info(f'Processed {bin_name} in {time() - t0:.0f} s, lag {time() - stopped_at:.0f} s '
+                                f'(waited {t0 - stopped_at:.0f} s), queue depth: {self._queue.qsize()}.')
+
+
 class Scheduler:
     def __init__(self, filename):
         self.start_minutes, self.acq_length, self.tolerance, self.legs = [], None, 1, []
+        self.processor = None
         self._scheduled_day = None
         self.read_configuration(filename)
         self._scheduler = sched.scheduler(time, sleep)
@@ -121,14 +200,20 @@ class Scheduler:
             self._thread = Thread(name=repr(self), target=self._run)
             self._thread.daemon = True
             self._thread.start()
+            if self.processor is not None:
+                self.processor.start()
 
     def stop(self):
         if self._alive:
             self._alive = False
+            if self.processor is not None:
+                self.processor.stop()
 
     def join(self, timeout=None):
         if self._thread is not None:
             self._thread.join(timeout)
+        if self.processor is not None:
+            self.processor.join(timeout)
 
     def _run(self):
         logger.info("Scheduler running ...")
@@ -158,6 +243,15 @@ class Scheduler:
                 datetime.fromisoformat(cfg.get(leg, 'StopDateTime'))
             ))
             logger.info(f"  + leg '{leg[4:]}' from {self.legs[-1][0]} to {self.legs[-1][1]}")
+        if cfg.has_section('processing') and cfg.getboolean('processing', 'Enabled', fallback=False):
+            self.processor = PostAcquisitionProcessor(
+                cfg.get('processing', 'PathToRaw'), cfg.get('processing', 'PathToOutput'),
+                cfg.get('processing', 'PathToEnvironmental'),
+                mode=cfg.get('processing', 'Mode', fallback='ml-classify-rt'),
+                workers=cfg.getint('processing', 'Workers', fallback=1),
+                niceness=cfg.getint('processing', 'Niceness', fallback=10),
+                settle_time=cfg.getint('processing', 'SettleTimeSeconds', fallback=10))
+            logger.info(f"  + post-acquisition processing to {cfg.get('processing', 'PathToOutput')}")
 
     def make_schedule_of_day(self):
         """
@@ -213,6 +307,8 @@ class Scheduler:
         for m in self.start_minutes:
             if abs(dt.minute - ((m + self.acq_length.total_seconds()/60) % 60) ) < self.tolerance:
                 stop_ifcb_acquire()
+                if self.processor is not None:
+                    self.processor.submit(dt - self.acq_length)
                 return
         logger.warning(f"Off schedule: prevented ifcb acquire start.")
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Inverted index of the classification (EcoTaxa annotations with taxonomic grouping) to retrieve images by Taxon, Group,
+or AnnotationStatus without scanning the classification table or the <bin>_sci.csv files:
+    + each image is a key: bin code << 32 | ImageId (uint64), bin code is the position of bin in TaxonIndex.bins
+    + each value of Taxon, Group, and AnnotationStatus has the sorted array of keys of its images
+    + queries combine arrays of keys with intersect, union, and difference (sorted arrays, no table scan)
+    + the index is saved in a compressed npz file (keys delta encoded) and updated incrementally: only bins whose
+      classification changed (fingerprint) are indexed again
+    >>> index = TaxonIndex.load('sci/taxon_index.npz')
+    >>> keys = index.select(Taxon='Chaetoceros', AnnotationStatus='validated')
+    >>> for bin_name, image_id, img in extractor.read_indexed_images(index, keys): ...
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+INDEXED_COLUMNS = ('Taxon', 'Group', 'AnnotationStatus')
+
+
+def intersect(*keys):
+    """ Keys in all arrays """
+    result = keys[0]
+    for k in keys[1:]:
+        result = np.intersect1d(result, k, assume_unique=True)
+    return result
+
+
+def union(*keys):
+    """ Keys in any array """
+    return np.unique(np.concatenate(keys)) if keys else np.empty(0, dtype=np.uint64)
+
+
+def difference(keys, other):
+    """ Keys not in other """
+    return np.setdiff1d(keys, other, assume_unique=True)
+
+
+class TaxonIndex:
+    """ Keys of images of each Taxon, Group, and AnnotationStatus """
+
+    def __init__(self):
+        self.bins = []  # Name of bin of each bin code
+        self.codes = dict()  # Code of each bin name
+        self.fingerprints = dict()  # Fingerprint of classification of each bin indexed
+        self.postings = {c: dict() for c in INDEXED_COLUMNS}  # Sorted keys of each value of each column
+
+    @classmethod
+    def from_classification(cls, classification_data):
+        """ Index classification data of BinExtractor.init_ecotaxa_classification """
+        index = cls()
+        index.update(classification_data)
+        return index
+
+    def _bin_codes(self, bin_names):
+        for b in bin_names:
+            if b not in self.codes:
+                self.codes[b] = len(self.bins)
+                self.bins.append(b)
+        return np.array([self.codes[b] for b in bin_names], dtype=np.uint64)
+
+    def update(self, classification_data):
+        """
+        Index again bins whose classification changed (or are new) and remove bins absent from classification data
+        :return: names of bins indexed again or removed
+        """
+        from ifcb_manifest import group_fingerprints
+        data = classification_data[['bin', 'ImageId', *INDEXED_COLUMNS]]
+        fingerprints = group_fingerprints(data, 'bin', 'ImageId').to_dict()
+        stale = [b for b in self.fingerprints if b not in fingerprints] + \
+                [b for b, f in fingerprints.items() if self.fingerprints.get(b) != f]
+        if not stale:
+            return stale
+        # Remove keys of stale bins
+        stale_codes = self._bin_codes(stale)
+        for postings in self.postings.values():
+            for value, keys in list(postings.items()):
+                keys = keys[~np.isin(keys >> np.uint64(32), stale_codes)]
+                if len(keys):
+                    postings[value] = keys
+                else:
+                    del postings[value]
+        # Add keys of bins changed
+        data = data[data['bin'].isin(stale)]
+        bin_names = data['bin'].astype(str).to_numpy()
+        unique_bins, inverse = np.unique(bin_names, return_inverse=True)
+        keys = (self._bin_codes(unique_bins)[inverse] << np.uint64(32)) | data['ImageId'].to_numpy(np.uint64)
+        for c in INDEXED_COLUMNS:
+            values = pd.Categorical(data[c])
+            codes = values.codes
+            order = np.lexsort((keys, codes))
+            codes, sorted_keys = codes[order], keys[order]
+            bounds = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1], True])
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if codes[start] < 0:  # Missing value
+                    continue
+                value = values.categories[codes[start]]
+                new = np.unique(sorted_keys[start:end])
+                old = self.postings[c].get(value)
+                self.postings[c][value] = new if old is None else union(old, new)
+        for b in stale:
+            if b in fingerprints:
+                self.fingerprints[b] = fingerprints[b]
+            else:
+                del self.fingerprints[b]
+        return stale
+
+    def values(self, column):
+        """ Values of column indexed with their number of images """
+        return pd.Series({v: len(k) for v, k in self.postings[column].items()}, dtype='int64').sort_index()
+
+    def get(self, column, value):
+        """ Keys of images with value (or any of the values if list) in column """
+        if isinstance(value, (list, tuple, set)):
+            return union(*[self.get(column, v) for v in value])
+        return self.postings[column].get(value, np.empty(0, dtype=np.uint64))
+
+    def select(self, **criteria):
+        """ Keys of images matching all criteria, e.g. select(Group=['Diatoms', 'Dinoflagellates'], AnnotationStatus=
+        'validated'), all images indexed if no criteria """
+        if not criteria:
+            return union(*[k for postings in self.postings.values() for k in postings.values()])
+        return intersect(*[self.get(column, value) for column, value in criteria.items()])
+
+    def images(self, keys):
+        """ Table of bin and ImageId of keys """
+        keys = np.asarray(keys, dtype=np.uint64)
+        return pd.DataFrame({'bin': pd.Categorical.from_codes((keys >> np.uint64(32)).astype(np.int64),
+                                                              categories=self.bins),
+                             'ImageId': (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)})
+
+    def save(self, filename):
+        """ Save index in compressed npz file, keys are delta encoded """
+        arrays, labels = dict(), []
+        for c, postings in self.postings.items():
+            for value, keys in postings.items():
+                arrays[f'p{len(labels)}'] = np.diff(keys, prepend=np.uint64(0))
+                labels.append(f'{c}\t{value}')
+        fingerprints = [self.fingerprints.get(b, '') for b in self.bins]
+        np.savez_compressed(filename, bins=np.array(self.bins, dtype=str), labels=np.array(labels, dtype=str),
+                            fingerprints=np.array(fingerprints, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with np.load(filename) as f:
+            index.bins = f['bins'].tolist()
+            index.codes = {b: i for i, b in enumerate(index.bins)}
+            index.fingerprints = {b: fp for b, fp in zip(index.bins, f['fingerprints'].tolist()) if fp}
+            for i, label in enumerate(f['labels'].tolist()):
+                c, value = label.split('\t', 1)
+                index.postings[c][value] = np.cumsum(f[f'p{i}'], dtype=np.uint64)
+        return index
+
+
+def update_index(classification_data, filename):
+    """ Load index saved in filename (if any), update it with classification data, and save it """
+    index = TaxonIndex.load(filename) if os.path.isfile(filename) else TaxonIndex()
+    stale = index.update(classification_data)
+    if stale or not os.path.isfile(filename):
+        index.save(filename)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or update inverted index of classification (taxon, group, '
+                                                 'annotation status) of IFCB images.')
+    parser.add_argument('-e', '--ecotaxa', type=str, required=True,
+                        help='Set path to EcoTaxa classification directory or file.')
+    parser.add_argument('-t', '--taxonomy', type=str, required=True, help='Set path to taxonomic grouping file.')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Set path to index (npz file).')
+    args = parser.parse_args()
+
+    from extractIFCBdata import BinExtractor
+    extractor = BinExtractor(None, path_to_ecotaxa_tsv=args.ecotaxa, path_to_taxonomic_grouping_csv=args.taxonomy)
+    index = update_index(extractor.classification_data, args.output)
+    print(f'{len(index.fingerprints)} bins indexed in {args.output}.')
+    print(index.values('Group').to_string())
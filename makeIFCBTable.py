@@ -0,0 +1,200 @@
+"""
+Consolidate the science data exported by extractIFCBdata.py (metadata.csv and <bin>_sci.csv) into one table with
+    + calibrated features (pixel to um)
+    + reliable samples (flag, volume sampled, concentration, and type of samples)
+saved in Parquet (one row per image) and MATLAB v7.3 formats. Python version of matlab_helpers/make_ifcb_table.m
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from ifcb_flags import FLAG_BITS, flag_mask
+
+CALIBRATION = {1: ['EquivalentDiameter', 'MinFeretDiameter', 'MaxFeretDiameter', 'MinorAxisLength', 'MajorAxisLength',
+                   'Perimeter', 'ConvexPerimeter', 'RepresentativeWidth'],  # um
+               2: ['Area', 'ConvexArea', 'SurfaceArea'],  # um^2
+               3: ['Biovolume']}  # um^3
+UNITS = {'NumberBlobsInImage': 'counts', 'NumberImagesInTrigger': 'counts', 'Orientation': 'degrees',
+         'SSCIntegrated': 'volts', 'FLIntegrated': 'volts', 'SSCPeak': 'volts', 'FLPeak': 'volts',
+         'TimeOfFlight': '???', 'ImageX': 'pixels', 'ImageY': 'pixels', 'ImageWidth': 'pixels', 'ImageHeight': 'pixels',
+         'ImageId': 'no units', 'Eccentricity': 'no units', 'Extent': 'no units', 'Solidity': 'no units',
+         'AnnotationStatus': 'no units', 'Taxon': 'no units', 'Group': 'no units'}
+FLAGS_TO_REMOVE = ['incomplete', 'bad', 'questionable', 'flush', 'bad_alignment', 'bad_focus', 'corrupted']
+TYPES_TO_REMOVE = ['PIC', 'ali6000', 'dock', 'micro-layer', 'incubation', 'karen', 'test', 'towfish', 'zootow',
+                   'culture']
+MAX_VOLUME_SAMPLED = 5.5  # mL
+CATEGORICAL_COLUMNS = ['AnnotationStatus', 'Taxon', 'Group']
+
+
+def read_sci(path_to_sci, bin_name):
+    """ Read science data of one bin, return None if file is missing """
+    filename = os.path.join(path_to_sci, bin_name + '_sci.csv')
+    if not os.path.isfile(filename):
+        print(f'Skipped {bin_name}')
+        return None
+    data = pd.read_csv(filename, engine='c')
+    if 'Status' in data.columns:
+        data.rename(columns={'Status': 'AnnotationStatus'}, inplace=True)
+    return data
+
+
+def calibrate(data, resolution):
+    """ Convert features from pixels to um (in place), return units of each column """
+    units = dict(UNITS)
+    for power, columns in CALIBRATION.items():
+        for c in columns:
+            if c in data.columns:
+                data[c] = data[c] / resolution ** power
+            units[c] = 'um' if power == 1 else f'um^{power}'
+    return units
+
+
+def to_datenum(dt):
+    """ Convert datetime to MATLAB serial date number """
+    return (dt - pd.Timestamp('1970-01-01')) / pd.Timedelta(days=1) + 719529
+
+
+def make_ifcb_table(info, cfg, n_workers=4, formats=('parquet', 'mat')):
+    """
+    Build table of IFCB samples from science data
+
+    :param info: dictionary with PROJECT_NAME, ECOTAXA_EXPORT_DATE, IFCB_RESOLUTION (pixels/um), CALIBRATED (bool),
+        and REMOVED_CONCENTRATED_SAMPLES (bool), completed with the samples removed and saved with the table
+    :param cfg: dictionary with path_to_input_data (directory of run_science) and path_to_output_table
+    :param n_workers: number of bins read in parallel
+    :param formats: parquet (one row per image including metadata of bin) and/or mat (structures ifcb: one row per bin,
+        images: one row per image with BinIndex, and info)
+    :return: metadata (one row per bin), data (one row per image), and info
+    :raises ValueError: if no sample is left after removing flagged, unrealistic volume, concentrated, unused type, and
+        empty samples
+    """
+    info = dict(info)
+    path_to_sci = cfg['path_to_input_data']
+    # Read metadata
+    meta = pd.read_csv(os.path.join(path_to_sci, 'metadata.csv'), parse_dates=['DateTime'])
+    meta.rename(columns={'Validated': 'AnnotationValidated'}, inplace=True)
+    removed = dict()  # Number of bins removed by each filter
+    # Remove flagged samples
+    print('Removing flagged data ... ', end='')
+    sel = flag_mask(meta['Flag'], include=FLAGS_TO_REMOVE)
+    info['FLAGS_TO_REMOVE'] = [FLAG_BITS[f] for f in FLAGS_TO_REMOVE]
+    info['REMOVED_BINS_FLAGGED'] = meta.loc[sel, 'BinId'].to_list()
+    removed['flag'] = int(sel.sum())
+    meta = meta[~sel]
+    print('Done')
+    # Remove un-realistic volumes (bug in software)
+    sel = (meta['VolumeSampled'] < 0) | (MAX_VOLUME_SAMPLED < meta['VolumeSampled'])
+    print(f'Removing {sel.sum()} un-real volumes (#bug) ... ', end='')
+    info['REMOVED_NON_REALISTIC_SAMPLE_VOLUME'] = meta.loc[sel, 'BinId'].to_list()
+    removed['volume sampled'] = int(sel.sum())
+    meta = meta[~sel]
+    print('Done')
+    # Remove concentrated samples
+    if info['REMOVED_CONCENTRATED_SAMPLES']:
+        sel = meta['Concentration'] != 1
+        print(f'Removing {sel.sum()} concentrated samples ... ', end='')
+        info['REMOVED_CONCENTRATED_SAMPLES'] = meta.loc[sel, 'BinId'].to_list()
+        removed['concentration'] = int(sel.sum())
+        meta = meta[~sel].drop(columns='Concentration')
+        print('Done')
+    # Remove types of samples not studied
+    if 'Type' in meta.columns:
+        print('Removing unused type of samples ... ', end='')
+        sel = meta['Type'].isin(TYPES_TO_REMOVE)
+        removed['type'] = int(sel.sum())
+        meta = meta[~sel]
+        info['REMOVED_TYPES'] = TYPES_TO_REMOVE
+        print('Done')
+        print('Types left:\n' + '\n'.join(f'\t- {t}' for t in meta['Type'].dropna().unique()))
+    # Read science data of samples left
+    with ThreadPoolExecutor(n_workers) as executor:
+        data = list(executor.map(lambda b: read_sci(path_to_sci, b), meta['BinId']))
+    n_images = np.array([0 if d is None else len(d.index) for d in data])
+    # Remove samples with no images
+    sel = n_images == 0
+    print(f'Removing {sel.sum()} empty samples (no images) ... ', end='')
+    info['REMOVED_EMPTY_SAMPLES'] = meta.loc[sel, 'BinId'].to_list()
+    removed['no images'] = int(sel.sum())
+    meta, n_images = meta[~sel].reset_index(drop=True), n_images[~sel]
+    if meta.empty:
+        raise ValueError('No samples left to make IFCB table, bins removed by filter: ' +
+                         ', '.join(f'{k}: {v}' for k, v in removed.items()))
+    data = pd.concat([d for d in data if d is not None and not d.empty], ignore_index=True)
+    print('Done')
+    for c in CATEGORICAL_COLUMNS:
+        if c in data.columns:
+            data[c] = data[c].astype('category')
+    data.insert(0, 'BinId', pd.Categorical.from_codes(np.repeat(np.arange(len(meta.index)), n_images),
+                                                      categories=meta['BinId']))
+    # Check missing classification
+    if 'Type' in meta.columns and 'AnnotationValidated' in meta.columns:
+        for t in ['inline', 'niskin']:
+            sel = (meta['Type'] == t) & meta['AnnotationValidated'].isna()
+            print(f'Missing EcoTaxa samples in {t}: {sel.sum()} samples, {n_images[sel].sum()} images')
+            if sel.any():
+                info[f'MISSING_{t.upper()}_CLASSIFICATION_IMAGES'] = int(n_images[sel].sum())
+                info[f'MISSING_{t.upper()}_CLASSIFICATION_BINS'] = int(sel.sum())
+                info[f'MISSING_{t.upper()}_CLASSIFICATION'] = meta.loc[sel, 'BinId'].to_list()
+    # Calibrate features (pixels to um)
+    if info['CALIBRATED']:
+        print('Calibrating ... ', end='')
+        info['UNITS'] = calibrate(data, info['IFCB_RESOLUTION'])
+        print('Done')
+    info['CREATED'] = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+    # Save
+    filename = os.path.join(cfg['path_to_output_table'], f"{info['PROJECT_NAME']}_IFCB_{info['ECOTAXA_EXPORT_DATE']}")
+    if 'parquet' in formats:
+        print('Saving Parquet table ... ', end='')
+        write_parquet(filename + '.parquet', meta, data, info)
+        print('Done')
+    if 'mat' in formats:
+        print('Saving MATLAB table ... ', end='')
+        write_mat(filename + '.mat', meta, data, n_images, info)
+        print('Done')
+    return meta, data, info
+
+
+def write_parquet(filename, meta, data, info):
+    """ Write one row per image with the metadata of its bin, info is saved in the metadata of the file """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = data.merge(meta.astype({'BinId': data['BinId'].dtype}), on='BinId', how='left', sort=False)
+    table = pa.Table.from_pandas(table, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'ifcb_info': json.dumps(info).encode()})
+    pq.write_table(table, filename, compression='zstd')
+
+
+def write_mat(filename, meta, data, n_images, info):
+    """
+    Write MATLAB v7.3 (HDF5) file with the structures:
+        ifcb: metadata of each bin (column vectors, text as cell arrays, DateTime as datenum)
+        images: data of each image (column vectors) with BinIndex (row in ifcb), categorical columns are saved as
+            codes (0 if missing) with their categories in <column>Categories, e.g. categorical(images.Taxon,
+            1:numel(images.TaxonCategories), images.TaxonCategories)
+        info: configuration and samples removed
+    """
+    import hdf5storage
+
+    def column(values):
+        values = np.asarray(values)
+        if values.dtype.kind in 'OU':
+            values = np.array(['' if pd.isna(v) else str(v) for v in values], dtype=object)
+        return values.reshape(-1, 1)
+
+    ifcb = {'NumberImages': column(n_images.astype('uint32'))}
+    for c in meta.columns:
+        ifcb[c] = column(to_datenum(meta[c]) if c == 'DateTime' else meta[c])
+    images = {'BinIndex': column(data['BinId'].cat.codes.to_numpy('uint32') + 1)}
+    for c in data.columns.drop('BinId'):
+        if isinstance(data[c].dtype, pd.CategoricalDtype):
+            images[c] = column(data[c].cat.codes.to_numpy('int32') + 1)
+            images[c + 'Categories'] = column(data[c].cat.categories.astype(str))
+        else:
+            images[c] = column(data[c])
+    mat_info = {k: column(v) if isinstance(v, list) else v for k, v in info.items()}
+    hdf5storage.savemat(filename, {'ifcb': ifcb, 'images': images, 'info': mat_info}, format='7.3',
+                        matlab_compatible=True, store_python_metadata=False)
@@ -1,9 +1,9 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import pandas as pd
 import numpy as np
 import os.path
 import glob
-import warnings
 
 
 ENV_COLS = {'DateTime': 'UTC date time', 'Latitude': 'latitude', 'Longitude': 'longitude',
@@ -11,12 +11,57 @@ ENV_COLS = {'DateTime': 'UTC date time', 'Latitude': 'latitude', 'Longitude': 'l
 LOG_COLS = {'bin': 'IFCB_bin_id', 'Depth': 'depth', 'Type': 'source', 'Source': 'source_id',
             'Reference': 'reference', 'Epoch': 'stn', 'Cast': 'cast', 'EpochDay': 'epoch_day', 'Flag': 'flag'}
 META_DEFAULTS = {'Type': 'inline', 'Depth': 5, 'Campaign': 2, 'Concentration': 1}
+ENV_CACHE_VERSION = 2  # Increment when the data cached of environmental files changes
 
 
-def read_env(filenames, keys=ENV_COLS, read_csv_kwargs=None):
+def _read_env_file(filename, keys, read_csv_kwargs, resolution=None):
+    """
+    Read one environmental data file loading only the columns listed in keys
+    and optionally average data over periods of length resolution
+    """
+    ikeys = {v: k for k, v in keys.items()}  # Remap dictionary
+    usecols = set(keys.values())
+    parse_dates = read_csv_kwargs.get('parse_dates', [])
+    for c in parse_dates.values() if isinstance(parse_dates, dict) else parse_dates:
+        usecols.update([c] if isinstance(c, str) else c)  # Columns combined to parse dates
+    kwargs = {'usecols': lambda c: c in usecols, **read_csv_kwargs}
+    try:
+        df = pd.read_csv(filename, **kwargs)
+    except UnicodeDecodeError:
+        print(f'Codec Error reading {filename}')
+        return None
+    df.rename(columns=ikeys, inplace=True)
+    df.drop(columns=[c for c in df.columns if c not in keys.keys()], inplace=True)
+    if resolution is not None:
+        # Mean of each period is timestamped at the mean time of its data (not at the start of the period)
+        # so interpolating means at the time of bins is not shifted
+        df['DateTime'] = pd.to_datetime(df['DateTime'])
+        groups = df.groupby(df['DateTime'].dt.floor(resolution))
+        means = groups.mean(numeric_only=True)
+        means.insert(0, 'DateTime', groups['DateTime'].mean())
+        df = means.reset_index(drop=True)
+    return df
+
+
+def _env_cache_key(filename, keys, read_csv_kwargs, resolution):
+    stat = os.stat(filename)
+    return hashlib.sha1(repr((ENV_CACHE_VERSION, os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+                              keys, read_csv_kwargs, resolution)).encode()).hexdigest()[:16]
+
+
+def read_env(filenames, keys=ENV_COLS, read_csv_kwargs=None,
+             resolution=None, around=None, window=None, path_to_cache=None, n_workers=4):
     """
     Read Environmental Data typically consisting of GPS and TSG measurements.
-    It concatenates data from multiple files into a single pandas dataframe/
+    It concatenates data from multiple files into a single pandas dataframe sorted by DateTime.
+
+    Only the columns in keys are read, files are read in parallel (n_workers threads).
+    If resolution is set (e.g. '1min'), data is averaged over periods of length resolution (timestamped at the mean
+        time of the data of each period, so interpolation at the time of bins is not shifted).
+    If around is set (list of bin DateTime), only data within window (default resolution or 10 min)
+        of one of the bins is kept.
+    If path_to_cache is set, the data of each file and the merged data are cached in feather files (requires pyarrow)
+        so only new or modified files are read the next time.
     """
     if type(filenames) == str:
         filenames = [filenames]
@@ -25,18 +70,63 @@ def read_env(filenames, keys=ENV_COLS, read_csv_kwargs=None):
     for k in ['DateTime', 'Latitude', 'Longitude']:
         if k not in keys:
             raise ValueError(f'Environmental data missing key: {k}')
-    ikeys = {v: k for k, v in keys.items()}  # Remap dictionary
-    env = list()
-    for f in filenames:
-        try:
-            df = pd.read_csv(f, **read_csv_kwargs)
-        except UnicodeDecodeError:
-            print(f'Codec Error reading {f}')
-            continue
-        df.rename(columns=ikeys, inplace=True)
-        df.drop(columns=[c for c in df.columns if c not in keys.keys()], inplace=True)
-        env.append(df)
-    return pd.concat(env)
+    if path_to_cache is None:
+        with ThreadPoolExecutor(n_workers) as executor:
+            env = list(executor.map(lambda f: _read_env_file(f, keys, read_csv_kwargs, resolution), filenames))
+        env = pd.concat(env).sort_values('DateTime', kind='stable').reset_index(drop=True)
+    else:
+        if not os.path.isdir(path_to_cache):
+            os.makedirs(path_to_cache)
+        cache_keys = [_env_cache_key(f, keys, read_csv_kwargs, resolution) for f in filenames]
+        merged_filename = os.path.join(path_to_cache, 'env.' + hashlib.sha1(''.join(cache_keys).encode())
+                                       .hexdigest()[:16] + '.feather')
+
+        def read_env_file_cached(f, key):
+            # Path hash prevents files with the same name in different directories from sharing a cache
+            stem = f'{os.path.basename(f)}.{hashlib.sha1(os.path.abspath(f).encode()).hexdigest()[:8]}'
+            cache_filename = os.path.join(path_to_cache, f'{stem}.{key}.feather')
+            if os.path.isfile(cache_filename):
+                return pd.read_feather(cache_filename)
+            df = _read_env_file(f, keys, read_csv_kwargs, resolution)
+            if df is not None:
+                for old in glob.glob(os.path.join(path_to_cache, f'{glob.escape(stem)}.*.feather')):
+                    os.remove(old)
+                df.reset_index(drop=True).to_feather(cache_filename)
+            return df
+
+        if os.path.isfile(merged_filename):
+            env = pd.read_feather(merged_filename)
+        else:
+            with ThreadPoolExecutor(n_workers) as executor:
+                env = list(executor.map(read_env_file_cached, filenames, cache_keys))
+            env = pd.concat(env).sort_values('DateTime', kind='stable').reset_index(drop=True)
+            for old in glob.glob(os.path.join(path_to_cache, 'env.*.feather')):
+                os.remove(old)
+            env.to_feather(merged_filename)
+    if around is not None:
+        # Keep only data close to bins
+        if window is None:
+            window = resolution if resolution is not None else '10min'
+        t_bin = np.sort(pd.to_datetime(around).to_numpy(dtype='datetime64[ns]'))
+        t = pd.to_datetime(env['DateTime']).to_numpy(dtype='datetime64[ns]')
+        window = pd.Timedelta(window).to_timedelta64()
+        i = np.searchsorted(t_bin, t)
+        near = np.zeros(len(t), dtype=bool)
+        if len(t_bin) > 0:
+            near = (np.abs(t - t_bin[np.maximum(i - 1, 0)]) <= window) | \
+                   (np.abs(t_bin[np.minimum(i, len(t_bin) - 1)] - t) <= window)
+        env = env[near].reset_index(drop=True)
+    return env
+
+
+def list_bins(path_to_raw):
+    """ List name of bins in path_to_raw """
+    return [os.path.splitext(os.path.basename(f))[0] for f in sorted(glob.glob(os.path.join(path_to_raw, '*.roi')))]
+
+
+def bin_datetimes(bins):
+    """ Get DateTime of each bin from its name (D<yyyymmdd>T<HHMMSS>_IFCB<SN#>) """
+    return pd.to_datetime(pd.Index(bins).str[:-8], format='D%Y%m%dT%H%M%S')
 
 
 def read_log(filename, sheet_name='Sheet1', keys=LOG_COLS):
@@ -76,8 +166,10 @@ def make_metadata(path_to_raw, env, log, events={}, defaults=META_DEFAULTS):
     Bin marked as flagged are moved into raw/ignored
     """
     path_to_ignored = os.path.join(path_to_raw, 'ignored')
+    if 'bin' in log.columns:
+        log = log.set_index('bin')
     # List all samples
-    bins = [os.path.splitext(os.path.basename(f))[0] for f in sorted(glob.glob(os.path.join(path_to_raw, '*.roi')))]
+    bins = list_bins(path_to_raw)
     # Ignore samples flagged with delete
     if 'Flag' in log.columns:
         for b in log.index[log.Flag == 'delete']:
@@ -95,54 +187,57 @@ def make_metadata(path_to_raw, env, log, events={}, defaults=META_DEFAULTS):
     # Interpolate Env parameters to all samples
     seen = set()
     keys = [x for x in ['bin', *list(env.keys()), *list(log.keys())] if not (x in seen or seen.add(x))]
-    meta = {c: [] for c in keys}
-    meta['bin'] = bins
-    ts = []
-    for b in bins:
-        meta['DateTime'].append(datetime.strptime(b[:-8], 'D%Y%m%dT%H%M%S'))
-        ts.append(meta['DateTime'][-1].timestamp())
-    for k in env.keys():
-        if k == 'DateTime':
-            continue
-        meta[k] = np.interp(ts, env.DateTime.to_numpy(dtype=np.int64) / 10**9, env[k], left=np.nan, right=np.nan)
+    meta = pd.DataFrame(index=pd.Index(bins, name='bin'))
+    meta['DateTime'] = bin_datetimes(meta.index)
+    env = env.sort_values('DateTime') if not env.DateTime.is_monotonic_increasing else env
+    t, t_env = meta.DateTime.to_numpy(dtype=np.int64), env.DateTime.to_numpy(dtype=np.int64)
+    for k in keys[1:]:
+        if k in env.keys() and k != 'DateTime':
+            meta[k] = np.interp(t, t_env, env[k], left=np.nan, right=np.nan)
+        elif k != 'DateTime':
+            meta[k] = np.nan
     # Set Default Parameters (if field absent from log or env it's added)
     for k, v in defaults.items():
-        meta[k] = [v] * len(bins)
-    # Set Remaining Fields to nan
-    for k in [k for k in log.keys() if k not in ['bin', *list(env.keys()), *list(defaults.keys())]]:
-        meta[k] = [np.nan] * len(bins)
-    meta = pd.DataFrame(meta).set_index('bin')
+        meta[k] = v
+    meta = meta[[*keys[1:], *[k for k in defaults.keys() if k not in keys]]]
     # Set Events
     for event_key, event_list in events.items():
-        for name, e in event_list.iterrows():
-            sel = (e.start <= meta.DateTime) & (meta.DateTime < e.end)
-            meta.loc[sel, event_key] = name
+        intervals = pd.IntervalIndex.from_arrays(event_list.start, event_list.end, closed='left')
+        current = meta[event_key].to_numpy(dtype=object) if event_key in meta.columns \
+            else np.full(len(meta), np.nan, dtype=object)
+        if not intervals.is_overlapping:
+            i = intervals.get_indexer(meta.DateTime)
+            current = np.where(i >= 0, event_list.index.to_numpy(dtype=object)[i], current)
+        else:
+            # Last event listed takes precedence
+            for name, e in event_list.iterrows():
+                current[((e.start <= meta.DateTime) & (meta.DateTime < e.end)).to_numpy()] = name
+        meta[event_key] = pd.Series(current, index=meta.index).infer_objects()
     # Append log data to selected samples
-    with warnings.catch_warnings():  # This task fragments the DataFrame in memory but is still really fast to run
-        warnings.filterwarnings('ignore', category=pd.errors.PerformanceWarning)
-        for b, r in log.iterrows():
-            i = meta.index[b == meta.index]
-            if i.empty:
-                print(f'Raw bin missing or invalid log bin: {b}')
-                continue
-            i = i[0]
-            # Empty environmental data if Depth field is not empty likely incorrect except dt, lat, and lon
-            if ('Depth' in r.keys() and not r.isnull()['Depth']) and \
-                    ('Depth' in defaults.keys() and r['Depth'] > defaults['Depth']):
-                for kk in env.keys():
-                    if kk not in ['DateTime', 'Latitude', 'Longitude']:
-                        meta.loc[i, kk] = np.nan
-            for k, missing in r.isnull().items():
-                if not missing:
-                    meta.loc[i, k] = r[k]
-    meta = meta.copy()  # Necessary as data is highly fragmented due to insertion of data at specific locations
+    for b in log.index[~log.index.isin(meta.index)]:
+        print(f'Raw bin missing or invalid log bin: {b}')
+    log = log[log.index.isin(meta.index)]
+    if not log.index.is_unique:
+        log = log.groupby(level=0, sort=False).last()  # last non null value
+    # Empty environmental data if Depth field is not empty likely incorrect except dt, lat, and lon
+    if 'Depth' in log.columns and 'Depth' in defaults.keys():
+        deep = log.index[pd.to_numeric(log.Depth, errors='coerce') > defaults['Depth']]
+        meta.loc[deep, [k for k in env.keys() if k not in ['DateTime', 'Latitude', 'Longitude']]] = np.nan
+    merged = log.combine_first(meta).reindex(index=meta.index, columns=meta.columns)
+    for k in log.columns.intersection(meta.columns):
+        # Keep integer columns as such if log values are integers (e.g. Depth)
+        if meta[k].dtype.kind in 'iu' and merged[k].dtype.kind == 'f' and (merged[k] % 1 == 0).all():
+            merged[k] = merged[k].astype(meta[k].dtype)
+    meta = merged
     return meta
 
 
 if __name__ == '__main__':
     # %% EXPORTS NA
     # root = '/Users/nils/Data/EXPORTS2/'
-    # env = read_env(sorted(glob.glob(os.path.join(root, 'TSG', '*.csv'))))
+    # env = read_env(sorted(glob.glob(os.path.join(root, 'TSG', '*.csv'))), resolution='1min',
+    #                around=bin_datetimes(list_bins(os.path.join(root, 'IFCB107', 'raw'))),
+    #                path_to_cache=os.path.join(root, 'TSG', 'cache'))
     # log = read_log(os.path.join(root, 'IFCB107', 'IFCB_log_EXPORTS02.xlsx'))
     # events = read_events({'Epoch': os.path.join(root, 'IFCB107', 'EXPORTS2.epochs.csv')})
     # meta = make_metadata(os.path.join(root, 'IFCB107', 'raw'), env, log, events)
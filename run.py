@@ -5,7 +5,8 @@ from datetime import datetime
 
 import pandas as pd
 
-from extractIFCBdata import BinExtractor, __version__, flag_str_to_int
+from extractIFCBdata import BinExtractor, __version__
+from ifcb_flags import parse_flags, flag_mask
 
 
 """
@@ -55,9 +56,9 @@ meta = pd.read_csv(path_to_metadata, index_col='bin')
 # ['LEG01_Lorient-Amsterdam', 'LEG02_Amsterdam-Aarhus', 'LEG03_Aarhus-Sopot', 'LEG05_Tallin-Kristineberg', 'LEG06_Kristineberg-Galway', 'LEG07_Galway-Bilbao', 'LEG08_Bilbao-Cadiz',
 #  nan, 'LEG09_Malaga-Barcelona', 'LEG10_Barcelona-Marseille', 'LEG11_Marseille-Napoli', 'LEG13_Ancona-Kotor', 'LEG_HyperBoost']
 leg_name = 'LEG_HyperBoost'
-meta['flag_int'] = meta.Flag.apply(flag_str_to_int).astype(int)
+meta['flag_int'] = parse_flags(meta.Flag)
 bin_list = meta.index[(meta.Leg == leg_name) &
-                      ~((meta.flag_int & 2**10) | (meta.flag_int & 2**2) | (meta.flag_int & 2**1) | (meta.flag_int & 2**5))].tolist()
+                      flag_mask(meta.flag_int, exclude=['corrupted', 'bad', 'incomplete', 'flush'])].tolist()
 path_to_ecotaxa = os.path.join(path_to_ecotaxa, leg_name)
 if not os.path.exists(path_to_ecotaxa):
     os.makedirs(path_to_ecotaxa)
@@ -108,5 +109,11 @@ ifcb.run_ecotaxa(output_path=path_to_ecotaxa, bin_list=bin_list,
 # Prepare IFCB data for Scientific Use
 ifcb.run_science(output_path=path_to_science, bin_list=bin_list, update_classification=True,
                  make_matlab_table=True, matlab_table_info=info)
+# Prepare IFCB data for Scientific Use on several nodes (run_worker on each node, then finalize_science once)
+# from ifcb_queue import WorkQueue, run_worker, finalize_science
+# queue = WorkQueue(os.path.join(root, 'queue.db'), 'sci')
+# queue.add(bin_list)
+# run_worker(queue, ifcb, 'ecology', path_to_science, update_classification=True)
+# finalize_science(queue, ifcb, path_to_science, make_matlab_table=True, matlab_table_info=info)
 # EXPORT IFCB data to SeaBASS
 BinExtractor.run_seabass(path_to_science, path_to_seabass, seabass_metadata)
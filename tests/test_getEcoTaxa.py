@@ -0,0 +1,157 @@
+"""
+Test export, polling, and resumed download of getEcoTaxa.py against a local http server mocking EcoTaxa
+"""
+import io
+import os
+import re
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import getEcoTaxa  # noqa: E402
+
+PROJECT, TASK = 42, 7
+EXPORT_NAME = 'export_42.zip'
+
+
+def make_export():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr('ecotaxa_IFCB107.tsv', 'object_id\tobject_annotation_category\n[t]\t[t]\n' +
+                   ''.join(f'D20230501T000000_IFCB107_{i:05d}\tDiatoms\n' for i in range(1, 5000)))
+    return buffer.getvalue()
+
+
+class EcoTaxa:
+    """ State of mocked server: task done after n_pending polls, first drops downloads cut after cut bytes """
+
+    def __init__(self, n_pending=3, cut=2**14, drops=1):
+        self.export = make_export()
+        self.n_pending = n_pending
+        self.cut = cut
+        self.drops = drops
+        self.created = 0
+        self.polls = 0
+        self.ranges = []
+        self.cleaned = False
+        self.missing = False
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, status=200, headers=()):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/Task/Create/TaskExportTxt'):
+            self.server.state.created += 1
+            self._send(f'<div class="alert alert-success alert-dismissible">Taks {TASK} created</div>'.encode())
+        else:
+            self._send(b'', 404)
+
+    def do_GET(self):
+        state = self.server.state
+        if self.path == '/Task/listall':
+            state.polls += 1
+            status = 'Done' if state.polls > state.n_pending else 'Running'
+            self._send(f'<a href="/Task/Show/{TASK}">{TASK}</a><a href="/Task/Show/{TASK}">{status}</a>'.encode())
+        elif self.path == f'/Task/Show/{TASK}':
+            self._send(f'<a href="/prj/{PROJECT}">IFCB (test)</a>'
+                       f'<a class="btn btn-primary btn-sm">file {EXPORT_NAME}</a>'.encode())
+        elif self.path == f'/Task/GetFile/{TASK}/{EXPORT_NAME}' and not state.missing:
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            offset = int(match.group(1)) if match else 0
+            state.ranges.append(offset)
+            body = state.export[offset:]
+            headers = [('Content-Range', f'bytes {offset}-{len(state.export) - 1}/{len(state.export)}')] \
+                if match else []
+            self.send_response(206 if match else 200)
+            for k, v in headers:
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if len(state.ranges) <= state.drops:
+                # Drop connection during first downloads
+                self.wfile.write(body[:state.cut])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+        elif self.path == f'/Task/Clean/{TASK}':
+            state.cleaned = True
+            self._send(b'')
+        else:
+            self._send(b'', 404)
+
+
+@pytest.fixture
+def ecotaxa(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.state = EcoTaxa()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(getEcoTaxa, 'ECOTAXA_URL', f'http://127.0.0.1:{server.server_address[1]}')
+    monkeypatch.setattr(getEcoTaxa, 'CHUNK_SIZE', 2**12)  # Chunks received before connection is dropped are kept
+    delays = []
+    monkeypatch.setattr(getEcoTaxa, 'sleep', delays.append)
+    server.state.delays = delays
+    yield server.state
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_resume(ecotaxa, tmp_path):
+    url = getEcoTaxa.ECOTAXA_URL + f'/Task/GetFile/{TASK}/{EXPORT_NAME}'
+    filename = str(tmp_path / EXPORT_NAME)
+    with getEcoTaxa.makeSession() as session:
+        getEcoTaxa.downloadFile(session, url, filename)
+    assert ecotaxa.ranges == [0, ecotaxa.cut]
+    assert not os.path.exists(filename + '.part')
+    with open(filename, 'rb') as f:
+        assert f.read() == ecotaxa.export
+
+
+def test_download_projects(ecotaxa, tmp_path):
+    with getEcoTaxa.makeSession() as session:
+        getEcoTaxa.downloadProjs(session, [PROJECT], str(tmp_path))
+    # Polling backs off while the export is running, then the export is downloaded (resumed) and extracted
+    assert ecotaxa.delays == [2, 4, 8, 16]
+    assert ecotaxa.ranges == [0, ecotaxa.cut]
+    assert ecotaxa.cleaned
+    folder, = os.listdir(tmp_path)
+    assert os.listdir(tmp_path / folder / 'IFCB_test') == ['ecotaxa_IFCB107.tsv']
+
+
+def test_download_resume_across_runs(ecotaxa, tmp_path):
+    # Every attempt of the first run is dropped, the next run resumes the partial download of the same export task
+    ecotaxa.drops = 3
+    with getEcoTaxa.makeSession() as session, pytest.raises(getEcoTaxa.requests.RequestException):
+        getEcoTaxa.downloadProjs(session, [PROJECT], str(tmp_path))
+    partial = tmp_path / getEcoTaxa.PARTIAL_FOLDER
+    assert sorted(os.listdir(partial)) == [f'{PROJECT}.task', f'{PROJECT}.zip.part']
+    with getEcoTaxa.makeSession() as session:
+        getEcoTaxa.downloadProjs(session, [PROJECT], str(tmp_path))
+    assert ecotaxa.created == 1
+    assert ecotaxa.ranges == [0, ecotaxa.cut, 2 * ecotaxa.cut, 3 * ecotaxa.cut]
+    assert not partial.exists()
+    assert len(list(tmp_path.glob('EcoTaxa_*/IFCB_test/ecotaxa_IFCB107.tsv'))) == 1
+
+
+def test_download_error(ecotaxa, tmp_path):
+    ecotaxa.missing = True
+    with getEcoTaxa.makeSession() as session, pytest.raises(getEcoTaxa.requests.HTTPError):
+        getEcoTaxa.downloadProjs(session, [PROJECT], str(tmp_path))
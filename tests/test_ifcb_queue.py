@@ -0,0 +1,118 @@
+"""
+Test leases of the work queue of ifcb_queue.py with worker processes sharing one SQLite file
+"""
+import multiprocessing
+import os
+import sqlite3
+import sys
+from collections import Counter
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ifcb_queue import WorkQueue, run_worker  # noqa: E402
+
+JOB = 'test'
+BINS = [f'D20230501T{h:02d}{m:02d}00_IFCB107' for h in range(4) for m in range(0, 60, 10)]
+
+
+class RecordingExtractor:
+    """ Stands for BinExtractor in mode ecotaxa: log bins processed, report bins of fail as failed """
+
+    def __init__(self, log, fail=(), delay=0.01):
+        self.log = log
+        self.fail = set(fail)
+        self.delay = delay
+
+    def run_ecotaxa(self, output_path, bin_list, failed=None, **kwargs):
+        for b in bin_list:
+            sleep(self.delay)
+            if b in self.fail:
+                failed[b] = 'CorruptedBin: test'
+                continue
+            with open(self.log, 'a') as f:
+                f.write(b + '\n')
+
+
+def work(path, log, output_path, worker):
+    run_worker(WorkQueue(path, JOB, worker=worker), RecordingExtractor(log), 'ecotaxa', output_path, batch=2,
+               poll_interval=0.05)
+
+
+def hold_leases(path, n, lease, ready):
+    """ Claim bins and wait to be killed without releasing them """
+    WorkQueue(path, JOB, lease=lease, worker='dead').claim(n)
+    ready.set()
+    sleep(60)
+
+
+def tasks(path):
+    with sqlite3.connect(path) as db:
+        return {b: (state, worker, attempts, error) for b, state, worker, attempts, error in db.execute(
+            'SELECT bin, state, worker, attempts, error FROM tasks WHERE job=?', (JOB,))}
+
+
+def logged(log):
+    with open(log) as f:
+        return Counter(line.strip() for line in f)
+
+
+def test_workers_drain_job(tmp_path):
+    path, log = str(tmp_path / 'queue.db'), str(tmp_path / 'log.txt')
+    WorkQueue(path, JOB).add(BINS)
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=work, args=(path, log, str(tmp_path / 'out'), f'w{i}')) for i in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(120)
+        assert w.exitcode == 0
+    # Each bin is processed exactly once
+    assert logged(log) == Counter(BINS)
+    t = tasks(path)
+    assert all(state == 'done' and attempts == 1 for state, _, attempts, _ in t.values())
+    assert WorkQueue(path, JOB).remaining() == 0
+
+
+def test_dead_worker_leases_reclaimed(tmp_path):
+    path, log = str(tmp_path / 'queue.db'), str(tmp_path / 'log.txt')
+    WorkQueue(path, JOB).add(BINS)
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Event()
+    dead = ctx.Process(target=hold_leases, args=(path, 3, 0.5, ready))
+    dead.start()
+    assert ready.wait(60)
+    dead.kill()
+    dead.join()
+    held = [b for b, (state, worker, _, _) in tasks(path).items() if worker == 'dead']
+    assert held == BINS[:3]
+    assert all(tasks(path)[b][0] == 'leased' for b in held)
+    # Bins of dead worker are claimed again once their lease expires
+    work(path, log, str(tmp_path / 'out'), 'alive')
+    assert logged(log) == Counter(BINS)
+    t = tasks(path)
+    assert all(t[b][:3] == ('done', 'alive', 2) for b in held)
+    assert all(t[b][:3] == ('done', 'alive', 1) for b in BINS[3:])
+
+
+def test_failed_after_max_attempts(tmp_path):
+    path, log = str(tmp_path / 'queue.db'), str(tmp_path / 'log.txt')
+    # Bins failing to process are released until max_attempts
+    queue = WorkQueue(path, JOB, max_attempts=3, worker='w')
+    queue.add(BINS)
+    run_worker(queue, RecordingExtractor(log, fail=BINS[:2], delay=0), 'ecotaxa', str(tmp_path / 'out'),
+               poll_interval=0.05)
+    t = tasks(path)
+    assert all(t[b][0] == 'failed' and t[b][2] == 3 and t[b][3] == 'CorruptedBin: test' for b in BINS[:2])
+    assert all(t[b][:3] == ('done', 'w', 1) for b in BINS[2:])
+    assert logged(log) == Counter(BINS[2:])
+    # Bins whose lease expired max_attempts times (worker killed each time) are not claimed again
+    queue = WorkQueue(path, 'killed', lease=0.05, max_attempts=2)
+    queue.add(BINS[:1])
+    for _ in range(2):
+        assert queue.claim() == BINS[:1]
+        sleep(0.1)
+    assert queue.claim() == []
+    assert queue.remaining() == 0
+    p = queue.progress()
+    assert p['counts']['failed'] == 1
+    assert p['failed']['error'].iloc[0] == 'Lease expired 2 times (worker died)'